@@ -0,0 +1,90 @@
+'''Shared helpers for the benchmark scripts: a throwaway app with a synthetic context.'''
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from incontext import create_app
+from incontext.db import get_db, migrate
+
+
+@contextmanager
+def bench_app(migrated=True, **config):
+    '''Yields an app bound to a fresh temporary database with the schema loaded and one user. With `migrated=False` only the baseline schema is loaded.'''
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({'TESTING': True, 'DATABASE': db_path, **config})
+    with app.app_context():
+        db = get_db()
+        with app.open_resource('schema.sql') as f:
+            db.executescript(f.read().decode('utf-8'))
+        if migrated:
+            migrate()
+        db.execute("INSERT INTO users (username, password) VALUES ('bench', 'x')")
+        db.commit()
+    try:
+        yield app
+    finally:
+        app.extensions['db'].close_all()
+        os.close(db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+def populate_context(db, lists, items, details, creator_id=1):
+    '''Creates a context with `lists` lists of `items` items and `details` details each. Returns the context id.'''
+    cur = db.cursor()
+    cur.execute(
+        "INSERT INTO contexts (creator_id, name, description) VALUES (?, ?, ?)",
+        (creator_id, "bench context", "synthetic context")
+    )
+    context_id = cur.lastrowid
+    for l in range(lists):
+        cur.execute(
+            "INSERT INTO lists (creator_id, name, description) VALUES (?, ?, ?)",
+            (creator_id, f"list {l}", f"synthetic list {l}")
+        )
+        list_id = cur.lastrowid
+        cur.execute("INSERT INTO context_list_relations (context_id, list_id) VALUES (?, ?)", (context_id, list_id))
+        detail_ids = []
+        for d in range(details):
+            cur.execute(
+                "INSERT INTO details (creator_id, name, description) VALUES (?, ?, ?)",
+                (creator_id, f"detail {d}", f"synthetic detail {d}")
+            )
+            detail_ids.append(cur.lastrowid)
+            cur.execute("INSERT INTO list_detail_relations (list_id, detail_id) VALUES (?, ?)", (list_id, cur.lastrowid))
+        for i in range(items):
+            cur.execute("INSERT INTO items (creator_id, name) VALUES (?, ?)", (creator_id, f"item {l}.{i}"))
+            item_id = cur.lastrowid
+            cur.execute("INSERT INTO list_item_relations (list_id, item_id) VALUES (?, ?)", (list_id, item_id))
+            cur.executemany(
+                "INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (?, ?, ?)",
+                [(item_id, detail_id, f"value {l}.{i}.{n}") for n, detail_id in enumerate(detail_ids)]
+            )
+    db.commit()
+    return context_id
+
+
+@contextmanager
+def count_queries(db):
+    queries = []
+    db.set_trace_callback(queries.append)
+    try:
+        yield queries
+    finally:
+        db.set_trace_callback(None)
+
+
+def timed(fn, *args, repeat=3):
+    '''Returns (best wall time in seconds, last result) over `repeat` runs.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
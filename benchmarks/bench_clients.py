@@ -0,0 +1,82 @@
+'''Compares per-call latency of building a new provider client for every message with reusing one from the registry, against a local OpenAI-compatible stand-in.'''
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _support import bench_app, timed
+
+from incontext.providers import clients, get_openai_client, make_openai_client, get_client_options
+
+
+RESPONSE = json.dumps({
+    'id': 'resp_bench',
+    'object': 'response',
+    'created_at': 0,
+    'model': 'bench',
+    'status': 'completed',
+    'output': [{
+        'type': 'message',
+        'id': 'msg_bench',
+        'role': 'assistant',
+        'status': 'completed',
+        'content': [{'type': 'output_text', 'text': 'pong', 'annotations': []}],
+    }],
+}).encode()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real APIs
+    disable_nagle_algorithm = True # otherwise delayed ACKs dominate the timings
+    connections = set()
+
+    def do_POST(self):
+        StandIn.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def call(client):
+    return client.responses.create(model='bench', input='ping').output_text
+
+
+def per_call_client(calls):
+    for _ in range(calls):
+        client = make_openai_client(os.environ['OPENAI_API_KEY'], **dict(get_client_options('openai')))
+        call(client)
+        client.close()
+
+
+def registry_client(calls):
+    for _ in range(calls):
+        call(get_openai_client())
+
+
+def main(calls=200):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+    base_url = f'http://127.0.0.1:{server.server_port}/v1'
+    try:
+        with bench_app(PROVIDER_BASE_URLS={'openai': base_url}) as app:
+            with app.app_context():
+                clients.clear()
+                print(f'{calls} calls against {base_url}')
+                for name, fn in (('new client per call', per_call_client), ('registry client', registry_client)):
+                    StandIn.connections.clear()
+                    seconds, _ = timed(fn, calls, repeat=1)
+                    print(f'{name:>20}: {seconds / calls * 1000:7.3f} ms/call, {len(StandIn.connections)} connections')
+                clients.clear()
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''Query count and wall time of building the context JSON, per-row lookups versus set-based queries.
+
+Run with `python benchmarks/bench_context_json.py`.
+'''
+import json
+
+from _support import bench_app, count_queries, populate_context, timed
+
+from incontext.db import get_db
+from incontext.conversations import get_context_payload
+
+
+def legacy_context_json(context_id):
+    '''The previous implementation: one query per list and one per item x detail.'''
+    db = get_db()
+    context = db.execute(
+        "SELECT l.id, l.name, l.description FROM lists l"
+        " JOIN context_list_relations clr ON clr.list_id = l.id"
+        " WHERE clr.context_id = ?",
+        (context_id,)
+    ).fetchall()
+    for alist in context:
+        alist["details"] = db.execute(
+            "SELECT d.id, d.name, d.description FROM details d"
+            " JOIN list_detail_relations r ON r.detail_id = d.id"
+            " WHERE r.list_id = ?",
+            (alist["id"],)
+        ).fetchall()
+    for alist in context:
+        alist["items"] = db.execute(
+            "SELECT i.id, i.name, i.created FROM items i"
+            " JOIN list_item_relations r ON r.item_id = i.id"
+            " WHERE r.list_id = ?",
+            (alist["id"],)
+        ).fetchall()
+        for item in alist["items"]:
+            item["created"] = item["created"].strftime("%Y-%m-%d")
+            for detail in alist["details"]:
+                item[detail["name"]] = db.execute(
+                    "SELECT content FROM item_detail_relations"
+                    " WHERE item_id = ? AND detail_id = ?",
+                    (item["id"], detail["id"])
+                ).fetchone()["content"]
+    return json.dumps(context)
+
+
+def set_based_context_json(context_id):
+    return json.dumps(get_context_payload(context_id))
+
+
+SIZES = [
+    # (lists, items per list, details per list)
+    (2, 10, 3),
+    (5, 50, 4),
+    (10, 100, 5),
+]
+
+
+def main():
+    print(f"{'lists':>5} {'items':>6} {'details':>7} | {'legacy q':>9} {'legacy ms':>10} | {'set q':>6} {'set ms':>8} | {'speedup':>7}")
+    for lists, items, details in SIZES:
+        with bench_app() as app, app.app_context():
+            db = get_db()
+            context_id = populate_context(db, lists, items, details)
+            with count_queries(db) as legacy_queries:
+                legacy_json = legacy_context_json(context_id)
+            with count_queries(db) as set_queries:
+                set_json = set_based_context_json(context_id)
+            assert json.loads(legacy_json) == json.loads(set_json)
+            legacy_time, _ = timed(legacy_context_json, context_id, repeat=1)
+            set_time, _ = timed(set_based_context_json, context_id)
+            print(
+                f"{lists:>5} {lists * items:>6} {details:>7} |"
+                f" {len(legacy_queries):>9} {legacy_time * 1000:>10.1f} |"
+                f" {len(set_queries):>6} {set_time * 1000:>8.1f} |"
+                f" {legacy_time / set_time:>6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+'''Peak memory of writing out the context, from materialized dicts versus streamed from the cursor, measured with tracemalloc.
+
+The finished text has to be held either way, as the provider SDKs take the prompt as a string. The columns to compare are the peak beyond the text itself ("overhead") and the peak when the chunks are only written to a sink, which is what a streamed request body or file export costs.
+
+Run with `python benchmarks/bench_context_memory.py`.
+'''
+import json
+import tracemalloc
+
+from _support import bench_app, populate_context
+
+from incontext.db import get_db
+from incontext.conversations import get_context_payload, iter_context_payload
+from incontext.formats import encode, serialize
+
+
+SIZES = [
+    # (lists, items per list, details per list)
+    (5, 1000, 5),
+    (10, 5000, 5),
+    (10, 10000, 5),
+]
+
+
+def peak(fn, *args):
+    '''Returns (peak traced bytes while running `fn`, its result).'''
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = fn(*args)
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def materialized(context_id):
+    return json.dumps(get_context_payload(context_id))
+
+
+def streamed(context_id):
+    return serialize(iter_context_payload(context_id))
+
+
+def streamed_to_sink(context_id):
+    size = 0
+    for chunk in encode(iter_context_payload(context_id)):
+        size += len(chunk) # stands in for writing to a socket or file
+    return size
+
+
+def mb(n):
+    return n / 1024 / 1024
+
+
+def main():
+    print(f"{'items':>7} {'text MB':>8} | {'dicts MB':>9} {'overhead':>9} | {'stream MB':>10} {'overhead':>9} | {'sink MB':>8}")
+    for lists, items, details in SIZES:
+        with bench_app() as app, app.app_context():
+            db = get_db()
+            context_id = populate_context(db, lists, items, details)
+            materialized_peak, text = peak(materialized, context_id)
+            streamed_peak, streamed_text = peak(streamed, context_id)
+            sink_peak, size = peak(streamed_to_sink, context_id)
+            assert text == streamed_text and size == len(text)
+            print(
+                f"{lists * items:>7} {mb(len(text)):>8.1f} |"
+                f" {mb(materialized_peak):>9.1f} {mb(materialized_peak - len(text)):>9.1f} |"
+                f" {mb(streamed_peak):>10.1f} {mb(streamed_peak - len(text)):>9.1f} |"
+                f" {mb(sink_peak):>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
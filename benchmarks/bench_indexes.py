@@ -0,0 +1,111 @@
+'''Query plans and wall time of the hot lookups before and after the index migration.
+
+Run with `python benchmarks/bench_indexes.py`.
+'''
+from _support import bench_app, populate_context, timed
+
+from incontext.db import get_db, migrate
+
+
+LISTS, ITEMS, DETAILS = 20, 500, 5
+CONVERSATIONS, MESSAGES = 200, 100
+
+QUERIES = {
+    'get_messages': (
+        'SELECT m.id, m.content, m.human, m.created FROM messages m'
+        ' WHERE m.conversation_id = ? ORDER BY m.id',
+        lambda ids: (ids['conversation'],),
+    ),
+    'get_list_items': (
+        'SELECT i.id, i.name, i.created FROM items i'
+        ' JOIN list_item_relations r ON r.item_id = i.id'
+        ' WHERE r.list_id = ? ORDER BY r.item_id',
+        lambda ids: (ids['list'],),
+    ),
+    'item detail value': (
+        'SELECT content FROM item_detail_relations WHERE item_id = ? AND detail_id = ?',
+        lambda ids: (ids['item'], ids['detail']),
+    ),
+    'context payload values': (
+        'SELECT idr.item_id, idr.detail_id, idr.content FROM item_detail_relations idr'
+        ' JOIN list_item_relations lir ON lir.item_id = idr.item_id'
+        ' WHERE lir.list_id IN (SELECT list_id FROM context_list_relations WHERE context_id = ?)',
+        lambda ids: (ids['context'],),
+    ),
+    'context conversations': (
+        'SELECT c.id, c.name FROM conversations c'
+        ' JOIN context_conversation_relations ccr ON ccr.conversation_id = c.id'
+        ' JOIN conversation_agent_relations car ON car.conversation_id = c.id'
+        ' WHERE ccr.context_id = ?',
+        lambda ids: (ids['context'],),
+    ),
+}
+
+
+def populate_conversations(db, context_id):
+    cur = db.cursor()
+    cur.execute(
+        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
+        " VALUES ('Bench', 'bench', 'Bench', 'bench', 'synthetic')"
+    )
+    cur.execute(
+        "INSERT INTO agents (creator_id, name, description, model_id, role, instructions)"
+        " VALUES (1, 'bench agent', '', ?, 'role', 'instructions')",
+        (cur.lastrowid,)
+    )
+    agent_id = cur.lastrowid
+    for c in range(CONVERSATIONS):
+        cur.execute("INSERT INTO conversations (name) VALUES (?)", (f"conversation {c}",))
+        conversation_id = cur.lastrowid
+        cur.execute(
+            "INSERT INTO context_conversation_relations (context_id, conversation_id) VALUES (?, ?)",
+            (context_id if c == 0 else 0, conversation_id)
+        )
+        cur.execute(
+            "INSERT INTO conversation_agent_relations (conversation_id, agent_id) VALUES (?, ?)",
+            (conversation_id, agent_id)
+        )
+    # Interleave conversations the way live traffic would
+    cur.executemany(
+        "INSERT INTO messages (conversation_id, content, human) VALUES (?, ?, ?)",
+        [(m % CONVERSATIONS + 1, f"message {m}", m % 2) for m in range(CONVERSATIONS * MESSAGES)]
+    )
+    db.commit()
+
+
+def measure(db, ids):
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        plan = '; '.join(row['detail'] for row in db.execute(f'EXPLAIN QUERY PLAN {sql}', params(ids)))
+        elapsed, _ = timed(lambda: db.execute(sql, params(ids)).fetchall(), repeat=5)
+        results[name] = (elapsed, plan)
+    return results
+
+
+def main():
+    with bench_app(migrated=False) as app, app.app_context():
+        db = get_db()
+        context_id = populate_context(db, LISTS, ITEMS, DETAILS)
+        populate_conversations(db, context_id)
+        ids = dict(
+            context=context_id,
+            conversation=CONVERSATIONS // 2,
+            list=LISTS // 2,
+            item=LISTS * ITEMS // 2,
+            detail=LISTS * DETAILS // 2,
+        )
+        before = measure(db, ids)
+        migrate()
+        db.execute('ANALYZE')
+        after = measure(db, ids)
+    print(f"{LISTS * ITEMS} items, {LISTS * ITEMS * DETAILS} detail values, {CONVERSATIONS * MESSAGES} messages\n")
+    for name in QUERIES:
+        before_time, before_plan = before[name]
+        after_time, after_plan = after[name]
+        print(f"{name}: {before_time * 1000:.2f} ms -> {after_time * 1000:.2f} ms ({before_time / after_time:.1f}x)")
+        print(f"  before: {before_plan}")
+        print(f"  after:  {after_plan}")
+
+
+if __name__ == "__main__":
+    main()
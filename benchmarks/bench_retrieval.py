@@ -0,0 +1,75 @@
+'''Index build time, query latency and prompt size of the retrieval mode against sending the whole context.
+
+Run with `python benchmarks/bench_retrieval.py`.
+'''
+import json
+import random
+
+from _support import bench_app, populate_context, timed
+
+from incontext.db import get_db
+from incontext.conversations import get_context_payload
+from incontext.prompts import get_tokenizer
+from incontext.retrieval import LexicalIndex
+
+
+SIZES = [
+    # (lists, items per list, details per list)
+    (2, 100, 3),
+    (5, 1000, 4),
+    (10, 2000, 5),
+]
+
+WORDS = [f"word{n}" for n in range(5000)]
+QUERIES = 50
+CHANGED = 0.01 # the share of items edited before the incremental refresh
+TOP_K, BUDGET = 20, 4000
+
+
+def add_words(db, rng):
+    '''Replaces the synthetic detail values with a few words each, so the items differ in what they match.'''
+    rows = db.execute("SELECT id FROM item_detail_relations").fetchall()
+    db.executemany(
+        "UPDATE item_detail_relations SET content = ? WHERE id = ?",
+        [(" ".join(rng.choices(WORDS, k=8)), row["id"]) for row in rows]
+    )
+    db.commit()
+
+
+def build_index(payload):
+    index = LexicalIndex()
+    index.refresh(1, payload)
+    return index
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'items':>6} | {'build ms':>9} {'refresh ms':>11} | {'query ms':>9} | {'full tok':>9} {'sent tok':>9} {'saved':>6}")
+    for lists, items, details in SIZES:
+        with bench_app() as app, app.app_context():
+            db = get_db()
+            tokenizer = get_tokenizer()
+            context_id = populate_context(db, lists, items, details)
+            add_words(db, rng)
+            payload = get_context_payload(context_id)
+            build_time, index = timed(build_index, payload)
+            ids = db.execute("SELECT id FROM item_detail_relations").fetchall()
+            for row in rng.sample(ids, max(1, int(len(ids) * CHANGED))):
+                db.execute("UPDATE item_detail_relations SET content = ? WHERE id = ?", (" ".join(rng.choices(WORDS, k=8)), row["id"]))
+            db.commit()
+            changed = get_context_payload(context_id)
+            refresh_time, _ = timed(index.refresh, 2, changed, repeat=1)
+            queries = [" ".join(rng.choices(WORDS, k=4)) for _ in range(QUERIES)]
+            query_time, selections = timed(lambda: [index.select(query, TOP_K, BUDGET, tokenizer) for query in queries])
+            full_tokens = tokenizer.count(json.dumps(changed))
+            sent_tokens = sum(tokenizer.count(json.dumps(selected)) for selected in selections) / len(selections)
+            print(
+                f"{lists * items:>6} |"
+                f" {build_time * 1000:>9.1f} {refresh_time * 1000:>11.1f} |"
+                f" {query_time * 1000 / QUERIES:>9.2f} |"
+                f" {full_tokens:>9} {sent_tokens:>9.0f} {1 - sent_tokens / full_tokens:>6.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,70 @@ def create_app(test_config=None):
     app.config.from_mapping( # sets some default configuration.
         SECRET_KEY='dev', # used by Flask and extensions to keep data safe. should be overridden with a random valye when deploying.
         DATABASE=os.path.join(app.instance_path, 'incontext.sqlite'), # the path where the sqlite database will be saved. `app.instance_path` is the path that Flask has chosen for the instance folder.
+        DB_PERSISTENT_CONNECTIONS=True, # keep one connection per worker thread open between requests instead of reconnecting every time.
+        DB_PRAGMAS={ # applied once to every new connection, in this order.
+            'busy_timeout': 5000, # wait up to 5 s for another worker's write lock instead of failing.
+            'journal_mode': 'WAL', # readers don't block the writer and vice versa.
+            'synchronous': 'NORMAL', # safe with WAL; skips an fsync per transaction.
+            'cache_size': -16000, # 16 MB page cache per connection.
+            'mmap_size': 134217728, # read up to 128 MB of the file through memory mapping.
+            'foreign_keys': 'OFF', # some delete paths still leave relation rows behind, so enforcement stays opt-in.
+        },
+        PROVIDER_TIMEOUT=60.0, # seconds before an LLM provider call is abandoned.
+        PROVIDER_TIMEOUTS={}, # per-provider overrides of PROVIDER_TIMEOUT, e.g. {'google': 90.0}.
+        RETRY_MAX_ATTEMPTS=3, # tries per provider call, counting the first. Only timeouts, connection errors, 429 and 5xx are retried.
+        RETRY_BASE_DELAY=0.5, # seconds; the backoff before retry n is random up to RETRY_BASE_DELAY * 2**n.
+        RETRY_MAX_DELAY=8.0, # the longest backoff, unless the provider's retry-after asks for more.
+        RETRY_AFTER_MAX=30.0, # give up rather than honor a longer retry-after.
+        HEDGE_PERCENTILE=None, # e.g. 0.95: send a second copy of a request that is slower than 95% of recent ones. None turns hedging off.
+        HEDGE_MIN_SAMPLES=20, # successful calls a provider needs before requests to it are hedged.
+        HEDGE_WORKERS=8, # threads per worker process that run the second copies of hedged requests. No request is hedged while all are busy.
+        BREAKER_FAILURES=5, # consecutive transient failures that open a provider's circuit breaker.
+        BREAKER_RESET_SECONDS=30.0, # how long an open breaker fails fast before letting a trial call through.
+        PROVIDER_LIMITS={}, # quotas shared by all worker processes, per provider or 'provider/model', e.g. {'openai': {'concurrency': 8}, 'openai/gpt-4o': {'rate': 2.0, 'burst': 10}}. `rate` is calls per second, `burst` the most saved up.
+        LIMIT_WAIT_MAX=30.0, # seconds a call waits for a slot before giving up, after which fallback models are tried.
+        LIMIT_POLL_INTERVAL=0.05, # seconds between checks of a waiting call.
+        LIMIT_SLOT_TTL=600.0, # a slot still held after this long is assumed lost with its worker and freed.
+        LIMIT_WAITER_STALE=5.0, # a waiter not seen for this long is assumed gone and dropped from the queue.
+        PROVIDER_MAX_CONNECTIONS=20, # the connection pool size of each provider client.
+        PROVIDER_MAX_KEEPALIVE_CONNECTIONS=10, # idle connections each provider client keeps open for reuse.
+        PROVIDER_BASE_URLS={}, # per-provider API base URL overrides, e.g. {'openai': 'http://localhost:8080/v1'} for a local stand-in.
+        PROMPT_BUDGET=32000, # prompt tokens for models without their own `agent_models.context_budget`.
+        PROMPT_RESPONSE_RESERVE=1024, # tokens of the budget kept free for the reply.
+        PROMPT_TOKENIZER='approximate', # 'approximate' (about 4 characters per token) or 'tiktoken' if installed.
+        PROMPT_HISTORY_POLICY='sliding', # how older turns are trimmed to fit: 'sliding', 'head_tail' or 'summary'.
+        PROMPT_HEAD_MESSAGES=2, # the opening turns 'head_tail' keeps.
+        PROMPT_SUMMARY_TOKENS=500, # the most tokens the 'summary' policy spends on dropped turns.
+        SUMMARY_THRESHOLD=8000, # tokens of unsummarized messages after which older ones are folded into the conversation summary. 0 turns summaries off.
+        SUMMARY_RECENT_TOKENS=2000, # tokens of the latest messages that are always sent in full.
+        SUMMARY_RETRY_SECONDS=300, # seconds a conversation is sent in full after summarizing it failed, before trying again.
+        GEMINI_CACHE_MIN_TOKENS=4096, # contexts smaller than this aren't worth a Gemini cached content (and may be below the API minimum).
+        GEMINI_CACHE_TTL=3600, # seconds a Gemini cached content of a context version lives.
+        GEMINI_CACHE_RETRY_SECONDS=60, # seconds before caching a context is tried again after a transient failure. Other failures wait out GEMINI_CACHE_TTL.
+        AGENT_MAX_FALLBACKS=3, # fallback models an agent can list, tried in order when its own model fails.
+        OPENAI_STATEFUL_RESPONSES=False, # continue OpenAI's stored response with `previous_response_id` and send only the new turns.
+        LEASE_SECONDS=300, # how long a request may answer a conversation before a repeated request takes over.
+        LEASE_POLL_INTERVAL=0.1, # seconds between checks of a repeated request waiting for the first one's reply.
+        IDEMPOTENCY_KEY_SECONDS=86400, # how long a sent message's Idempotency-Key is remembered.
+        TOOL_MAX_STEPS=5, # provider calls an agent in the "tools" context mode may make per reply. The last one has to answer.
+        TOOL_PAGE_SIZE=50, # the most items a tool call returns.
+        JOB_WORKERS=4, # background threads per worker process that wait on LLM providers.
+        JOB_PROGRESS_INTERVAL=0.25, # seconds between saves of a running job's partial reply.
+        JOB_DEFER_SECONDS=0.5, # seconds before a job whose conversation state another request is answering checks again.
+        JOB_HEARTBEAT_INTERVAL=10.0, # seconds between touches of the heartbeat of the jobs a worker process is running.
+        JOB_STALE_SECONDS=300, # a running job without a heartbeat for this long is assumed lost with its worker and requeued.
+        JOB_PENDING_GRACE=60, # a pending job nobody has queued or touched for this long is assumed lost too.
+        CONTEXT_CACHE_SIZE=128, # the number of serialized context payloads each worker keeps in memory.
+        CONTEXT_RETRIEVAL=False, # send only the items that match the latest user message instead of the whole context. Needs numpy.
+        RETRIEVAL_TOP_K=20, # the most items of each list sent with `CONTEXT_RETRIEVAL`.
+        RETRIEVAL_BUDGET=4000, # the most tokens of the context sent with `CONTEXT_RETRIEVAL`.
+        RETRIEVAL_INDEX_SIZE=32, # the number of context search indexes each worker keeps in memory.
+        LIST_PAGE_SIZE=100, # the number of items shown per page of a list.
+        LIST_PAGE_SIZE_MAX=500, # the largest page a client can request with `limit`.
+        CONTEXT_VIEW_MESSAGES=20, # the number of latest messages rendered per conversation on the context view. Older ones are loaded on demand.
+        MESSAGE_PAGE_SIZE_MAX=200, # the largest page of messages a client can request with `limit`.
+        SEARCH_PAGE_SIZE=20, # the number of search results shown.
+        SEARCH_PAGE_SIZE_MAX=100, # the most search results a client can request with `limit`.
     )
 
     if test_config is None:
@@ -31,6 +95,24 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import cache
+    cache.init_app(app)
+
+    from . import retrieval
+    retrieval.init_app(app)
+
+    from . import formats
+    formats.init_app(app)
+
+    from . import resilience
+    resilience.init_app(app)
+
+    from . import providers
+    providers.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -50,4 +132,11 @@ def create_app(test_config=None):
     from .import conversations
     app.register_blueprint(conversations.bp)
 
+    from . import search
+    app.register_blueprint(search.bp)
+    search.init_app(app)
+
+    from . import jobs
+    jobs.init_app(app)
+
     return app
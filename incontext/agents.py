@@ -1,14 +1,17 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, redirect, render_template, request, url_for, current_app
 )
 from werkzeug.exceptions import abort
 
 from incontext.auth import login_required
 from incontext.db import get_db, dict_factory
+from incontext.formats import FORMATS
 
 
 bp = Blueprint("agents", __name__, url_prefix="/agents")
 
+CONTEXT_MODES = ("inline", "tools")
+
 
 @bp.route("/")
 @login_required
@@ -34,20 +37,24 @@ def new():
         model = next((agent_model for agent_model in agent_models if agent_model["id"] == model_id), None)
         role = request.form['role']
         instructions = request.form['instructions']
+        context_mode = get_context_mode()
+        context_format = get_context_format()
         if not name or not model or not role or not instructions:
             error = 'Name, model, role, and instructions are all required.'
         if error is not None:
             flash(error)
         else:
             db = get_db()
-            db.execute(
-                'INSERT INTO agents (name, description, model_id, role, instructions, creator_id)'
-                ' VALUES (?, ?, ?, ?, ?, ?)',
-                (name, description, model_id, role, instructions, g.user['id'])
+            cur = db.execute(
+                'INSERT INTO agents (name, description, model_id, role, instructions, context_mode, context_format, creator_id)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, description, model_id, role, instructions, context_mode, context_format, g.user['id'])
             )
+            set_agent_fallbacks(cur.lastrowid, get_fallback_ids(agent_models, model_id))
             db.commit()
             return redirect(url_for('agents.index'))
-    return render_template('agents/new.html', agent_models=agent_models)
+    fallback_ids = get_fallback_ids(agent_models) if request.method == 'POST' else []
+    return render_template('agents/new.html', agent_models=agent_models, fallback_ids=pad_fallback_ids(fallback_ids), context_mode=get_context_mode(), context_format=get_context_format())
 
 
 @bp.route('/<int:agent_id>/view')
@@ -56,7 +63,8 @@ def view(agent_id):
     agent = get_agent(agent_id)
     conversations = get_agent_conversations(agent_id)
     contexts = get_agent_contexts(agent_id)
-    return render_template('agents/view.html', agent=agent, conversations=conversations, contexts=contexts)
+    fallbacks = get_agent_fallbacks(agent_id)
+    return render_template('agents/view.html', agent=agent, conversations=conversations, contexts=contexts, fallbacks=fallbacks)
 
 
 @bp.route('/<int:agent_id>/edit', methods=('GET', 'POST'))
@@ -77,6 +85,8 @@ def edit(agent_id):
         model = next((agent_model for agent_model in agent_models if agent_model["id"] == model_id), None)
         role = request.form["role"]
         instructions = request.form["instructions"]
+        context_mode = get_context_mode()
+        context_format = get_context_format()
         if not name or not model or not role or not instructions:
             error = "Name, model, role, and instructions are all required."
         if error is not None:
@@ -85,13 +95,22 @@ def edit(agent_id):
             db = get_db()
             db.execute(
                 "UPDATE agents"
-                " SET name = ?, description = ?, model_id = ?, role = ?, instructions = ?"
+                " SET name = ?, description = ?, model_id = ?, role = ?, instructions = ?, context_mode = ?, context_format = ?"
                 " WHERE id = ?",
-                (name, description, model_id, role, instructions, agent_id)
+                (name, description, model_id, role, instructions, context_mode, context_format, agent_id)
             )
+            set_agent_fallbacks(agent_id, get_fallback_ids(agent_models, model_id))
             db.commit()
             return redirect(url_for('agents.view', agent_id=agent_id))
-    return render_template("agents/edit.html", agent=agent, agent_models=agent_models)
+    if request.method == "POST":
+        fallback_ids = get_fallback_ids(agent_models)
+    else:
+        fallback_ids = [fallback["model_id"] for fallback in get_agent_fallbacks(agent_id)]
+    if request.method == "POST":
+        context_mode, context_format = get_context_mode(), get_context_format()
+    else:
+        context_mode, context_format = agent["context_mode"], agent["context_format"]
+    return render_template("agents/edit.html", agent=agent, agent_models=agent_models, fallback_ids=pad_fallback_ids(fallback_ids), context_mode=context_mode, context_format=context_format)
 
 
 @bp.route("<int:agent_id>/delete", methods=("POST",))
@@ -100,6 +119,7 @@ def delete(agent_id):
     agent = get_agent(agent_id)
     db = get_db()
     db.execute("DELETE FROM agents WHERE id = ?", (agent_id,))
+    db.execute("DELETE FROM agent_fallbacks WHERE agent_id = ?", (agent_id,))
     db.commit()
     return redirect(url_for('agents.index'))
 
@@ -107,7 +127,7 @@ def delete(agent_id):
 def get_agents():
     db = get_db()
     agents = db.execute(
-        'SELECT a.id, a.creator_id, a.created, a.name, a.description, a.model_id, a.role, a.instructions, u.username'
+        'SELECT a.id, a.creator_id, a.created, a.name, a.description, a.model_id, a.role, a.instructions, a.context_mode, a.context_format, u.username'
         ' FROM agents a JOIN users u ON a.creator_id = u.id'
         " WHERE creator_id = ?",
         (g.user["id"],)
@@ -118,7 +138,7 @@ def get_agents():
 def get_agent(agent_id, check_access=True):
     db = get_db()
     agent = db.execute(
-        'SELECT a.id, a.creator_id, a.created, a.name, a.description, a.model_id, a.role, a.instructions, m.model_name, m.provider_name, m.provider_code, m.model_code, u.username'
+        'SELECT a.id, a.creator_id, a.created, a.name, a.description, a.model_id, a.role, a.instructions, a.context_mode, a.context_format, m.model_name, m.provider_name, m.provider_code, m.model_code, m.context_budget, u.username'
         ' FROM agents a'
         ' JOIN agent_models m ON m.id = a.model_id'
         ' JOIN users u ON u.id = a.creator_id'
@@ -187,3 +207,56 @@ def get_agent_conversations(agent_id, check_access=True):
         (agent_id,)
     ).fetchall()
     return conversations
+
+
+def get_agent_fallbacks(agent_id):
+    '''Returns the models the agent falls back to, in order.'''
+    fallbacks = get_db().execute(
+        "SELECT f.model_id, m.model_name, m.provider_code, m.model_code, m.context_budget"
+        " FROM agent_fallbacks f"
+        " JOIN agent_models m ON m.id = f.model_id"
+        " WHERE f.agent_id = ?"
+        " ORDER BY f.position",
+        (agent_id,)
+    ).fetchall()
+    return fallbacks
+
+
+def set_agent_fallbacks(agent_id, model_ids):
+    '''Replaces the agent's fallback chain. Runs in the caller's transaction.'''
+    db = get_db()
+    db.execute("DELETE FROM agent_fallbacks WHERE agent_id = ?", (agent_id,))
+    db.executemany(
+        "INSERT INTO agent_fallbacks (agent_id, model_id, position) VALUES (?, ?, ?)",
+        [(agent_id, model_id, position) for position, model_id in enumerate(model_ids)]
+    )
+
+
+def get_fallback_ids(agent_models, model_id=None):
+    '''Reads the fallback models from the form in order, skipping blanks, unknown models, repeats and the agent's own model.'''
+    known = {agent_model["id"] for agent_model in agent_models}
+    fallback_ids = []
+    for value in request.form.getlist("fallback_model_id"):
+        try:
+            fallback_id = int(value)
+        except ValueError:
+            continue
+        if fallback_id in known and fallback_id != model_id and fallback_id not in fallback_ids:
+            fallback_ids.append(fallback_id)
+    return fallback_ids[:current_app.config["AGENT_MAX_FALLBACKS"]]
+
+
+def pad_fallback_ids(fallback_ids):
+    return fallback_ids + [None] * (current_app.config["AGENT_MAX_FALLBACKS"] - len(fallback_ids))
+
+
+def get_context_mode():
+    '''Reads the context mode from the form. Anything unknown means the default, "inline".'''
+    context_mode = request.form.get("context_mode", "inline")
+    return context_mode if context_mode in CONTEXT_MODES else "inline"
+
+
+def get_context_format():
+    '''Reads the context format from the form. Anything unknown means the default, "json".'''
+    context_format = request.form.get("context_format", "json")
+    return context_format if context_format in FORMATS else "json"
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from incontext.db import get_db
+
+
+class LRUCache:
+    '''A bounded, thread-safe mapping that evicts the least recently used entry.'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_context_cache():
+    return current_app.extensions['context_cache']
+
+
+def get_context_version(context_id):
+    '''The version counter lives in SQLite so that every worker sees the same value.'''
+    row = get_db().execute(
+        'SELECT version FROM context_versions WHERE context_id = ?',
+        (context_id,)
+    ).fetchone()
+    return row['version'] if row else 0
+
+
+def bump_context_version(context_id):
+    '''Invalidates the cached payload of a context. Runs in the caller's transaction.'''
+    get_db().execute(
+        'INSERT INTO context_versions (context_id, version) VALUES (?, 1)'
+        ' ON CONFLICT (context_id) DO UPDATE SET version = version + 1',
+        (context_id,)
+    )
+
+
+def bump_list_context_versions(list_id):
+    '''Invalidates the cached payload of every context the list belongs to.'''
+    get_db().execute(
+        'INSERT INTO context_versions (context_id, version)'
+        ' SELECT DISTINCT context_id, 1 FROM context_list_relations WHERE list_id = ?'
+        ' ON CONFLICT (context_id) DO UPDATE SET version = version + 1',
+        (list_id,)
+    )
+
+
+def init_app(app):
+    app.extensions['context_cache'] = LRUCache(app.config['CONTEXT_CACHE_SIZE'])
@@ -1,5 +1,7 @@
+import sys
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, redirect, render_template, request, url_for, current_app, Response, stream_with_context
 )
 from werkzeug.exceptions import abort
 
@@ -7,6 +9,8 @@ from incontext.auth import login_required
 from incontext.db import get_db, dict_factory
 from incontext.lists import get_user_lists, get_list
 from incontext.agents import get_agents, get_agent
+from incontext.cache import bump_context_version
+from incontext.formats import FORMATS, encode
 
 
 bp = Blueprint('contexts', __name__, url_prefix='/contexts')
@@ -58,6 +62,32 @@ def view(context_id):
     return render_template("contexts/view.html", context=context, lists=lists, conversations=conversations)
 
 
+@bp.route("/<int:context_id>/export", methods=("GET",))
+@login_required
+def export(context_id):
+    '''Downloads the context the way agents get it, in the `format` asked for. Written out while it is read from the database, so memory stays flat however large the context.'''
+    from incontext.conversations import iter_context_payload # conversations.py imports this module
+    get_context(context_id)
+    context_format = request.args.get("format", "json")
+    if context_format not in FORMATS:
+        abort(400, f"Unknown format {context_format}.")
+    extension, mimetype = EXPORT_TYPES[context_format]
+    return Response(
+        stream_with_context(encode(iter_context_payload(context_id), context_format)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="context-{context_id}.{extension}"'},
+    )
+
+
+EXPORT_TYPES = {
+    "json": ("json", "application/json"),
+    "columnar": ("json", "application/json"),
+    "tsv": ("tsv", "text/tab-separated-values"),
+    "markdown": ("md", "text/markdown"),
+    "compact": ("txt", "text/plain"),
+}
+
+
 @bp.route("/<int:context_id>/edit", methods=("GET", "POST"))
 @login_required
 def edit(context_id):
@@ -106,6 +136,7 @@ def new_list(context_id):
             " VALUES (?, ?)",
             (context_id, list_id)
         )
+        bump_context_version(context_id)
         db.commit()
         return redirect(url_for("contexts.view", context_id=context_id))
     lists = get_unrelated_lists(context_id)
@@ -124,6 +155,7 @@ def remove_list(context_id):
         " WHERE context_id = ? AND list_id = ?",
         (context_id, list_id)
     )
+    bump_context_version(context_id)
     db.commit()
     return redirect(url_for("contexts.view", context_id=context_id))
 
@@ -167,8 +199,12 @@ def get_context_agents(context_id):
     return agents
 
 
-def get_context_conversations(context_id):
-    conversations = get_db().execute(
+def get_context_conversations(context_id, recent=None):
+    '''Returns the conversation headers of a context, each with only its `recent` latest messages and a `has_older` flag.'''
+    if recent is None:
+        recent = current_app.config["CONTEXT_VIEW_MESSAGES"]
+    db = get_db()
+    conversations = db.execute(
         "SELECT c.id, c.name, a.id AS agent_id, a.name AS agent_name"
         " FROM conversations c"
         " JOIN context_conversation_relations ccr ON ccr.conversation_id = c.id"
@@ -177,8 +213,30 @@ def get_context_conversations(context_id):
         " WHERE ccr.context_id = ?",
         (context_id,)
     ).fetchall()
+    conversations_by_id = {}
+    for conversation in conversations:
+        conversation["messages"] = []
+        conversation["has_older"] = False
+        conversations_by_id[conversation["id"]] = conversation
+    # One extra message per conversation tells whether older ones exist
+    messages = db.execute(
+        "SELECT m.id, m.conversation_id, m.content, m.human, m.created"
+        " FROM messages m"
+        " JOIN (SELECT mm.id, ROW_NUMBER() OVER (PARTITION BY mm.conversation_id ORDER BY mm.id DESC) AS position"
+        "  FROM messages mm"
+        "  JOIN context_conversation_relations ccr ON ccr.conversation_id = mm.conversation_id"
+        "  WHERE ccr.context_id = ?) latest ON latest.id = m.id"
+        " WHERE latest.position <= ?"
+        " ORDER BY m.conversation_id, m.id",
+        (context_id, recent + 1)
+    ).fetchall()
+    for message in messages:
+        conversation = conversations_by_id[message.pop("conversation_id")]
+        conversation["messages"].append(message)
     for conversation in conversations:
-        conversation["messages"] = get_messages(conversation["id"])
+        if len(conversation["messages"]) > recent:
+            conversation["messages"] = conversation["messages"][1:]
+            conversation["has_older"] = True
     return conversations
 
 
@@ -203,15 +261,26 @@ def get_unrelated_agents(context_id):
     return agents
 
 
-def get_messages(conversation_id):
+def get_messages(conversation_id, before=None, limit=None, after=None):
+    '''Returns the messages of a conversation in order, or only those newer than the `after` message id. With a `limit`, returns only the latest `limit` messages older than the `before` message id.'''
+    if limit is None:
+        messages = get_db().execute(
+            'SELECT m.id, m.content, m.human, m.created'
+            ' FROM messages m'
+            ' JOIN conversations c'
+            ' ON m.conversation_id = c.id'
+            ' WHERE c.id = ? AND m.id > ?'
+            ' ORDER BY m.id',
+            (conversation_id, after or 0)
+        ).fetchall()
+        return messages
     messages = get_db().execute(
         'SELECT m.id, m.content, m.human, m.created'
         ' FROM messages m'
-        ' JOIN conversations c'
-        ' ON m.conversation_id = c.id'
-        ' WHERE c.id = ?',
-        (conversation_id,)
+        ' WHERE m.conversation_id = ? AND m.id < ?'
+        ' ORDER BY m.id DESC'
+        ' LIMIT ?',
+        (conversation_id, before or sys.maxsize, limit)
     ).fetchall()
+    messages.reverse()
     return messages
-
-
@@ -1,20 +1,28 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, redirect, render_template, request, url_for, Response, stream_with_context, current_app
 )
 from werkzeug.exceptions import abort
 
 from incontext.auth import login_required
-from incontext.db import get_db
+from incontext.db import get_db, release_db
 from incontext.contexts import get_context, get_messages
 from incontext.agents import get_agents
 from incontext.agents import get_agent
-from incontext.lists import get_list_with_items_and_details, get_list_details, get_list_items
-from openai import OpenAI
-import anthropic
-from google import genai
-from google.genai import types
-import os
+from incontext.agents import get_agent_fallbacks
+from incontext.leases import get_last_message_id, join_lease, finish_lease, fail_lease
+from incontext.cache import get_context_cache, get_context_version
+from incontext.metrics import incr
+from incontext.lists import get_page_size
+from incontext.providers import get_provider_response, stream_provider_response, convert_history, format_history, format_tool_results, pin_model
+from incontext.prompts import assemble_prompt, get_budget
+from incontext.retrieval import is_enabled as retrieval_enabled, select_context
+from incontext.summaries import get_summary, get_summary_message, compact_conversation
+from incontext.tools import TOOLS, get_catalogue, run_tool
+from incontext.formats import serialize
+import hashlib
 import json
+import sqlite3
+import time
 
 
 bp = Blueprint('conversations', __name__, url_prefix='/conversations')
@@ -115,10 +123,31 @@ def delete(conversation_id):
     db.execute("DELETE FROM context_conversation_relations WHERE conversation_id = ?", (conversation_id,))
     db.execute("DELETE FROM conversation_agent_relations WHERE conversation_id = ?", (conversation_id,))
     db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+    db.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,))
+    db.execute("DELETE FROM response_leases WHERE conversation_id = ?", (conversation_id,))
+    db.execute("DELETE FROM idempotency_keys WHERE conversation_id = ?", (conversation_id,))
     db.commit()
     return redirect(url_for("home.index"))
 
 
+@bp.route("/<int:conversation_id>/messages")
+@login_required
+def messages(conversation_id):
+    get_conversation(conversation_id) # To check access
+    limit = get_page_size("CONTEXT_VIEW_MESSAGES", "MESSAGE_PAGE_SIZE_MAX")
+    page = get_messages(conversation_id, request.args.get("before", type=int), limit + 1)
+    has_older = len(page) > limit
+    if has_older:
+        page = page[1:]
+    return dict(
+        messages=[
+            dict(id=m["id"], content=m["content"], human=m["human"], created=m["created"].isoformat())
+            for m in page
+        ],
+        next_before=page[0]["id"] if has_older else None,
+    )
+
+
 def get_related_agent(conversation_id):
     agent = get_db().execute(
         'SELECT a.name, a.model, a.role, a.instructions'
@@ -147,75 +176,11 @@ def get_conversation(conversation_id, check_creator=True):
     return conversation
 
 
-def get_credential(name):
-    os_env_var = os.environ.get(name)
-    if os_env_var is not None:
-        return os_env_var
-    else:
-        credential_path = os.environ.get('CREDENTIALS_DIRECTORY')
-        with open(f'{credential_path}/{name}') as f:
-            credential = f.read().strip()
-            return credential
-
-
-def get_openai_response(conversation_history, agent):
-    conversation_history = [
-        dict(
-            role='developer',
-            content=f'You are a {agent["role"]}. {agent["instructions"]}',
-        )
-    ] + conversation_history
-    openai_api_key = get_credential('OPENAI_API_KEY')
-    client = OpenAI(api_key=openai_api_key)
-    try:
-        response = client.responses.create(
-            model=agent['model_code'],
-            input=conversation_history
-        )
-        return dict(success=True, content=response.output_text)
-    except Exception as e:
-        return dict(success=False, content=e)    
+def get_agent_request(cid, check_access=True):
+    '''Reads everything the provider call needs from the database: the agent and the conversation history with the context prepended. Background jobs pass `check_access=False` as they run without a logged in user.
 
-
-def get_anthropic_response(conversation_history, agent):
-    conversation_history = [
-        dict(
-            role='user',
-            content=agent['instructions']
-        )
-    ] + conversation_history
-    anthropic_api_key = get_credential('ANTHROPIC_API_KEY')
-    client = anthropic.Anthropic(api_key=anthropic_api_key)
-    try:
-        response = client.messages.create(
-            model=agent['model_code'],
-            max_tokens=1024,
-            system=f'You are a {agent["role"]}.',
-            messages=conversation_history
-        )
-        return dict(success=True, content=response.content[0].text)
-    except Exception as e:
-        return dict(success=False, content=e)
-
-
-def get_google_response(conversation_history, agent):
-    google_api_key = get_credential('GEMINI_API_KEY')
-    client = genai.Client(api_key=google_api_key)
-    chat = client.chats.create(
-        model=agent['model_code'],
-        config=types.GenerateContentConfig(
-            system_instruction=f'You are a {agent["role"]}. {agent["instructions"]}'
-        ),
-        history=conversation_history[:-1]
-    )
-    try:
-        response = chat.send_message(conversation_history[-1]['parts'][0]['text'])
-        return dict(success=True, content=response.text)
-    except Exception as e:
-        return dict(success=False, content=e)
-
-
-def get_agent_response(cid):
+    With `CONTEXT_RETRIEVAL` the context only carries the items relevant to the latest user message. In the "tools" context mode it is only a catalogue of the lists, and the agent carries the `tools` to read them (see tools.py). Older messages are sent as a summary once the conversation grows past `SUMMARY_THRESHOLD` tokens. The agent carries its fallback models, and with `OPENAI_STATEFUL_RESPONSES` also the stored response to continue from, if the chain is intact. The history is trimmed to the budget of the agent's own model.
+    '''
     agent_id = get_db().execute(
         "SELECT r.agent_id"
         " FROM conversation_agent_relations r"
@@ -223,32 +188,125 @@ def get_agent_response(cid):
         " WHERE r.conversation_id = ?",
         (cid,)
     ).fetchone()['agent_id']
-    agent = get_agent(agent_id)
-    provider = agent['provider_code']
-    agent_conversation_role = "model" if provider == "google" else "assistant"
-    conversation_history = []
-    messages = get_messages(cid)
-    context_json = get_context_json(cid)
-    context_message = [{
-        "human": 1,
-        "content": f"Contextual info: {context_json}"
-    }]
-    messages = context_message + messages
-    for message in messages:
-        human = message['human']
-        role = 'user' if human == 1 else agent_conversation_role
-        content = message['content']
-        if provider == 'google':
-            parts = [{'text': content}]
-            conversation_history.append(dict(role=role, parts=parts))
-        else:
-            conversation_history.append(dict(role=role, content=content))
-    if provider == 'openai':
-        return get_openai_response(conversation_history, agent)
-    elif provider == 'anthropic':
-        return get_anthropic_response(conversation_history, agent)
+    agent = get_agent(agent_id, check_access)
+    summary = get_summary(cid)
+    messages = get_messages(cid, after=summary['last_message_id'] if summary else None)
+    summary, messages = compact_conversation(agent, cid, summary, messages)
+    if summary is not None:
+        messages = [get_summary_message(summary)] + messages
+    context_key = get_context_key(cid)
+    if agent["context_mode"] == "tools":
+        context_content = f"Contextual info: these lists, to be read with the tools: {get_catalogue(context_key[0])}"
+        context_label = "{}-{}-tools".format(*context_key)
     else:
-        return get_google_response(conversation_history, agent)
+        context_format = agent["context_format"]
+        if retrieval_enabled():
+            context_text, context_label = get_relevant_context_json(context_key, messages, context_format)
+        else:
+            context_text, context_label = get_context_json(cid, context_key, context_format), "{}-{}".format(*context_key)
+        if context_format != "json":
+            context_label += f"-{context_format}"
+        context_content = f"Contextual info: {context_text}"
+    context_message = {
+        "human": 1,
+        "content": context_content
+    }
+    messages = assemble_prompt(agent, cid, context_message, messages)
+    agent = dict(agent, context=context_message["content"], context_key=context_label) # providers place the context where their prompt cache can reuse it
+    agent["fallbacks"] = get_agent_fallbacks(agent_id)
+    agent["chain_key"] = get_chain_key(agent)
+    if agent["context_mode"] == "tools":
+        agent["tools"] = TOOLS
+        agent["context_id"] = context_key[0]
+    elif current_app.config["OPENAI_STATEFUL_RESPONSES"] and agent["provider_code"] == "openai":
+        add_response_chain(agent, cid, messages)
+    return agent, format_history(agent, messages)
+
+
+def get_chain_key(agent):
+    '''Fingerprints what a stored response was made with. A reply made with another agent, model, instructions or context version can't be continued.'''
+    parts = [agent["id"], agent["model_code"], agent["role"], agent["instructions"], agent["context_key"]]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:16]
+
+
+def add_response_chain(agent, conversation_id, messages):
+    '''Points the agent at the stored response of the last agent message, and counts the messages sent since, if that message was made with the same chain key.
+
+    Once the stored chain has grown past the model's prompt budget, it is dropped and the next reply starts a new chain from the assembled prompt, so the budget and the conversation summary apply again.
+    '''
+    last = get_db().execute(
+        "SELECT id, response_id, chain_key, input_tokens, output_tokens FROM messages"
+        " WHERE conversation_id = ? AND human = 0"
+        " ORDER BY id DESC LIMIT 1",
+        (conversation_id,)
+    ).fetchone()
+    if last is None or last["response_id"] is None or last["chain_key"] != agent["chain_key"]:
+        return
+    if (last["input_tokens"] or 0) + (last["output_tokens"] or 0) > get_budget(agent):
+        incr("openai.chain_resets")
+        return
+    new_messages = [message for message in messages if message.get("id", 0) > last["id"]] # the user's turns since, at the end of the history
+    if new_messages:
+        agent["previous_response_id"] = last["response_id"]
+        agent["chained_messages"] = len(new_messages)
+
+
+def get_agent_response(cid):
+    agent, conversation_history = get_agent_request(cid)
+    return get_reply_response(agent, conversation_history)
+
+
+def get_reply_response(agent, conversation_history):
+    '''Like `get_provider_response`, but runs the tool calls of agents that have tools.'''
+    if agent.get("tools"):
+        return get_tool_response(agent, conversation_history)
+    return get_provider_response(agent, conversation_history)
+
+
+def stream_reply_response(agent, conversation_history, report=None):
+    '''Like `stream_provider_response`. Agents with tools aren't streamed: their reply is yielded in one chunk once the tool calls are done, and failures are raised.'''
+    if not agent.get("tools"):
+        yield from stream_provider_response(agent, conversation_history, report)
+        return
+    response = get_tool_response(agent, conversation_history)
+    if not response["success"]:
+        raise RuntimeError(response["content"])
+    if report is not None:
+        report.update(usage=response.get("usage"), response_id=response.get("response_id"), model_id=response.get("model_id"))
+    if response["content"]:
+        yield response["content"]
+
+
+def get_tool_response(agent, conversation_history):
+    '''Calls the provider until it answers without tool calls, running the calls of each step against the context. After `TOOL_MAX_STEPS` - 1 steps the model has to answer. Usage is summed over the steps.
+
+    Whichever model of the chain answers the first step answers the rest, as only it can continue its tool calls.
+    '''
+    max_steps = current_app.config["TOOL_MAX_STEPS"]
+    usage = {}
+    for step in range(max_steps):
+        if step == max_steps - 1:
+            agent = dict(agent, tool_choice="none")
+        response = get_provider_response(agent, conversation_history)
+        if not response["success"]:
+            return response
+        for name, value in (response.get("usage") or {}).items():
+            usage[name] = usage.get(name, 0) + value
+        response["usage"] = usage or None
+        tool_calls = response.get("tool_calls")
+        if not tool_calls:
+            return response
+        incr("tools.steps")
+        if step == 0:
+            pinned = pin_model(agent, response["model_id"])
+            if pinned["provider_code"] != agent["provider_code"]:
+                conversation_history = convert_history(conversation_history, pinned)
+            agent = pinned
+        results = [run_tool(agent["context_id"], call["name"], call["arguments"]) for call in tool_calls]
+        conversation_history = conversation_history + response["tool_turn"] + format_tool_results(agent, tool_calls, results)
+    if response["content"]:
+        return response
+    return dict(success=False, content=f"No reply after {max_steps} steps of tool calls.")
 
     
 @bp.route("/add-message", methods=("POST",))
@@ -278,41 +336,301 @@ def add_message():
 def agent_response():
     conversation_id = request.json["conversation_id"]
     conversation = get_conversation(conversation_id) # To check access
-    agent_response = get_agent_response(conversation_id)
+    last_message_id = get_last_message_id(conversation_id)
+    owner, lease = join_lease(conversation_id, last_message_id) # A repeated request for the same state gets the reply of the first.
+    if lease is not None:
+        if lease['status'] == 'done':
+            return {'content': lease['content']}, 200
+        return {'content': f'An error occurred in get_agent_response: {lease["error"]}'}, 200
+    try:
+        agent, conversation_history = get_agent_request(conversation_id)
+        release_db() # Don't hold a connection or a read snapshot while the provider takes its time.
+        agent_response = get_reply_response(agent, conversation_history)
+    except Exception as e:
+        fail_lease(conversation_id, last_message_id, owner, e)
+        raise
     if agent_response['success']:
-        db = get_db()
-        db.execute(
-            'INSERT INTO messages (conversation_id, content, human)'
-            'VALUES (?, ?, ?)',
-            (conversation_id, agent_response['content'], 0,)
-        )
+        db = get_db() # Checks a connection out again for the short write transaction.
+        message_id = insert_agent_message(conversation_id, agent_response['content'], agent, agent_response.get('usage'), agent_response.get('response_id'), agent_response.get('model_id'))
+        finish_lease(conversation_id, last_message_id, owner, agent_response['content'], message_id)
         db.commit()
         return {'content': agent_response['content']}, 200
     else:
         # print(agent_response['content']) # Log the error
+        fail_lease(conversation_id, last_message_id, owner, agent_response['content'])
         return {'content': f'An error occurred in get_agent_response: {agent_response["content"]}'}, 200
 
 
-def get_context_json(conversation_id):
-    # Get lists with items and details
+@bp.route('/agent-response/stream', methods=('POST',))
+@login_required
+def agent_response_stream():
+    '''Relays the agent's reply as server-sent events while it is generated and stores it once complete. A repeated request for the same conversation state waits for the first and gets its reply in one piece.'''
+    conversation_id = request.json["conversation_id"]
+    conversation = get_conversation(conversation_id) # To check access
+    last_message_id = get_last_message_id(conversation_id) # the state this request answers, however late its body is read
+    release_db() # The stream can take a minute. Only the final write needs a connection.
+    return stream_reply(conversation_id, last_message_id)
+
+
+@bp.route('/send', methods=('POST',))
+@login_required
+def send():
+    '''Stores the user's message and starts the agent's reply in one request: as server-sent events with `"mode": "stream"`, otherwise as a job to poll.
+
+    A client that sends an `Idempotency-Key` header can retry safely. A repeated key doesn't store the message again and gets the same job, or the same reply streamed.
+    '''
+    conversation_id = request.json["conversation_id"]
+    conversation = get_conversation(conversation_id) # To check access
+    content = request.json.get("content")
+    mode = request.json.get("mode", "job")
+    if mode not in ("job", "stream"):
+        return "Mode must be 'job' or 'stream'.", 400
+    key = request.headers.get("Idempotency-Key")
+    sent = get_sent_message(key) if key else None
+    if sent is not None and sent["conversation_id"] != conversation["id"]:
+        return "The idempotency key was used for another conversation.", 422
+    if sent is None:
+        if not content:
+            return "Message can't be empty.", 400
+        sent = insert_sent_message(conversation["id"], content, key, with_job=mode == "job")
+    if mode == "stream":
+        release_db()
+        return stream_reply(conversation["id"], sent["message_id"], message_id=sent["message_id"])
+    from incontext.jobs import get_job_queue, insert_job # jobs imports this module
+    if sent["job_id"] is None: # first sent in stream mode
+        sent["job_id"] = insert_job(conversation["id"], sent["message_id"])
+        db = get_db()
+        db.execute(
+            "UPDATE idempotency_keys SET job_id = ? WHERE user_id = ? AND key = ?",
+            (sent["job_id"], g.user["id"], key)
+        )
+        db.commit()
+        sent["new_job"] = True
+    if sent.get("new_job"):
+        get_job_queue().submit(sent["job_id"])
+    return dict(
+        message_id=sent["message_id"],
+        job_id=sent["job_id"],
+        status_url=url_for("jobs.status", job_id=sent["job_id"]),
+        result_url=url_for("jobs.result", job_id=sent["job_id"]),
+    ), 202
+
+
+def get_sent_message(key):
+    return get_db().execute(
+        "SELECT conversation_id, message_id, job_id FROM idempotency_keys WHERE user_id = ? AND key = ?",
+        (g.user["id"], key)
+    ).fetchone()
+
+
+def insert_sent_message(conversation_id, content, key=None, with_job=True):
+    '''Stores the user's message, its reply job if `with_job`, and the idempotency key in one transaction. If a concurrent retry stored the key first, returns what that one stored instead.'''
+    from incontext.jobs import insert_job
     db = get_db()
-    context_id = db.execute("SELECT context_id FROM context_conversation_relations WHERE conversation_id = ?", (conversation_id,)).fetchone()["context_id"]
-    context = db.execute(
-        "SELECT l.id, l.name, l.description FROM lists l"
+    try:
+        message_id = db.execute(
+            "INSERT INTO messages (conversation_id, content, human) VALUES (?, ?, 1)",
+            (conversation_id, content)
+        ).lastrowid
+        job_id = insert_job(conversation_id, message_id) if with_job else None
+        if key:
+            now = time.time()
+            db.execute("DELETE FROM idempotency_keys WHERE created < ?", (now - current_app.config["IDEMPOTENCY_KEY_SECONDS"],))
+            db.execute(
+                "INSERT INTO idempotency_keys (user_id, key, conversation_id, message_id, job_id, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (g.user["id"], key, conversation_id, message_id, job_id, now)
+            )
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return get_sent_message(key)
+    return dict(conversation_id=conversation_id, message_id=message_id, job_id=job_id, new_job=with_job)
+
+
+def get_reply(conversation_id, message_id):
+    '''The agent message that answered the conversation at `message_id`, if any.'''
+    return get_db().execute(
+        "SELECT id, content FROM messages"
+        " WHERE conversation_id = ? AND id > ? AND human = 0"
+        " ORDER BY id LIMIT 1",
+        (conversation_id, message_id)
+    ).fetchone()
+
+
+def stream_reply(conversation_id, last_message_id, **first):
+    '''Returns the streamed reply to the conversation at `last_message_id`. Sends `first` (if given) as a "message" event before anything else.'''
+
+    def generate():
+        if first:
+            yield sse_event("message", first)
+        reply = get_reply(conversation_id, last_message_id) # already answered, e.g. a retry after the stream finished
+        if reply is not None:
+            yield sse_event("delta", dict(content=reply["content"]))
+            yield sse_event("done", dict(content=reply["content"], message_id=reply["id"]))
+            return
+        owner, lease = join_lease(conversation_id, last_message_id) # taken only once the client reads, so an abandoned request holds no lease
+        if lease is not None:
+            if lease["status"] == "done":
+                yield sse_event("delta", dict(content=lease["content"]))
+                yield sse_event("done", dict(content=lease["content"], message_id=lease["message_id"]))
+            else:
+                yield sse_event("error", dict(content=f"An error occurred in agent_response_stream: {lease['error']}"))
+            return
+        chunks = []
+        report = {}
+        finished = False
+        try:
+            try:
+                agent, conversation_history = get_agent_request(conversation_id)
+                release_db()
+                for chunk in stream_reply_response(agent, conversation_history, report):
+                    chunks.append(chunk)
+                    yield sse_event("delta", dict(content=chunk))
+            except Exception as e:
+                fail_lease(conversation_id, last_message_id, owner, e)
+                finished = True
+                yield sse_event("error", dict(content=f"An error occurred in agent_response_stream: {e}"))
+                return
+            content = "".join(chunks)
+            db = get_db()
+            message_id = insert_agent_message(conversation_id, content, agent, report.get("usage"), report.get("response_id"), report.get("model_id"))
+            finish_lease(conversation_id, last_message_id, owner, content, message_id)
+            db.commit()
+            finished = True
+            yield sse_event("done", dict(content=content, message_id=message_id))
+        finally:
+            if not finished: # the client went away mid-stream
+                fail_lease(conversation_id, last_message_id, owner, "The stream was interrupted.")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # keep proxies from buffering the stream
+    )
+
+
+def insert_agent_message(conversation_id, content, agent, usage=None, response_id=None, model_id=None):
+    '''Stores an agent reply with the model that wrote it (the agent's own unless a fallback answered) and the token usage and stored response id its provider reported, and counts the tokens per provider. Runs in the caller's transaction.'''
+    usage = usage or {}
+    model_id = model_id or agent["model_id"]
+    model = next((fallback for fallback in agent.get("fallbacks") or [] if fallback["model_id"] == model_id), agent)
+    chain_key = agent.get("chain_key") if model_id == agent["model_id"] else None # a fallback's reply can't continue the agent's chain
+    cur = get_db().execute(
+        "INSERT INTO messages (conversation_id, content, human, model_id, input_tokens, cached_input_tokens, output_tokens, response_id, chain_key)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            conversation_id, content, 0, model_id,
+            usage.get("input_tokens"), usage.get("cached_input_tokens"), usage.get("output_tokens"),
+            response_id, chain_key,
+        )
+    )
+    for name, value in usage.items():
+        incr(f"tokens.{model['provider_code']}.{name}", value)
+    return cur.lastrowid
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def get_context_key(conversation_id):
+    '''Returns (context id, context version) of the conversation's context. The pair changes whenever the context payload does.'''
+    context_id = get_db().execute(
+        "SELECT context_id FROM context_conversation_relations WHERE conversation_id = ?",
+        (conversation_id,)
+    ).fetchone()["context_id"]
+    return context_id, get_context_version(context_id)
+
+
+def get_context_json(conversation_id, key=None, context_format="json"):
+    '''Returns the conversation's context written out in `context_format` (see formats.py), cached per context version and format.'''
+    if key is None:
+        key = get_context_key(conversation_id)
+    cache = get_context_cache()
+    cache_key = (*key, context_format)
+    context_json = cache.get(cache_key)
+    if context_json is None:
+        incr("context_cache.misses")
+        context_json = serialize(iter_context_payload(key[0]), context_format)
+        cache.put(cache_key, context_json)
+    else:
+        incr("context_cache.hits")
+    return context_json
+
+
+def get_relevant_context_json(context_key, messages, context_format="json"):
+    '''Returns the context in `context_format` cut down to the items that match the latest user message, and a key that changes with the selection.'''
+    query = next((message["content"] for message in reversed(messages) if message["human"]), "")
+    selected = select_context(*context_key, lambda: get_context_payload(context_key[0]), query)
+    item_ids = [item["id"] for alist in selected for item in alist["items"]]
+    digest = hashlib.sha256(json.dumps(item_ids).encode()).hexdigest()[:8]
+    return serialize(selected, context_format), "{}-{}-{}".format(*context_key, digest)
+
+
+def get_context_payload(context_id):
+    '''Returns the lists of a context with their details and items. Each item carries its detail values keyed by detail name. Uses a fixed number of queries regardless of context size.'''
+    return [dict(alist, items=list(alist["items"])) for alist in iter_context_payload(context_id)]
+
+
+def iter_context_payload(context_id):
+    '''Yields the lists of `get_context_payload` one at a time, each with an iterator over its items. Items are pivoted from one cursor as they are read, so memory doesn't grow with the context. Read each list's items before the next list, as the formats in formats.py do.'''
+    db = get_db()
+    context_list_ids = "SELECT list_id FROM context_list_relations WHERE context_id = ?"
+    lists = db.execute(
+        "SELECT clr.id AS position, l.id, l.name, l.description FROM lists l"
         " JOIN context_list_relations clr ON clr.list_id = l.id"
-        " WHERE clr.context_id = ?",
+        " WHERE clr.context_id = ?"
+        " ORDER BY clr.id",
         (context_id,)
     ).fetchall()
-    for alist in context:
-        alist["details"] = get_list_details(alist["id"], False)
-    for alist in context:
-        alist["items"] = get_list_items(alist["id"], False)
-        for item in alist["items"]:
-            item["created"] = item["created"].strftime("%Y-%m-%d")
-            for detail in alist["details"]:
-                item[detail["name"]] = db.execute(
-                    "SELECT content FROM item_detail_relations"
-                    " WHERE item_id = ? AND detail_id = ?",
-                    (item["id"], detail["id"])
-                ).fetchone()["content"]
-    return json.dumps(context)
+    details = {}
+    for detail in db.execute(
+        "SELECT ldr.list_id, d.id, d.name, d.description FROM details d"
+        " JOIN list_detail_relations ldr ON ldr.detail_id = d.id"
+        f" WHERE ldr.list_id IN ({context_list_ids})"
+        " ORDER BY ldr.id",
+        (context_id,)
+    ):
+        details.setdefault(detail.pop("list_id"), []).append(detail)
+    rows = RowReader(db.execute(
+        "SELECT clr.id AS position, lir.id AS entry, i.id, i.name, i.created, idr.detail_id, idr.content"
+        " FROM context_list_relations clr"
+        " JOIN list_item_relations lir ON lir.list_id = clr.list_id"
+        " JOIN items i ON i.id = lir.item_id"
+        " LEFT JOIN item_detail_relations idr ON idr.item_id = i.id"
+        " WHERE clr.context_id = ?"
+        " ORDER BY clr.id, lir.id, idr.id",
+        (context_id,)
+    ))
+    for alist in lists:
+        position = alist.pop("position")
+        alist["details"] = details.get(alist["id"], [])
+        items = iter_list_items(rows, position, alist["details"])
+        alist["items"] = items
+        yield alist
+        for item in items: # skip whatever the reader left, to get to the next list's rows
+            pass
+
+
+class RowReader:
+    '''A cursor with the current row kept, so a reader can stop at the first row that isn't its own.'''
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.row = next(cursor, None)
+
+    def advance(self):
+        self.row = next(self.cursor, None)
+
+
+def iter_list_items(rows, position, details):
+    '''Yields the items of the list at `position` in the context, pivoting their rows into detail values keyed by detail name.'''
+    while rows.row is not None and rows.row["position"] == position:
+        entry = rows.row["entry"]
+        item = dict(id=rows.row["id"], name=rows.row["name"], created=rows.row["created"].strftime("%Y-%m-%d"))
+        values = {}
+        while rows.row is not None and rows.row["entry"] == entry:
+            values.setdefault(rows.row["detail_id"], rows.row["content"])
+            rows.advance()
+        for detail in details:
+            item[detail["name"]] = values.get(detail["id"])
+        yield item
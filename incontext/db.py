@@ -1,9 +1,26 @@
 import os
 import sqlite3
+import threading
 from datetime import datetime
 
 import click
 from flask import current_app, g
+from flask.cli import with_appcontext
+
+
+# The prompt token budgets (context windows) of the models the app ships with, for `AGENT_MODELS` entries that don't give their own.
+# Keep in step with migrations/0018_model_budget_seed.sql.
+MODEL_BUDGETS = {
+    'gemini-2.0-flash': 1048576,
+    'gemini-2.5-pro': 1048576,
+    'gemini-2.0-flash-lite': 1048576,
+    'claude-3-5-haiku-latest': 200000,
+    'claude-sonnet-4-0': 200000,
+    'claude-opus-4-0': 200000,
+    'gpt-4o-mini': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4o': 128000,
+}
 
 
 def dict_factory(cursor, row):
@@ -11,24 +28,101 @@ def dict_factory(cursor, row):
     return {key: value for key, value in zip(fields, row)}
 
 
+class ConnectionManager:
+    '''Hands out long-lived SQLite connections, one per thread, so requests don't pay for connecting, parsing the schema and warming the page cache.
+
+    Pragmas are applied once when a connection is opened. Connections are health-checked before they are handed out again and replaced if broken.
+    '''
+    def __init__(self, database, pragmas, persistent=True):
+        self.database = database
+        self.pragmas = pragmas
+        self.persistent = persistent
+        self.checked_out = 0 # connections currently held by requests (or other work), across all threads
+        self._local = threading.local() # the idle connection of each thread
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def connect(self):
+        db = sqlite3.connect( # establishes a connection to the file pointed at by the `DATABASE` configuration key. This file doesn't have to exist yet, and won't until the database is initialized. (see protocol doc).
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES, # Does things like parsing timestamps to python datetime objects because sqlite has only very few native data types (INTEGER, TEXT, REAL, and BLOB).
+            check_same_thread=False, # each connection is only used by one thread at a time, but `close_all` may run on another.
+        )
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._connections.add(db)
+        return db
+
+    def checkout(self):
+        db = getattr(self._local, 'db', None)
+        self._local.db = None
+        if db is not None and not self.is_healthy(db):
+            self.discard(db)
+            db = None
+        if db is None:
+            db = self.connect()
+        db.row_factory = dict_factory # returns rows as dicts, allowing access to the columns by name.
+        with self._lock:
+            self.checked_out += 1
+        return db
+
+    def checkin(self, db):
+        with self._lock:
+            self.checked_out -= 1
+        if db.in_transaction:
+            db.rollback() # never hand an open transaction to the next request.
+        if self.persistent and getattr(self._local, 'db', None) is None:
+            self._local.db = db
+        else:
+            self.discard(db)
+
+    def is_healthy(self, db):
+        try:
+            db.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def discard(self, db):
+        with self._lock:
+            self._connections.discard(db)
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        '''Closes every connection opened by this manager, e.g. at worker shutdown.'''
+        with self._lock:
+            connections = list(self._connections)
+        for db in connections:
+            self.discard(db)
+        self._local = threading.local()
+
+
+def get_connection_manager():
+    return current_app.extensions['db']
+
+
 def get_db():
     if 'db' not in g: # `g` is the application context global - a special object unique for each request. It is used for data that might be accessed by multiple functions during the request. This conditional ensures that for any given request there is only one connection to the database.
-        g.db = sqlite3.connect( # establishes a connection to the file pointed at by the `DATABASE` configuration key. This file doesn't have to exist yet, and won't until the database is initialized. (see protocol doc).
-            current_app.config['DATABASE'], # `current_app` is also a special object. It points to the Flask application handling the request. It's available because the project uses an application factory in `__init__.py`. `get_db` will be called while the application is handling a request. It's not being called outside of that context. Therefore `current_app` will be available.
-            detect_types=sqlite3.PARSE_DECLTYPES # Does things like parsing timestamps to python datetime objects because sqlite has only very few native data types (INTEGER, TEXT, REAL, and BLOB).
-        )
-        # g.db.row_factory = sqlite3.Row # returns rows that behave like dicts, allowing access to the columns by name.
-        g.db.row_factory = dict_factory
+        g.db = get_connection_manager().checkout() # `current_app` is also a special object. It points to the Flask application handling the request. It's available because the project uses an application factory in `__init__.py`. `get_db` will be called while the application is handling a request. It's not being called outside of that context. Therefore `current_app` will be available.
 
     return g.db
 
 
 def close_db(e=None):
-    '''Checks if a connection was created and closes it if so. Called by the application factory after each request.'''
+    '''Checks if a connection was checked out and returns it to the manager if so. Called by the application factory after each request.'''
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        get_connection_manager().checkin(db)
+
+
+def release_db():
+    '''Returns the request's connection to the manager early, e.g. before blocking on the network. A later `get_db` checks one out again.'''
+    close_db()
 
 
 def init_db():
@@ -37,17 +131,26 @@ def init_db():
     with current_app.open_resource('schema.sql') as f: # `open_resource` opens a file relative to the `incontext` package
         db.executescript(f.read().decode('utf-8'))
 
+    migrate() # `schema.sql` is the baseline schema. Everything added since lives in the migrations.
+
     db.execute('INSERT INTO users (username, password, admin) VALUES(?, ?, ?)', ('admin', os.environ.get('IC_ADMIN_PW_HASH'), True),)
 
     db.executemany(
-        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
-        " VALUES (?, ?, ?, ?, ?)",
-        current_app.config["AGENT_MODELS"]
+        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description, context_budget)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        [get_model_seed(model) for model in current_app.config["AGENT_MODELS"]]
     )
 
     db.commit()
 
 
+def get_model_seed(model):
+    '''An `AGENT_MODELS` entry as an `agent_models` row. The context budget is optional, shipped models default to `MODEL_BUDGETS`.'''
+    provider_name, provider_code, model_name, model_code, model_description, *budget = model
+    context_budget = budget[0] if budget else MODEL_BUDGETS.get(model_code)
+    return (provider_name, provider_code, model_name, model_code, model_description, context_budget)
+
+
 @click.command('init-db') # defines a command line command 
 def init_db_command():
     '''Clear the existing data and create new tables.'''
@@ -55,6 +158,59 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+def get_migrations():
+    '''Returns (version, filename) for each script in the `migrations` folder, in order. Scripts are named `NNNN_description.sql`.'''
+    migrations_path = os.path.join(current_app.root_path, 'migrations')
+    migrations = []
+    for filename in os.listdir(migrations_path):
+        if filename.endswith('.sql'):
+            migrations.append((int(filename.split('_', 1)[0]), filename))
+    return sorted(migrations)
+
+
+def get_schema_version():
+    db = get_db()
+    db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    row = db.execute('SELECT MAX(version) AS version FROM schema_version').fetchone()
+    return row['version'] or 0
+
+
+def migrate():
+    '''Applies the migrations newer than the database's schema version, each in its own transaction. Returns the filenames applied.'''
+    db = get_db()
+    current_version = get_schema_version()
+    db.commit()
+    applied = []
+    for version, filename in get_migrations():
+        if version <= current_version:
+            continue
+        with current_app.open_resource(f'migrations/{filename}') as f:
+            script = f.read().decode('utf-8')
+        try:
+            db.executescript(
+                'BEGIN;\n'
+                f'{script}\n'
+                f'INSERT INTO schema_version (version) VALUES ({version});\n'
+                'COMMIT;'
+            )
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(filename)
+    return applied
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    '''Bring the database schema up to date without touching existing data.'''
+    applied = migrate()
+    for filename in applied:
+        click.echo(f'Applied {filename}.')
+    click.echo(f'Database is at schema version {get_schema_version()}.')
+
+
 # tell python how to interpret timestamp values in the database
 sqlite3.register_converter(
     "timestamp", lambda v: datetime.fromisoformat(v.decode())
@@ -63,5 +219,11 @@ sqlite3.register_converter(
 
 def init_app(app):
     '''Called by the app factory to do these register actions on the app.'''
+    app.extensions['db'] = ConnectionManager(
+        app.config['DATABASE'],
+        app.config['DB_PRAGMAS'],
+        app.config['DB_PERSISTENT_CONNECTIONS'],
+    )
     app.teardown_appcontext(close_db) # register the `close_db` function with the process of cleaning up after returning the response
     app.cli.add_command(init_db_command) # registers the `init-db` command that can be called with the `flask` command
+    app.cli.add_command(migrate_command)
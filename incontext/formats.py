@@ -0,0 +1,180 @@
+import json
+
+import click
+from flask.cli import with_appcontext
+
+from incontext.prompts import TOKENIZERS, get_tokenizer
+
+
+def get_columns(alist):
+    return ["id", "name", "created"] + [detail["name"] for detail in alist["details"]]
+
+
+def get_row(item, alist):
+    return [item["id"], item["name"], item["created"]] + [item.get(detail["name"]) for detail in alist["details"]]
+
+
+def get_heading(alist):
+    '''Names the list, and says how many items were left out when retrieval sent only some.'''
+    heading = f'{alist["name"]} (list {alist["id"]})'
+    if "total_items" in alist and alist["total_items"] > len(alist["items"]): # retrieval's lists are never streamed
+        heading += f' - {len(alist["items"])} of {alist["total_items"]} items'
+    return heading
+
+
+def get_detail_lines(alist):
+    return [f'- {detail["name"]}: {detail["description"]}' for detail in alist["details"] if detail["description"]]
+
+
+def iter_json(payload):
+    '''Every item as an object keyed by detail name. The most verbose format, and the default. The same text as `json.dumps(payload)`.'''
+    yield "["
+    for index, alist in enumerate(payload):
+        yield ", {" if index else "{"
+        for position, (key, value) in enumerate(alist.items()):
+            yield f"{', ' if position else ''}{json.dumps(key)}: "
+            if key == "items":
+                yield "["
+                for number, item in enumerate(value):
+                    yield f"{', ' if number else ''}{json.dumps(item)}"
+                yield "]"
+            else:
+                yield json.dumps(value)
+        yield "}"
+    yield "]"
+
+
+def iter_columnar(payload):
+    '''JSON with the column names once per list and each item as a row of values.'''
+    compact = dict(separators=(",", ":"))
+    yield "["
+    for index, alist in enumerate(payload):
+        head = dict(
+            id=alist["id"],
+            name=alist["name"],
+            description=alist["description"],
+            details=alist["details"],
+            columns=get_columns(alist),
+        )
+        yield ("," if index else "") + json.dumps(head, **compact)[:-1] + ',"rows":['
+        for number, item in enumerate(alist["items"]):
+            yield ("," if number else "") + json.dumps(get_row(item, alist), **compact)
+        yield "]"
+        if "total_items" in alist: # read after the items, which may be streamed
+            yield f',"total_items":{alist["total_items"]}'
+        yield "}"
+    yield "]"
+
+
+def tsv_value(value):
+    return "" if value is None else str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def iter_tsv(payload):
+    '''A heading per list, then its items as tab separated values under a header row.'''
+    for index, alist in enumerate(payload):
+        yield ("\n\n" if index else "") + f"# {get_heading(alist)}"
+        if alist["description"]:
+            yield "\n" + alist["description"]
+        for line in get_detail_lines(alist):
+            yield "\n" + line
+        yield "\n" + "\t".join(tsv_value(column) for column in get_columns(alist))
+        for item in alist["items"]:
+            yield "\n" + "\t".join(tsv_value(value) for value in get_row(item, alist))
+
+
+def markdown_value(value):
+    return "" if value is None else str(value).replace("|", "\\|").replace("\n", "<br>")
+
+
+def iter_markdown(payload):
+    '''A heading per list, then its items as a markdown table.'''
+    for index, alist in enumerate(payload):
+        yield ("\n\n" if index else "") + f"## {get_heading(alist)}"
+        if alist["description"]:
+            yield "\n" + alist["description"]
+        for line in get_detail_lines(alist):
+            yield "\n" + line
+        columns = get_columns(alist)
+        yield "\n| " + " | ".join(markdown_value(column) for column in columns) + " |"
+        yield "\n|" + "---|" * len(columns)
+        for item in alist["items"]:
+            yield "\n| " + " | ".join(markdown_value(value) for value in get_row(item, alist)) + " |"
+
+
+def compact_value(value):
+    '''Plain text as is. Quoted as JSON if it could be mistaken for the syntax around it.'''
+    if value is None:
+        return "~"
+    if isinstance(value, int):
+        return str(value)
+    if value == "" or value != value.strip() or any(c in value for c in ",:#[]{}\"'\n~") or value[0] in "-|>":
+        return json.dumps(value)
+    return value
+
+
+def iter_compact(payload):
+    '''YAML-like: a block per list with its details, the column names once and an item per line.'''
+    for index, alist in enumerate(payload):
+        yield ("\n" if index else "") + f"{compact_value(get_heading(alist))}:"
+        if alist["description"]:
+            yield f"\n  description: {compact_value(alist['description'])}"
+        if alist["details"]:
+            yield "\n  details:"
+            for detail in alist["details"]:
+                yield f"\n    {compact_value(detail['name'])}: {compact_value(detail['description'])}"
+        yield f"\n  items [{', '.join(compact_value(column) for column in get_columns(alist))}]:"
+        for item in alist["items"]:
+            yield f"\n    - {', '.join(compact_value(value) for value in get_row(item, alist))}"
+
+
+# Each format is a generator of text fragments, so a context can be written out while its rows are still being read.
+FORMATS = {
+    'json': iter_json,
+    'columnar': iter_columnar,
+    'tsv': iter_tsv,
+    'markdown': iter_markdown,
+    'compact': iter_compact,
+}
+
+
+def encode(payload, context_format="json", chunk_size=65536):
+    '''Yields the context block in `context_format` as chunks of about `chunk_size` characters. `payload` is a context payload or, to keep memory flat, a stream of lists with streamed items (see conversations.iter_context_payload). Unknown formats fall back to JSON.'''
+    buffer = []
+    size = 0
+    for fragment in FORMATS.get(context_format, iter_json)(payload):
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def serialize(payload, context_format="json"):
+    '''Returns the whole context block in `context_format`. See `encode`.'''
+    return "".join(encode(payload, context_format))
+
+
+@click.command('measure-formats')
+@click.argument('context_id', type=int)
+@click.option('--tokenizer', default='approximate', type=click.Choice(list(TOKENIZERS)))
+@with_appcontext
+def measure_formats_command(context_id, tokenizer):
+    '''Print the size of a context in every format.'''
+    from incontext.conversations import get_context_payload # conversations.py imports this module
+    payload = get_context_payload(context_id)
+    counter = get_tokenizer(tokenizer)
+    baseline = None
+    click.echo(f"{'format':<10} {'bytes':>10} {'tokens':>10} {'vs json':>8}")
+    for name in FORMATS:
+        text = serialize(payload, name)
+        tokens = counter.count(text)
+        baseline = baseline or tokens
+        click.echo(f"{name:<10} {len(text.encode()):>10} {tokens:>10} {tokens / baseline:>8.0%}")
+
+
+def init_app(app):
+    app.cli.add_command(measure_formats_command)
@@ -0,0 +1,292 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, current_app, request, url_for
+from werkzeug.exceptions import abort
+
+from incontext.auth import login_required
+from incontext.db import get_db, release_db
+from incontext.conversations import get_conversation, get_agent_request, insert_agent_message, stream_reply_response
+from incontext.leases import get_last_message_id, try_lease, finish_lease, fail_lease
+from incontext.metrics import incr, observe
+
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+
+class JobQueue:
+    '''Runs agent responses on a bounded pool of background threads so web workers aren't tied up for the whole provider round trip.
+
+    The `jobs` table is the source of truth. A job is claimed with a conditional update, so a job recovered by several workers still runs once.
+    While a job runs, its worker touches the job's heartbeat. A job whose heartbeat stops is taken for lost with its worker.
+    '''
+    def __init__(self, app, workers):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='incontext-job')
+        self.closed = False
+        self.running = set()
+        self._lock = threading.Lock()
+        self.stopped = threading.Event()
+        threading.Thread(target=self.beat, name='incontext-job-heartbeat', daemon=True).start()
+
+    def submit(self, job_id, delay=0):
+        '''Queues the job, after `delay` seconds if given. A delayed job holds no worker while it waits.'''
+        if self.closed:
+            return # left pending for the next worker to recover
+        if delay:
+            timer = threading.Timer(delay, self.submit, (job_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        with self.app.app_context():
+            incr('jobs.depth')
+        self.executor.submit(self.run, job_id)
+
+    def recover(self):
+        '''Requeues the jobs left behind by stopped workers: running jobs whose heartbeat is older than `JOB_STALE_SECONDS`, and pending jobs nobody has queued or touched for `JOB_PENDING_GRACE`. Returns their ids.'''
+        config = self.app.config
+        with self.app.app_context():
+            db = get_db()
+            now = time.time()
+            job_ids = [row['id'] for row in db.execute(
+                "UPDATE jobs SET status = 'pending', content = NULL, started_at = NULL, heartbeat = ?"
+                " WHERE status = 'running' AND COALESCE(heartbeat, started_at) < ?"
+                " RETURNING id",
+                (now, now - config['JOB_STALE_SECONDS'])
+            ).fetchall()]
+            job_ids += [row['id'] for row in db.execute(
+                "UPDATE jobs SET heartbeat = ?"
+                " WHERE status = 'pending' AND COALESCE(heartbeat, enqueued_at) < ?"
+                " RETURNING id",
+                (now, now - config['JOB_PENDING_GRACE'])
+            ).fetchall()] # touched, so other workers sweeping now leave them to this one
+            db.commit()
+        job_ids.sort()
+        for job_id in job_ids:
+            self.submit(job_id)
+        return job_ids
+
+    def beat(self):
+        '''Touches the heartbeat of the jobs this worker is running until the queue shuts down.'''
+        while not self.stopped.wait(self.app.config['JOB_HEARTBEAT_INTERVAL']):
+            with self._lock:
+                job_ids = list(self.running)
+            if job_ids:
+                with self.app.app_context():
+                    touch_jobs(job_ids)
+
+    def run(self, job_id):
+        with self.app.app_context():
+            incr('jobs.depth', -1)
+            job = claim_job(job_id)
+            if job is None:
+                return # someone else got it first
+            observe('jobs.wait_seconds', job['started_at'] - job['enqueued_at'])
+            with self._lock:
+                self.running.add(job_id)
+            try:
+                if run_agent_job(job) is None:
+                    self.submit(job_id, self.app.config['JOB_DEFER_SECONDS'])
+                    incr('jobs.deferred')
+                    return
+            except Exception as e:
+                db = get_db()
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (str(e), time.time(), job_id)
+                )
+                db.commit()
+                incr('jobs.failed')
+            else:
+                incr('jobs.done')
+            finally:
+                with self._lock:
+                    self.running.discard(job_id)
+            observe('jobs.run_seconds', time.time() - job['started_at'])
+
+    def shutdown(self, wait=True):
+        self.closed = True
+        self.stopped.set()
+        self.executor.shutdown(wait=wait)
+
+
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    '''Returns the app's job queue, starting it on first use. Starting it lazily keeps the threads out of CLI commands and out of a pre-forking master process.'''
+    app = current_app._get_current_object()
+    queue = app.extensions.get('jobs')
+    if queue is None:
+        with _queue_lock:
+            queue = app.extensions.get('jobs')
+            if queue is None:
+                queue = JobQueue(app, app.config['JOB_WORKERS'])
+                app.extensions['jobs'] = queue
+                queue.recover()
+    return queue
+
+
+def enqueue_agent_response(conversation_id):
+    job_id = insert_job(conversation_id, get_last_message_id(conversation_id))
+    get_db().commit()
+    get_job_queue().submit(job_id)
+    return job_id
+
+
+def insert_job(conversation_id, last_message_id):
+    '''Adds a pending job for the reply to the conversation at `last_message_id`, the state to answer in case the job waits for another request. Runs in the caller's transaction; submit the job once it is committed.'''
+    cur = get_db().execute(
+        "INSERT INTO jobs (conversation_id, last_message_id, enqueued_at) VALUES (?, ?, ?)",
+        (conversation_id, last_message_id, time.time())
+    )
+    return cur.lastrowid
+
+
+def claim_job(job_id):
+    db = get_db()
+    now = time.time()
+    cur = db.execute(
+        "UPDATE jobs SET status = 'running', started_at = ?, heartbeat = ? WHERE id = ? AND status = 'pending'",
+        (now, now, job_id)
+    )
+    db.commit()
+    if cur.rowcount != 1:
+        return None
+    return get_job(job_id)
+
+
+def run_agent_job(job):
+    '''Streams the reply into the job row as it arrives, then stores it as a message. A job for a conversation state another request has answered takes that reply instead. Returns (message id, content), or None if another request is still answering, in which case the job is pending again and should be retried later.'''
+    conversation_id = job['conversation_id']
+    last_message_id = job['last_message_id'] if job['last_message_id'] is not None else get_last_message_id(conversation_id)
+    owner, lease = try_lease(conversation_id, last_message_id)
+    if lease is not None:
+        if lease['status'] == 'running':
+            defer_job(job['id'])
+            return None
+        if lease['status'] == 'failed':
+            raise RuntimeError(lease['error'])
+        finish_job(job['id'], lease['content'], lease['message_id'])
+        return lease['message_id'], lease['content']
+    try:
+        message_id, content = stream_agent_job(job, last_message_id, owner)
+    except Exception as e:
+        fail_lease(conversation_id, last_message_id, owner, e)
+        raise
+    return message_id, content
+
+
+def defer_job(job_id):
+    db = get_db()
+    db.execute("UPDATE jobs SET status = 'pending', started_at = NULL, heartbeat = ? WHERE id = ?", (time.time(), job_id))
+    db.commit()
+
+
+def touch_jobs(job_ids):
+    db = get_db()
+    db.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = 'running'", [(time.time(), job_id) for job_id in job_ids])
+    db.commit()
+
+
+def stream_agent_job(job, last_message_id, owner):
+    agent, conversation_history = get_agent_request(job['conversation_id'], check_access=False) # checked when the job was queued
+    release_db() # hold no connection while waiting on the provider
+    interval = current_app.config['JOB_PROGRESS_INTERVAL']
+    chunks = []
+    report = {}
+    saved = time.monotonic()
+    for chunk in stream_reply_response(agent, conversation_history, report):
+        chunks.append(chunk)
+        if time.monotonic() - saved >= interval:
+            db = get_db()
+            db.execute("UPDATE jobs SET content = ?, heartbeat = ? WHERE id = ?", ("".join(chunks), time.time(), job['id']))
+            db.commit()
+            release_db()
+            saved = time.monotonic()
+    content = "".join(chunks)
+    message_id = insert_agent_message(job['conversation_id'], content, agent, report.get('usage'), report.get('response_id'), report.get('model_id'))
+    finish_lease(job['conversation_id'], last_message_id, owner, content, message_id)
+    finish_job(job['id'], content, message_id)
+    return message_id, content
+
+
+def finish_job(job_id, content, message_id):
+    '''Marks the job done. Commits the caller's transaction.'''
+    db = get_db()
+    db.execute(
+        "UPDATE jobs SET status = 'done', content = ?, message_id = ?, finished_at = ? WHERE id = ?",
+        (content, message_id, time.time(), job_id)
+    )
+    db.commit()
+
+
+def get_job(job_id, check_creator=False):
+    job = get_db().execute(
+        "SELECT id, conversation_id, last_message_id, status, content, error, message_id, enqueued_at, started_at, heartbeat, finished_at"
+        " FROM jobs WHERE id = ?",
+        (job_id,)
+    ).fetchone()
+    if job is None:
+        abort(404, f"Job id {job_id} doesn't exist.")
+    if check_creator:
+        get_conversation(job['conversation_id']) # the job belongs to whoever owns the conversation
+    return job
+
+
+def is_lost(job):
+    '''Whether `recover` would requeue the job.'''
+    config = current_app.config
+    now = time.time()
+    if job['status'] == 'running':
+        return (job['heartbeat'] or job['started_at']) < now - config['JOB_STALE_SECONDS']
+    if job['status'] == 'pending':
+        return (job['heartbeat'] or job['enqueued_at']) < now - config['JOB_PENDING_GRACE']
+    return False
+
+
+@bp.route('/agent-response', methods=('POST',))
+@login_required
+def agent_response():
+    '''Queues the agent's reply and returns right away. Poll the status URL for progress.'''
+    conversation_id = request.json["conversation_id"]
+    get_conversation(conversation_id) # To check access
+    job_id = enqueue_agent_response(conversation_id)
+    return dict(
+        job_id=job_id,
+        status_url=url_for('jobs.status', job_id=job_id),
+        result_url=url_for('jobs.result', job_id=job_id),
+    ), 202
+
+
+@bp.route('/<int:job_id>')
+@login_required
+def status(job_id):
+    queue = get_job_queue() # a restarted worker picks up its leftover jobs on the first poll
+    job = get_job(job_id, check_creator=True)
+    if is_lost(job):
+        queue.recover() # lost with a worker that died after this one started, so the sweep at startup missed it
+        job = get_job(job_id)
+    return dict(
+        id=job['id'],
+        status=job['status'],
+        content=job['content'],
+        error=job['error'],
+        message_id=job['message_id'],
+    )
+
+
+@bp.route('/<int:job_id>/result')
+@login_required
+def result(job_id):
+    job = get_job(job_id, check_creator=True)
+    if job['status'] == 'done':
+        return dict(content=job['content'], message_id=job['message_id']), 200
+    if job['status'] == 'failed':
+        return dict(content=f"An error occurred in the agent response job: {job['error']}"), 200
+    return dict(status=job['status']), 202
+
+
+def init_app(app):
+    app.register_blueprint(bp)
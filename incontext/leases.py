@@ -0,0 +1,90 @@
+import time
+import uuid
+
+from flask import current_app
+
+from incontext.db import get_db, release_db
+from incontext.metrics import incr
+
+
+def get_last_message_id(conversation_id):
+    row = get_db().execute(
+        "SELECT MAX(id) AS id FROM messages WHERE conversation_id = ?",
+        (conversation_id,)
+    ).fetchone()
+    return row['id'] or 0
+
+
+def claim_lease(conversation_id, last_message_id):
+    '''Takes the lease on answering the conversation at `last_message_id` and returns the owner token that finishes it, or None. Fails while another request holds it, unless that one failed or its lease expired.'''
+    db = get_db()
+    now = time.time()
+    owner = uuid.uuid4().hex
+    cur = db.execute(
+        "INSERT INTO response_leases (conversation_id, last_message_id, owner, status, expires) VALUES (?, ?, ?, 'running', ?)"
+        " ON CONFLICT (conversation_id, last_message_id) DO UPDATE"
+        " SET owner = excluded.owner, status = 'running', content = NULL, error = NULL, message_id = NULL, expires = excluded.expires"
+        " WHERE response_leases.status = 'failed' OR (response_leases.status = 'running' AND response_leases.expires < ?)",
+        (conversation_id, last_message_id, owner, now + current_app.config['LEASE_SECONDS'], now)
+    )
+    db.commit()
+    return owner if cur.rowcount == 1 else None
+
+
+def get_lease(conversation_id, last_message_id):
+    return get_db().execute(
+        "SELECT conversation_id, last_message_id, status, content, error, message_id, expires"
+        " FROM response_leases WHERE conversation_id = ? AND last_message_id = ?",
+        (conversation_id, last_message_id)
+    ).fetchone()
+
+
+def try_lease(conversation_id, last_message_id):
+    '''Returns (owner token, None) if this request now holds the lease, otherwise (None, the lease of the request that does), which may still be running.'''
+    while True:
+        owner = claim_lease(conversation_id, last_message_id)
+        if owner is not None:
+            return owner, None
+        lease = get_lease(conversation_id, last_message_id)
+        if lease is not None: # else it was cleaned up in between, so try again
+            return None, lease
+
+
+def join_lease(conversation_id, last_message_id):
+    '''Single flight for agent responses, across workers. Returns (owner token, None) once this request holds the lease and should call the provider. If another request is already answering the same conversation state, waits for it and returns (None, its finished lease) instead, with `status` 'done' or 'failed'.'''
+    interval = current_app.config['LEASE_POLL_INTERVAL']
+    attached = False
+    while True:
+        owner, lease = try_lease(conversation_id, last_message_id)
+        if lease is None or lease['status'] != 'running':
+            return owner, lease
+        if not attached:
+            incr('leases.attached')
+            attached = True
+        release_db() # hold no connection while the other request works
+        time.sleep(interval) # if the lease expires meanwhile, the next claim takes it over
+
+
+def finish_lease(conversation_id, last_message_id, owner, content, message_id):
+    '''Hands the reply to the requests waiting on the lease. Runs in the caller's transaction, which should be the one that stored the message.'''
+    db = get_db()
+    db.execute(
+        "UPDATE response_leases SET status = 'done', content = ?, message_id = ?"
+        " WHERE conversation_id = ? AND last_message_id = ? AND owner = ?",
+        (content, message_id, conversation_id, last_message_id, owner)
+    )
+    db.execute(
+        "DELETE FROM response_leases WHERE conversation_id = ? AND last_message_id < ?", # nobody waits on an older state any more
+        (conversation_id, last_message_id)
+    )
+
+
+def fail_lease(conversation_id, last_message_id, owner, error):
+    '''Lets the next request for the state try again. Does nothing if the lease has expired and been taken over since.'''
+    db = get_db()
+    db.execute(
+        "UPDATE response_leases SET status = 'failed', error = ?"
+        " WHERE conversation_id = ? AND last_message_id = ? AND owner = ?",
+        (str(error), conversation_id, last_message_id, owner)
+    )
+    db.commit()
@@ -0,0 +1,178 @@
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context
+
+from incontext.db import get_connection_manager
+from incontext.metrics import incr, observe
+
+
+class LimitTimeoutError(Exception):
+    '''Raised when a provider call waited `LIMIT_WAIT_MAX` seconds for a free slot. Fallback models are tried next.'''
+    def __init__(self, provider, model, waited):
+        super().__init__(f'{provider}/{model} is at its limit, gave up after {waited:.1f}s')
+        self.provider = provider
+
+
+def get_limits(provider, model):
+    '''Returns [(scope, limit)] of the `PROVIDER_LIMITS` that apply to a call: the provider's, then the model's. Scopes are `provider` and `provider/model`.'''
+    config = current_app.config['PROVIDER_LIMITS']
+    scopes = [provider, f'{provider}/{model}']
+    return [(scope, config[scope]) for scope in scopes if scope in config]
+
+
+def get_user_id(agent):
+    '''The user the call is made for: the logged in user, or the agent's owner in background work.'''
+    if has_request_context() and g.get('user') is not None:
+        return g.user['id']
+    return agent.get('creator_id')
+
+
+def is_next(db, provider, model, waiter_id):
+    '''Whether the waiter is first in the fair order: the users with the fewest calls in flight go first, then whoever has waited longest. A user's own calls go in order.'''
+    head = db.execute(
+        "SELECT w.id,"
+        " (SELECT COUNT(*) FROM limit_slots s WHERE s.provider = w.provider AND s.user_id IS w.user_id) AS in_flight"
+        " FROM limit_waiters w"
+        " WHERE w.provider = ? AND w.model IS ?"
+        " ORDER BY in_flight, (SELECT MIN(o.id) FROM limit_waiters o WHERE o.provider = w.provider AND o.model IS w.model AND o.user_id IS w.user_id), w.id"
+        " LIMIT 1",
+        (provider, model)
+    ).fetchone()
+    return head is not None and head['id'] == waiter_id
+
+
+def has_room(db, provider, model, limits, now):
+    '''Checks every limit, and if all have room, takes a token from each rate limited bucket.'''
+    buckets = []
+    for scope, limit in limits:
+        if limit.get('concurrency'):
+            if scope == provider:
+                in_flight = db.execute("SELECT COUNT(*) AS n FROM limit_slots WHERE provider = ?", (provider,)).fetchone()['n']
+            else:
+                in_flight = db.execute("SELECT COUNT(*) AS n FROM limit_slots WHERE provider = ? AND model IS ?", (provider, model)).fetchone()['n']
+            if in_flight >= limit['concurrency']:
+                return False
+        if limit.get('rate'):
+            burst = limit.get('burst') or 1
+            bucket = db.execute("SELECT tokens, updated FROM limit_buckets WHERE scope = ?", (scope,)).fetchone()
+            tokens = burst if bucket is None else min(burst, bucket['tokens'] + (now - bucket['updated']) * limit['rate'])
+            if tokens < 1:
+                return False
+            buckets.append((scope, tokens - 1))
+    db.executemany(
+        "INSERT INTO limit_buckets (scope, tokens, updated) VALUES (?, ?, ?)"
+        " ON CONFLICT (scope) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+        [(scope, tokens, now) for scope, tokens in buckets]
+    )
+    return True
+
+
+def acquire(db, provider, model, user_id, limits):
+    '''Waits in the shared queue for a slot under every limit. Returns the slot id. All state is in SQLite, so the limits hold across worker processes.'''
+    config = current_app.config
+    started = time.monotonic()
+    now = time.time()
+    with db:
+        waiter_id = db.execute(
+            "INSERT INTO limit_waiters (provider, model, user_id, seen) VALUES (?, ?, ?, ?)",
+            (provider, model, user_id, now)
+        ).lastrowid
+    try:
+        while True:
+            now = time.time()
+            db.execute('BEGIN IMMEDIATE') # one worker at a time decides who goes next
+            try:
+                db.execute("DELETE FROM limit_slots WHERE expires < ?", (now,)) # held by a worker that died
+                db.execute("DELETE FROM limit_waiters WHERE seen < ?", (now - config['LIMIT_WAITER_STALE'],))
+                db.execute("UPDATE limit_waiters SET seen = ? WHERE id = ?", (now, waiter_id))
+                slot_id = None
+                if is_next(db, provider, model, waiter_id) and has_room(db, provider, model, limits, now):
+                    db.execute("DELETE FROM limit_waiters WHERE id = ?", (waiter_id,))
+                    slot_id = db.execute(
+                        "INSERT INTO limit_slots (provider, model, user_id, expires) VALUES (?, ?, ?, ?)",
+                        (provider, model, user_id, now + config['LIMIT_SLOT_TTL'])
+                    ).lastrowid
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            waited = time.monotonic() - started
+            if slot_id is not None:
+                observe('limits.wait_seconds', waited)
+                observe(f'limits.{provider}.wait_seconds', waited)
+                return slot_id
+            if waited >= config['LIMIT_WAIT_MAX']:
+                incr(f'limits.{provider}.timeouts')
+                raise LimitTimeoutError(provider, model, waited)
+            time.sleep(config['LIMIT_POLL_INTERVAL'])
+    finally:
+        with db:
+            db.execute("DELETE FROM limit_waiters WHERE id = ?", (waiter_id,))
+
+
+def try_acquire(db, provider, model, user_id, limits):
+    '''Takes a slot if one is free right now and nobody is queued for the provider. Returns the slot id, or None.'''
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute("DELETE FROM limit_slots WHERE expires < ?", (now,))
+        queued = db.execute(
+            "SELECT 1 FROM limit_waiters WHERE provider = ? AND seen >= ? LIMIT 1",
+            (provider, now - current_app.config['LIMIT_WAITER_STALE'])
+        ).fetchone()
+        slot_id = None
+        if queued is None and has_room(db, provider, model, limits, now):
+            slot_id = db.execute(
+                "INSERT INTO limit_slots (provider, model, user_id, expires) VALUES (?, ?, ?, ?)",
+                (provider, model, user_id, now + current_app.config['LIMIT_SLOT_TTL'])
+            ).lastrowid
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return slot_id
+
+
+@contextmanager
+def limited(agent):
+    '''Holds a slot of the agent's provider and model for the duration of the block. Does nothing unless `PROVIDER_LIMITS` covers them.'''
+    provider = agent['provider_code']
+    model = agent.get('model_code')
+    limits = get_limits(provider, model)
+    if not limits:
+        yield
+        return
+    slot_id = with_connection(lambda db: acquire(db, provider, model, get_user_id(agent), limits))
+    try:
+        yield
+    finally:
+        with_connection(lambda db: release(db, slot_id))
+
+
+def take_slot(agent):
+    '''Takes a slot of the agent's provider and model without waiting, for a call only worth making right away, like the second copy of a hedged call. Returns a function that frees it, or None if no slot is free.'''
+    provider = agent['provider_code']
+    model = agent.get('model_code')
+    limits = get_limits(provider, model)
+    if not limits:
+        return lambda: None
+    slot_id = with_connection(lambda db: try_acquire(db, provider, model, get_user_id(agent), limits))
+    if slot_id is None:
+        return None
+    return lambda: with_connection(lambda db: release(db, slot_id))
+
+
+def release(db, slot_id):
+    with db:
+        db.execute("DELETE FROM limit_slots WHERE id = ?", (slot_id,))
+
+
+def with_connection(fn):
+    '''Runs `fn` on a connection of its own, so the caller's transaction is never committed here and no connection is held during the call.'''
+    manager = get_connection_manager()
+    db = manager.checkout()
+    try:
+        return fn(db)
+    finally:
+        manager.checkin(db)
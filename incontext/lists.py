@@ -1,11 +1,12 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for, jsonify
+    Blueprint, flash, g, redirect, render_template, request, url_for, jsonify, current_app
 )
 from werkzeug.exceptions import abort
 
 from incontext.auth import login_required
 from incontext.db import get_db
 from incontext.db import dict_factory
+from incontext.cache import bump_list_context_versions
 
 
 bp = Blueprint('lists', __name__, url_prefix='/lists')
@@ -45,9 +46,29 @@ def new():
 @bp.route('/<int:list_id>/view')
 @login_required
 def view(list_id):
-    alist = get_list_with_items_and_details(list_id)
-    contexts = get_list_contexts(list_id)
-    return render_template('lists/view.html', alist=alist, contexts=contexts)
+    after = request.args.get('after', type=int)
+    alist = get_list_with_items_and_details(list_id, after=after, limit=get_page_size())
+    contexts = get_list_contexts(list_id, False)
+    return render_template('lists/view.html', alist=alist, contexts=contexts, after=after, limit=request.args.get('limit', type=int))
+
+
+@bp.route('/<int:list_id>/items')
+@login_required
+def items_page(list_id):
+    alist = get_list_with_items_and_details(list_id, after=request.args.get('after', type=int), limit=get_page_size())
+    return jsonify(
+        details=alist['details'],
+        items=[
+            dict(
+                id=item['id'],
+                name=item['name'],
+                created=item['created'].isoformat(),
+                relations=item['relations'],
+            )
+            for item in alist['items']
+        ],
+        next_after=alist['next_after'],
+    )
 
 
 @bp.route('/<int:list_id>/edit', methods=('GET', 'POST'))
@@ -69,6 +90,7 @@ def edit(list_id):
                 ' WHERE id = ?',
                 (name, description, list_id)
             )
+            bump_list_context_versions(list_id)
             db.commit()
             return redirect(url_for('lists.index'))
     return render_template('lists/edit.html', alist=alist)
@@ -106,6 +128,7 @@ def delete(list_id):
     db.execute('DELETE FROM list_detail_relations WHERE list_id = ?', (list_id,))
     # Delete list
     db.execute('DELETE FROM lists WHERE id = ?', (list_id,))
+    bump_list_context_versions(list_id)
     db.commit()
     return redirect(url_for('lists.index'))
 
@@ -149,6 +172,7 @@ def new_item(list_id):
                 ' VALUES(?, ?, ?)',
                 relations
             )
+            bump_list_context_versions(list_id)
             db.commit()
             return redirect(url_for('lists.view', list_id=list_id))
     alist = get_list(list_id)
@@ -197,6 +221,7 @@ def edit_item(list_id, item_id):
                 ' AND detail_id = ?',
                 detail_fields
             )
+            bump_list_context_versions(list_id)
             db.commit()
             return redirect(url_for('lists.view', list_id=list_id))
     return render_template('lists/items/edit.html', alist=alist, item=item, details=details)
@@ -215,6 +240,7 @@ def delete_item(list_id, item_id):
         (list_id, item_id)
     )
     db.execute('DELETE FROM item_detail_relations WHERE item_id = ?', (item_id,))
+    bump_list_context_versions(list_id)
     db.commit()
     return redirect(url_for('lists.view', list_id=list_id))
 
@@ -252,6 +278,7 @@ def new_detail(list_id):
                 'VALUES (?, ?, ?)',
                 data
             )
+            bump_list_context_versions(list_id)
             db.commit()
             return redirect(url_for('lists.view', list_id=list_id))
     return render_template('lists/details/new.html', alist=alist)
@@ -277,6 +304,7 @@ def edit_detail(list_id, detail_id):
                 ' WHERE id = ?',
                 (name, description, detail_id)
             )
+            bump_list_context_versions(list_id)
             db.commit()
             return redirect(url_for('lists.view', list_id=list_id))
     return render_template('lists/details/edit.html', alist=alist, detail=detail)
@@ -291,6 +319,7 @@ def delete_detail(list_id, detail_id):
     db.execute('DELETE FROM details WHERE id = ?', (detail_id,))
     db.execute('DELETE FROM item_detail_relations WHERE detail_id = ?', (detail_id,))
     db.execute('DELETE FROM list_detail_relations WHERE detail_id = ?', (detail_id,))
+    bump_list_context_versions(list_id)
     db.commit()
     return redirect(url_for('lists.view', list_id=list_id))
 
@@ -308,28 +337,26 @@ def get_user_lists():
 
 
 def get_list(list_id, check_creator=True):
-    db = get_db()
-    if check_creator:
-        list_creator_id = get_list_creator_id(list_id)
-        if list_creator_id is None:
-            abort(404)
-        if list_creator_id != g.user['id']:
-            abort(403)
     alist = get_db().execute(
         'SELECT id, name, description, creator_id'
         ' FROM lists'
         ' WHERE id = ?',
         (list_id,)
     ).fetchone()
+    if check_creator:
+        if alist is None:
+            abort(404)
+        if alist['creator_id'] != g.user['id']:
+            abort(403)
     return alist
 
 
-def get_list_with_items_and_details(list_id, check_creator=True):
-    alist = get_list(list_id) 
-    if check_creator:
-        list_creator_id = get_list_creator_id(list_id)
-        if list_creator_id != g.user['id']:
-            abort(403)
+def get_list_with_items_and_details(list_id, check_creator=True, after=None, limit=None):
+    '''Loads a page of the list grid in one join ordered by item and pivots it into `item["relations"]`, one relation per list detail.
+
+    Pages are keyed on `items.id`: pass the `next_after` of the previous page as `after`. Without a `limit` every item is returned.
+    '''
+    alist = get_list(list_id, check_creator)
     db = get_db()
     db.row_factory = dict_factory
     details = db.execute(
@@ -337,28 +364,51 @@ def get_list_with_items_and_details(list_id, check_creator=True):
         " FROM details d"
         " JOIN list_detail_relations ldr"
         " ON ldr.detail_id = d.id"
-        " WHERE ldr.list_id = ?",
+        " WHERE ldr.list_id = ?"
+        " ORDER BY ldr.id",
         (list_id,)
     ).fetchall()
     alist["details"] = details
-    items = get_list_items(list_id)
-    for item in items:
-        item["relations"] = []
-        for detail in details:
-            item_detail_relation = db.execute(
-                "SELECT d.name, r.content"
-                " FROM details d JOIN item_detail_relations r"
-                " ON d.id = r.detail_id"
-                " WHERE d.id = ?"
-                " AND r.item_id = ?",
-                (detail["id"], item["id"],) 
-            ).fetchone()
-            item["relations"].append(item_detail_relation)
-    alist["items"] = items
+    rows = db.execute(
+        "SELECT i.id, i.name, i.created, r.detail_id, r.content"
+        " FROM (SELECT item_id FROM list_item_relations"
+        "  WHERE list_id = ? AND item_id > ?"
+        "  ORDER BY item_id LIMIT ?) page"
+        " JOIN items i ON i.id = page.item_id"
+        " LEFT JOIN item_detail_relations r ON r.item_id = i.id"
+        " ORDER BY i.id, r.id",
+        (list_id, after or 0, -1 if limit is None else limit + 1)
+    )
+    alist["items"], alist["next_after"] = paginate(pivot_item_rows(rows, details), limit)
     return alist
 
 
-def get_list_items(list_id, check_creator=True):
+def pivot_item_rows(rows, details):
+    '''Turns item x detail rows ordered by item into items with their `relations`.'''
+    items = []
+    item = None
+    contents = {}
+    for row in rows:
+        if item is None or row["id"] != item["id"]:
+            if item is not None:
+                add_item_relations(item, details, contents)
+            item = dict(id=row["id"], name=row["name"], created=row["created"])
+            items.append(item)
+            contents = {}
+        contents.setdefault(row["detail_id"], row["content"])
+    if item is not None:
+        add_item_relations(item, details, contents)
+    return items
+
+
+def add_item_relations(item, details, contents):
+    item["relations"] = [
+        dict(name=detail["name"], content=contents.get(detail["id"]))
+        for detail in details
+    ]
+
+
+def get_list_items(list_id, check_creator=True, after=None, limit=None):
     if check_creator:
         list_creator_id = get_list_creator_id(list_id)
         if list_creator_id != g.user['id']:
@@ -368,10 +418,28 @@ def get_list_items(list_id, check_creator=True):
         'SELECT i.id, i.name, i.created'
         ' FROM items i'
         ' JOIN list_item_relations r ON r.item_id = i.id'
-        ' WHERE r.list_id = ?',
-        (list_id,)
+        ' WHERE r.list_id = ? AND r.item_id > ?'
+        ' ORDER BY r.item_id'
+        ' LIMIT ?',
+        (list_id, after or 0, -1 if limit is None else limit + 1)
     ).fetchall()
-    return items
+    if limit is None:
+        return items
+    return paginate(items, limit)[0]
+
+
+def paginate(items, limit):
+    '''Trims a page fetched with one extra row and returns it with the cursor of the next page, or None on the last page.'''
+    if limit is None or len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, items[-1]["id"]
+
+
+def get_page_size(default_key='LIST_PAGE_SIZE', max_key='LIST_PAGE_SIZE_MAX'):
+    '''The page size requested with the `limit` argument, clamped to the configured maximum.'''
+    limit = request.args.get('limit', current_app.config[default_key], type=int)
+    return max(1, min(limit, current_app.config[max_key]))
 
 
 def get_list_item(list_id, item_id, check_relation=True):
@@ -477,4 +545,64 @@ def get_list_contexts(list_id, check_access=True):
         (list_id,)
     ).fetchall()
     return contexts
-        
+
+
+def get_context_lists(context_id):
+    '''Returns the lists of a context with their item counts, in the order they were added.'''
+    return get_db().execute(
+        "SELECT l.id, l.name, l.description,"
+        " (SELECT COUNT(*) FROM list_item_relations r WHERE r.list_id = l.id) AS items"
+        " FROM lists l"
+        " JOIN context_list_relations clr ON clr.list_id = l.id"
+        " WHERE clr.context_id = ?"
+        " ORDER BY clr.id",
+        (context_id,)
+    ).fetchall()
+
+
+def is_context_list(context_id, list_id):
+    return get_db().execute(
+        "SELECT 1 FROM context_list_relations WHERE context_id = ? AND list_id = ?",
+        (context_id, list_id)
+    ).fetchone() is not None
+
+
+def get_list_items_by_id(list_id, item_ids, details):
+    '''Returns the items of the list among `item_ids` with their `relations`, in id order. Ids of other lists' items are ignored.'''
+    if not item_ids:
+        return []
+    rows = get_db().execute(
+        "SELECT i.id, i.name, i.created, r.detail_id, r.content"
+        " FROM list_item_relations lir"
+        " JOIN items i ON i.id = lir.item_id"
+        " LEFT JOIN item_detail_relations r ON r.item_id = i.id"
+        f" WHERE lir.list_id = ? AND lir.item_id IN ({', '.join('?' * len(item_ids))})"
+        " ORDER BY i.id, r.id",
+        (list_id, *item_ids)
+    )
+    return pivot_item_rows(rows, details)
+
+
+def search_list_items(list_id, query, limit):
+    '''Returns the ids of up to `limit` items of the list whose name or detail values contain every word of `query`, ignoring case.'''
+    words = query.split()
+    if not words:
+        return []
+    conditions = []
+    params = [list_id]
+    for word in words:
+        pattern = "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append(
+            "(i.name LIKE ? ESCAPE '\\' OR EXISTS (SELECT 1 FROM item_detail_relations idr"
+            " WHERE idr.item_id = i.id AND idr.content LIKE ? ESCAPE '\\'))"
+        )
+        params += [pattern, pattern]
+    rows = get_db().execute(
+        "SELECT i.id FROM list_item_relations lir"
+        " JOIN items i ON i.id = lir.item_id"
+        " WHERE lir.list_id = ? AND " + " AND ".join(conditions) +
+        " ORDER BY lir.item_id"
+        " LIMIT ?",
+        (*params, limit)
+    ).fetchall()
+    return [row["id"] for row in rows]
@@ -0,0 +1,60 @@
+import threading
+
+from flask import Blueprint, current_app, g
+from werkzeug.exceptions import abort
+
+from incontext.auth import login_required
+
+
+bp = Blueprint('metrics', __name__, url_prefix='/metrics')
+
+
+class Metrics:
+    '''In-process counters and timings. Each gunicorn worker keeps its own.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self.timings.setdefault(name, dict(count=0, total=0.0, max=0.0))
+            timing['count'] += 1
+            timing['total'] += value
+            timing['max'] = max(timing['max'], value)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                counters=dict(self.counters),
+                timings={name: dict(timing) for name, timing in self.timings.items()},
+            )
+
+
+def get_metrics():
+    return current_app.extensions['metrics']
+
+
+def incr(name, amount=1):
+    get_metrics().incr(name, amount)
+
+
+def observe(name, value):
+    get_metrics().observe(name, value)
+
+
+@bp.route('/')
+@login_required
+def index():
+    if not g.user['admin']:
+        abort(403)
+    return get_metrics().snapshot()
+
+
+def init_app(app):
+    app.extensions['metrics'] = Metrics()
+    app.register_blueprint(bp)
@@ -0,0 +1,23 @@
+-- Foreign key lookups. Relation tables get an index per direction; the second
+-- column makes each one covering for the join it serves.
+CREATE INDEX IF NOT EXISTS messages_conversation_id ON messages (conversation_id);
+CREATE INDEX IF NOT EXISTS context_list_relations_context_id_list_id ON context_list_relations (context_id, list_id);
+CREATE INDEX IF NOT EXISTS context_list_relations_list_id_context_id ON context_list_relations (list_id, context_id);
+CREATE INDEX IF NOT EXISTS context_conversation_relations_context_id_conversation_id ON context_conversation_relations (context_id, conversation_id);
+CREATE INDEX IF NOT EXISTS context_conversation_relations_conversation_id_context_id ON context_conversation_relations (conversation_id, context_id);
+CREATE INDEX IF NOT EXISTS conversation_agent_relations_conversation_id_agent_id ON conversation_agent_relations (conversation_id, agent_id);
+CREATE INDEX IF NOT EXISTS conversation_agent_relations_agent_id_conversation_id ON conversation_agent_relations (agent_id, conversation_id);
+CREATE INDEX IF NOT EXISTS list_item_relations_list_id_item_id ON list_item_relations (list_id, item_id);
+CREATE INDEX IF NOT EXISTS list_item_relations_item_id_list_id ON list_item_relations (item_id, list_id);
+CREATE INDEX IF NOT EXISTS list_detail_relations_list_id_detail_id ON list_detail_relations (list_id, detail_id);
+CREATE INDEX IF NOT EXISTS list_detail_relations_detail_id_list_id ON list_detail_relations (detail_id, list_id);
+-- Covers the item x detail lookups of the list grid and the context payload without touching the table.
+CREATE INDEX IF NOT EXISTS item_detail_relations_item_id_detail_id ON item_detail_relations (item_id, detail_id, content);
+CREATE INDEX IF NOT EXISTS item_detail_relations_detail_id ON item_detail_relations (detail_id);
+
+-- Per-user listings.
+CREATE INDEX IF NOT EXISTS contexts_creator_id ON contexts (creator_id);
+CREATE INDEX IF NOT EXISTS lists_creator_id ON lists (creator_id);
+CREATE INDEX IF NOT EXISTS items_creator_id ON items (creator_id);
+CREATE INDEX IF NOT EXISTS details_creator_id ON details (creator_id);
+CREATE INDEX IF NOT EXISTS agents_creator_id ON agents (creator_id);
@@ -0,0 +1,6 @@
+-- Version counters for the context payload cache (see cache.py).
+CREATE TABLE IF NOT EXISTS context_versions (
+    context_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (context_id) REFERENCES contexts (id)
+);
@@ -0,0 +1,15 @@
+-- Background agent responses (see jobs.py). Times are epoch seconds so queue latency can be measured.
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- pending, running, done or failed
+    content TEXT, -- the reply so far while running, the full reply once done
+    error TEXT,
+    message_id INTEGER,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+    FOREIGN KEY (message_id) REFERENCES messages (id)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
@@ -0,0 +1,2 @@
+-- The prompt token budget of each model (see prompts.py). NULL falls back to PROMPT_BUDGET.
+ALTER TABLE agent_models ADD COLUMN context_budget INTEGER;
@@ -0,0 +1,11 @@
+-- Rolling summaries of older messages (see summaries.py). Each row covers the messages from first_message_id to last_message_id.
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL,
+    first_message_id INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+);
+CREATE INDEX IF NOT EXISTS conversation_summaries_conversation_id_last_message_id ON conversation_summaries (conversation_id, last_message_id);
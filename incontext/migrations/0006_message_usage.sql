@@ -0,0 +1,4 @@
+-- Token usage reported by the provider for each agent message, to measure prompt caching.
+ALTER TABLE messages ADD COLUMN input_tokens INTEGER;
+ALTER TABLE messages ADD COLUMN cached_input_tokens INTEGER; -- the part of input_tokens read from the provider's prompt cache
+ALTER TABLE messages ADD COLUMN output_tokens INTEGER;
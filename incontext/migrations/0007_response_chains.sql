@@ -0,0 +1,3 @@
+-- OpenAI stored responses (see OPENAI_STATEFUL_RESPONSES). chain_key fingerprints the agent and context a reply was made with.
+ALTER TABLE messages ADD COLUMN response_id TEXT;
+ALTER TABLE messages ADD COLUMN chain_key TEXT;
@@ -0,0 +1,12 @@
+-- Models an agent falls back to, in order, when its own model fails (see providers.get_provider_response).
+CREATE TABLE IF NOT EXISTS agent_fallbacks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent_id INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (agent_id) REFERENCES agents (id),
+    FOREIGN KEY (model_id) REFERENCES agent_models (id)
+);
+CREATE INDEX IF NOT EXISTS agent_fallbacks_agent_id_position ON agent_fallbacks (agent_id, position);
+-- The model that actually wrote each agent message.
+ALTER TABLE messages ADD COLUMN model_id INTEGER REFERENCES agent_models (id);
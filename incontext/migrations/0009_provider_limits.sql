@@ -0,0 +1,22 @@
+-- Shared state of the provider limiter (see limits.py), so the limits hold across worker processes.
+CREATE TABLE IF NOT EXISTS limit_buckets (
+    scope TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS limit_slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    model TEXT,
+    user_id INTEGER,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS limit_slots_provider_model ON limit_slots (provider, model);
+CREATE TABLE IF NOT EXISTS limit_waiters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    model TEXT,
+    user_id INTEGER,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS limit_waiters_provider_model ON limit_waiters (provider, model);
@@ -0,0 +1,14 @@
+-- One row per conversation state being answered, so concurrent requests for it share one provider call (see leases.py).
+CREATE TABLE IF NOT EXISTS response_leases (
+    conversation_id INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    owner TEXT NOT NULL, -- the token of the request holding the lease
+    status TEXT NOT NULL, -- 'running', 'done' or 'failed'
+    content TEXT,
+    error TEXT,
+    message_id INTEGER,
+    expires REAL NOT NULL,
+    PRIMARY KEY (conversation_id, last_message_id)
+);
+-- The conversation state a job answers, fixed when it is queued.
+ALTER TABLE jobs ADD COLUMN last_message_id INTEGER;
@@ -0,0 +1,2 @@
+-- How an agent gets the context: 'inline' sends it with the prompt, 'tools' sends a catalogue of the lists and lets the model read them with tool calls (see tools.py).
+ALTER TABLE agents ADD COLUMN context_mode TEXT NOT NULL DEFAULT 'inline';
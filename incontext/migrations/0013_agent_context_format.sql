@@ -0,0 +1,2 @@
+-- How an agent's context is written out in the prompt: one of formats.FORMATS.
+ALTER TABLE agents ADD COLUMN context_format TEXT NOT NULL DEFAULT 'json';
@@ -0,0 +1,81 @@
+-- Full-text search (see search.py). Messages, contexts, lists and agents are indexed from their own
+-- tables (external content); items get a table of their own holding the name and all detail values.
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS contexts_fts USING fts5 (name, description, content='contexts', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS lists_fts USING fts5 (name, description, content='lists', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS agents_fts USING fts5 (name, description, content='agents', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5 (name, details, tokenize='unicode61 remove_diacritics 2');
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS contexts_fts_insert AFTER INSERT ON contexts BEGIN
+    INSERT INTO contexts_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS contexts_fts_delete AFTER DELETE ON contexts BEGIN
+    INSERT INTO contexts_fts (contexts_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS contexts_fts_update AFTER UPDATE OF name, description ON contexts BEGIN
+    INSERT INTO contexts_fts (contexts_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO contexts_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS lists_fts_insert AFTER INSERT ON lists BEGIN
+    INSERT INTO lists_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS lists_fts_delete AFTER DELETE ON lists BEGIN
+    INSERT INTO lists_fts (lists_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS lists_fts_update AFTER UPDATE OF name, description ON lists BEGIN
+    INSERT INTO lists_fts (lists_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO lists_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS agents_fts_insert AFTER INSERT ON agents BEGIN
+    INSERT INTO agents_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS agents_fts_delete AFTER DELETE ON agents BEGIN
+    INSERT INTO agents_fts (agents_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS agents_fts_update AFTER UPDATE OF name, description ON agents BEGIN
+    INSERT INTO agents_fts (agents_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO agents_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, name, details)
+    VALUES (new.id, new.name, (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = new.id));
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+    DELETE FROM items_fts WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name ON items BEGIN
+    UPDATE items_fts SET name = new.name WHERE rowid = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS item_details_fts_insert AFTER INSERT ON item_detail_relations BEGIN
+    UPDATE items_fts SET details = (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = new.item_id) WHERE rowid = new.item_id;
+END;
+CREATE TRIGGER IF NOT EXISTS item_details_fts_delete AFTER DELETE ON item_detail_relations BEGIN
+    UPDATE items_fts SET details = (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = old.item_id) WHERE rowid = old.item_id;
+END;
+CREATE TRIGGER IF NOT EXISTS item_details_fts_update AFTER UPDATE OF item_id, content ON item_detail_relations BEGIN
+    UPDATE items_fts SET details = (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = old.item_id) WHERE rowid = old.item_id;
+    UPDATE items_fts SET details = (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = new.item_id) WHERE rowid = new.item_id;
+END;
+
+-- Index what is already there (the same as `flask search-backfill`).
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+INSERT INTO contexts_fts (contexts_fts) VALUES ('rebuild');
+INSERT INTO lists_fts (lists_fts) VALUES ('rebuild');
+INSERT INTO agents_fts (agents_fts) VALUES ('rebuild');
+DELETE FROM items_fts;
+INSERT INTO items_fts (rowid, name, details)
+SELECT i.id, i.name, (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = i.id) FROM items i;
@@ -0,0 +1,2 @@
+-- Workers touch the heartbeat of the jobs they run, so a job that runs long isn't taken for one lost with its worker (see jobs.py).
+ALTER TABLE jobs ADD COLUMN heartbeat REAL;
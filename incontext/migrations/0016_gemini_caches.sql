@@ -0,0 +1,11 @@
+-- The Gemini cached contents made for the contexts (see providers.get_google_cached_content), shared by the worker processes so each context version is cached once.
+-- One row per model, instructions and context: a new context version replaces the row and its cached content is deleted.
+CREATE TABLE IF NOT EXISTS gemini_caches (
+    model TEXT NOT NULL,
+    instructions TEXT NOT NULL, -- sha256 of the system instruction
+    context_id INTEGER NOT NULL,
+    context_key TEXT NOT NULL, -- the context version the cached content holds
+    name TEXT, -- NULL if creating it failed, in which case it isn't tried again before `expires`
+    expires REAL NOT NULL, -- epoch seconds
+    PRIMARY KEY (model, instructions, context_id)
+);
@@ -0,0 +1,2 @@
+-- After a failed summary, a conversation isn't summarized again before this time (epoch seconds, see summaries.py).
+ALTER TABLE conversations ADD COLUMN summary_retry_after REAL;
@@ -0,0 +1,5 @@
+-- The prompt token budgets of the models the app ships with (their context windows, see MODEL_BUDGETS in db.py). Budgets already set are kept.
+UPDATE agent_models SET context_budget = 1048576 WHERE model_code IN ('gemini-2.0-flash', 'gemini-2.5-pro', 'gemini-2.0-flash-lite') AND context_budget IS NULL;
+UPDATE agent_models SET context_budget = 200000 WHERE model_code IN ('claude-3-5-haiku-latest', 'claude-sonnet-4-0', 'claude-opus-4-0') AND context_budget IS NULL;
+UPDATE agent_models SET context_budget = 128000 WHERE model_code IN ('gpt-4o-mini', 'gpt-4o') AND context_budget IS NULL;
+UPDATE agent_models SET context_budget = 1047576 WHERE model_code = 'gpt-4.1' AND context_budget IS NULL;
@@ -0,0 +1,142 @@
+import math
+
+from flask import current_app
+
+from incontext.metrics import observe
+
+try:
+    import tiktoken # optional: exact counts for OpenAI models
+except ImportError:
+    tiktoken = None
+
+
+MESSAGE_OVERHEAD = 4 # role and framing tokens every provider adds per message
+
+
+class ApproximateTokenizer:
+    '''Counts roughly four characters per token, which holds for English prose. Fast and needs no dependencies.'''
+    def count(self, text):
+        return math.ceil(len(text) / 4)
+
+
+class TiktokenTokenizer:
+    def __init__(self, encoding='o200k_base'):
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+TOKENIZERS = {
+    'approximate': ApproximateTokenizer,
+    'tiktoken': TiktokenTokenizer,
+}
+
+_tokenizers = {}
+
+
+def get_tokenizer(name=None):
+    '''Returns the tokenizer named by `PROMPT_TOKENIZER`. Tokenizers are built once per process.'''
+    name = name or current_app.config['PROMPT_TOKENIZER']
+    if name == 'tiktoken' and tiktoken is None:
+        current_app.logger.warning('tiktoken is not installed. Counting tokens approximately.')
+        name = 'approximate'
+    tokenizer = _tokenizers.get(name)
+    if tokenizer is None:
+        tokenizer = _tokenizers[name] = TOKENIZERS[name]()
+    return tokenizer
+
+
+def count_message(tokenizer, message):
+    return tokenizer.count(message['content']) + MESSAGE_OVERHEAD
+
+
+def keep_tail(counts, budget):
+    '''Returns how many of the latest messages fit in `budget`. The latest message always counts as fitting.'''
+    kept = 0
+    used = 0
+    for count in reversed(counts):
+        if kept and used + count > budget:
+            break
+        used += count
+        kept += 1
+    return kept
+
+
+def sliding_window(messages, counts, budget, tokenizer):
+    '''Keeps the latest turns that fit.'''
+    kept = keep_tail(counts, budget)
+    return messages[len(messages) - kept:]
+
+
+def head_and_tail(messages, counts, budget, tokenizer):
+    '''Keeps the opening turns, which often set up the task, and then the latest turns that fit.'''
+    head = 0
+    used = 0
+    for count in counts[:current_app.config['PROMPT_HEAD_MESSAGES']]:
+        if used + count > budget // 2:
+            break
+        used += count
+        head += 1
+    tail = keep_tail(counts[head:], budget - used)
+    return messages[:head] + messages[len(messages) - tail:]
+
+
+def extractive_summary(messages, counts, budget, tokenizer):
+    '''Keeps the latest turns that fit and replaces the rest with a note made of the start of each dropped turn.'''
+    reserve = min(current_app.config['PROMPT_SUMMARY_TOKENS'], budget // 4)
+    tail = keep_tail(counts, budget - reserve)
+    dropped = messages[:len(messages) - tail]
+    lines = [
+        f"{'User' if message['human'] == 1 else 'Agent'}: {message['content'][:200]}"
+        for message in dropped
+    ]
+    summary = dict(human=1, content='')
+    while lines:
+        summary['content'] = 'Summary of the earlier conversation:\n' + '\n'.join(lines)
+        if count_message(tokenizer, summary) <= reserve:
+            return [summary] + messages[len(dropped):]
+        lines.pop(0) # the oldest turns go first
+    return messages[len(dropped):]
+
+
+POLICIES = {
+    'sliding': sliding_window,
+    'head_tail': head_and_tail,
+    'summary': extractive_summary,
+}
+
+
+def fit_history(messages, budget, tokenizer, policy='sliding'):
+    '''Returns the messages trimmed to `budget` tokens by `policy`. The latest message is always kept.'''
+    counts = [count_message(tokenizer, message) for message in messages]
+    if sum(counts) <= budget:
+        return messages
+    return POLICIES[policy](messages, counts, budget, tokenizer)
+
+
+def get_budget(agent):
+    '''The tokens the prompt may use: the model's budget minus room for the reply.'''
+    config = current_app.config
+    return (agent['context_budget'] or config['PROMPT_BUDGET']) - config['PROMPT_RESPONSE_RESERVE']
+
+
+def assemble_prompt(agent, conversation_id, context_message, messages):
+    '''Returns as much of the conversation as fits the agent's model budget next to the context message, and logs the token counts.'''
+    config = current_app.config
+    tokenizer = get_tokenizer()
+    budget = get_budget(agent)
+    system = f'You are a {agent["role"]}. {agent["instructions"]}'
+    fixed_tokens = tokenizer.count(system) + count_message(tokenizer, context_message) # never trimmed
+    history = fit_history(messages, budget - fixed_tokens, tokenizer, config['PROMPT_HISTORY_POLICY'])
+    history_tokens = sum(count_message(tokenizer, message) for message in history)
+    total = fixed_tokens + history_tokens
+    current_app.logger.info(
+        'Prompt for conversation %s: %d of %d tokens (system and context %d, history %d), %d of %d messages, policy %s',
+        conversation_id, total, budget, fixed_tokens, history_tokens,
+        len(history), len(messages), config['PROMPT_HISTORY_POLICY']
+    )
+    if total > budget:
+        current_app.logger.warning('Prompt for conversation %s is over budget by %d tokens', conversation_id, total - budget)
+    observe('prompt.tokens', total)
+    return history
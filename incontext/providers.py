@@ -0,0 +1,590 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import httpx
+from flask import current_app
+from openai import OpenAI
+import openai
+import anthropic
+from google import genai
+from google.genai import types
+
+from incontext.cache import LRUCache
+from incontext.prompts import get_tokenizer
+from incontext.metrics import incr
+from incontext import resilience
+from incontext.limits import limited, take_slot, with_connection
+
+
+class ClientRegistry:
+    '''Process-wide cache of one long-lived SDK client per provider and API key, safe to share between threads.
+
+    Reusing a client keeps its HTTP connection pool and TLS sessions alive between messages. When a credential rotates, the next call builds a new client and the old one is dropped.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._credentials = {}
+
+    def get_credential(self, name):
+        os_env_var = os.environ.get(name)
+        if os_env_var is not None:
+            return os_env_var
+        credential_path = os.environ.get('CREDENTIALS_DIRECTORY')
+        path = f'{credential_path}/{name}'
+        modified = os.stat(path).st_mtime_ns # a changed file means the credential was rotated.
+        cached = self._credentials.get(path)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        with open(path) as f:
+            credential = f.read().strip()
+        self._credentials[path] = (modified, credential)
+        return credential
+
+    def get_client(self, provider, api_key, options, factory):
+        key = (provider, api_key, options)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                for stale_key in [k for k in self._clients if k[0] == provider]:
+                    del self._clients[stale_key] # in-flight calls keep their reference; the pool closes once they are done.
+                client = factory(api_key, **dict(options))
+                self._clients[key] = client
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self._credentials.clear()
+
+
+clients = ClientRegistry()
+
+
+def get_credential(name):
+    return clients.get_credential(name)
+
+
+def get_client_options(provider):
+    config = current_app.config
+    return (
+        ('timeout', config['PROVIDER_TIMEOUTS'].get(provider, config['PROVIDER_TIMEOUT'])),
+        ('max_connections', config['PROVIDER_MAX_CONNECTIONS']),
+        ('max_keepalive_connections', config['PROVIDER_MAX_KEEPALIVE_CONNECTIONS']),
+        ('base_url', config['PROVIDER_BASE_URLS'].get(provider)),
+    )
+
+
+def make_openai_client(api_key, timeout, max_connections, max_keepalive_connections, base_url):
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=0, # retries are up to resilience.py
+        http_client=openai.DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        ),
+    )
+
+
+def make_anthropic_client(api_key, timeout, max_connections, max_keepalive_connections, base_url):
+    return anthropic.Anthropic(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=0, # retries are up to resilience.py
+        http_client=anthropic.DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        ),
+    )
+
+
+def make_google_client(api_key, timeout, max_connections, max_keepalive_connections, base_url):
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            base_url=base_url,
+            timeout=int(timeout * 1000), # milliseconds
+            client_args=dict(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+            ),
+        ),
+    )
+
+
+def get_openai_client():
+    return clients.get_client('openai', get_credential('OPENAI_API_KEY'), get_client_options('openai'), make_openai_client)
+
+
+def get_anthropic_client():
+    return clients.get_client('anthropic', get_credential('ANTHROPIC_API_KEY'), get_client_options('anthropic'), make_anthropic_client)
+
+
+def get_google_client():
+    return clients.get_client('google', get_credential('GEMINI_API_KEY'), get_client_options('google'), make_google_client)
+
+
+def get_openai_input(conversation_history, agent, chained=False):
+    '''Instructions, then the context, then the conversation. OpenAI caches long prompt prefixes automatically, so the stable parts go first. A `chained` request continues the agent's stored response and sends only the new messages.'''
+    if chained:
+        return conversation_history[-agent['chained_messages']:]
+    return [
+        dict(
+            role='developer',
+            content=f'You are a {agent["role"]}. {agent["instructions"]}',
+        )
+    ] + [
+        dict(role='user', content=context) for context in get_context_blocks(agent)
+    ] + conversation_history
+
+
+def get_openai_options(agent, chained=False):
+    options = dict(model=agent['model_code'])
+    if agent.get('context_key'):
+        options['prompt_cache_key'] = f'context-{agent["context_key"]}' # routes requests with the same context to the same cache
+    if chained:
+        options['previous_response_id'] = agent['previous_response_id']
+        options['truncation'] = 'auto' # drop the oldest stored turns rather than fail once the chain outgrows the window
+    if agent.get('tools'):
+        options['tools'] = [dict(type='function', **tool) for tool in agent['tools']]
+        if agent.get('tool_choice'):
+            options['tool_choice'] = agent['tool_choice']
+    return options
+
+
+def create_openai_response(conversation_history, agent, **options):
+    '''Continues the agent's stored response when it has one, replaying the assembled history if OpenAI no longer has it or the chain no longer fits the model.'''
+    client = get_openai_client()
+    if agent.get('previous_response_id'):
+        try:
+            return client.responses.create(
+                input=get_openai_input(conversation_history, agent, chained=True),
+                **get_openai_options(agent, chained=True),
+                **options
+            )
+        except (openai.NotFoundError, openai.BadRequestError) as e:
+            if not isinstance(e, openai.NotFoundError) and e.param != 'previous_response_id' and e.code != 'context_length_exceeded':
+                raise
+            current_app.logger.warning('Can\'t continue response %s, replaying the conversation: %s', agent['previous_response_id'], e)
+            incr('openai.chain_replays')
+    return client.responses.create(
+        input=get_openai_input(conversation_history, agent),
+        **get_openai_options(agent),
+        **options
+    )
+
+
+def get_openai_usage(usage):
+    if usage is None:
+        return None
+    cached = usage.input_tokens_details.cached_tokens if usage.input_tokens_details else 0
+    return dict(input_tokens=usage.input_tokens, cached_input_tokens=cached or 0, output_tokens=usage.output_tokens)
+
+
+def get_openai_response(conversation_history, agent):
+    response = create_openai_response(conversation_history, agent)
+    result = dict(success=True, content=response.output_text, usage=get_openai_usage(response.usage), response_id=response.id)
+    tool_calls = [
+        dict(id=item.call_id, name=item.name, arguments=json.loads(item.arguments or '{}'))
+        for item in response.output if item.type == 'function_call'
+    ]
+    if tool_calls:
+        result.update(tool_calls=tool_calls, tool_turn=[item.model_dump(exclude_none=True) for item in response.output])
+    return result
+
+
+def stream_openai_response(conversation_history, agent, report=None):
+    stream = create_openai_response(conversation_history, agent, stream=True)
+    for event in stream:
+        if event.type == 'response.output_text.delta':
+            yield event.delta
+        elif event.type == 'response.completed' and report is not None:
+            report['usage'] = get_openai_usage(event.response.usage)
+            report['response_id'] = event.response.id
+
+
+def get_anthropic_system(agent):
+    '''The system prompt, with the context in its own block marked as a cache breakpoint so later turns read it from Anthropic's prompt cache.'''
+    system = [dict(type='text', text=f'You are a {agent["role"]}.')]
+    for context in get_context_blocks(agent):
+        system.append(dict(type='text', text=context, cache_control=dict(type='ephemeral')))
+    return system
+
+
+def get_anthropic_messages(conversation_history, agent):
+    return [
+        dict(
+            role='user',
+            content=agent['instructions']
+        )
+    ] + conversation_history
+
+
+def get_anthropic_usage(usage):
+    if usage is None:
+        return None
+    cached = usage.cache_read_input_tokens or 0
+    written = usage.cache_creation_input_tokens or 0
+    return dict(input_tokens=usage.input_tokens + written + cached, cached_input_tokens=cached, output_tokens=usage.output_tokens)
+
+
+def get_anthropic_tool_options(agent):
+    if not agent.get('tools'):
+        return {}
+    options = dict(tools=[dict(name=tool['name'], description=tool['description'], input_schema=tool['parameters']) for tool in agent['tools']])
+    if agent.get('tool_choice'):
+        options['tool_choice'] = dict(type=agent['tool_choice'])
+    return options
+
+
+def get_anthropic_response(conversation_history, agent):
+    client = get_anthropic_client()
+    response = client.messages.create(
+        model=agent['model_code'],
+        max_tokens=1024,
+        system=get_anthropic_system(agent),
+        messages=get_anthropic_messages(conversation_history, agent),
+        **get_anthropic_tool_options(agent)
+    )
+    content = ''.join(block.text for block in response.content if block.type == 'text')
+    result = dict(success=True, content=content, usage=get_anthropic_usage(response.usage))
+    tool_calls = [dict(id=block.id, name=block.name, arguments=block.input) for block in response.content if block.type == 'tool_use']
+    if tool_calls:
+        result.update(tool_calls=tool_calls, tool_turn=[dict(role='assistant', content=[block.model_dump(exclude_none=True) for block in response.content])])
+    return result
+
+
+def stream_anthropic_response(conversation_history, agent, report=None):
+    client = get_anthropic_client()
+    with client.messages.stream(
+        model=agent['model_code'],
+        max_tokens=1024,
+        system=get_anthropic_system(agent),
+        messages=get_anthropic_messages(conversation_history, agent)
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
+        if report is not None:
+            report['usage'] = get_anthropic_usage(stream.get_final_message().usage)
+
+
+def get_google_caches():
+    return current_app.extensions['google_caches'] # (model, instructions, context id) -> row of gemini_caches
+
+
+def get_google_cached_content(agent, system_instruction):
+    '''Returns the name of a Gemini cached content holding the instructions and the context of the agent's request, creating one per context version. None if the context is too small to cache or caching failed.
+    The cached contents are shared by the worker processes through the `gemini_caches` table. The previous version of a context is deleted once a new one is cached.'''
+    config = current_app.config
+    contexts = get_context_blocks(agent)
+    if not contexts or get_tokenizer().count(contexts[0]) < config['GEMINI_CACHE_MIN_TOKENS']:
+        return None
+    key = (agent['model_code'], hashlib.sha256(system_instruction.encode()).hexdigest(), int(agent['context_key'].split('-')[0]))
+    now = time.time()
+    entry = get_google_caches().get(key)
+    if entry is None or entry['context_key'] != agent['context_key'] or entry['expires'] <= now:
+        entry = with_connection(lambda db: db.execute(
+            "SELECT context_key, name, expires FROM gemini_caches WHERE model = ? AND instructions = ? AND context_id = ?", key
+        ).fetchone()) # another worker may have made it
+    if entry is not None and entry['context_key'] == agent['context_key'] and entry['expires'] > now:
+        get_google_caches().put(key, entry)
+        return entry['name']
+    superseded = entry['name'] if entry is not None and entry['context_key'] != agent['context_key'] else None
+    ttl = config['GEMINI_CACHE_TTL']
+    try:
+        cached_content = get_google_client().caches.create(
+            model=agent['model_code'],
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                contents=[types.Content(role='user', parts=[types.Part(text=contexts[0])])],
+                ttl=f'{ttl}s',
+            )
+        )
+        entry = dict(context_key=agent['context_key'], name=cached_content.name, expires=now + ttl - 60) # stop using it a minute before it expires
+    except Exception as e:
+        current_app.logger.warning('Caching the context for %s failed: %s', agent['model_code'], e)
+        retry_in = config['GEMINI_CACHE_RETRY_SECONDS'] if resilience.is_transient(e) else ttl
+        entry = dict(context_key=agent['context_key'], name=None, expires=now + retry_in) # don't retry on every turn
+    with_connection(lambda db: save_google_cache(db, key, entry))
+    get_google_caches().put(key, entry)
+    if superseded is not None:
+        delete_google_cache(superseded)
+    return entry['name']
+
+
+def save_google_cache(db, key, entry):
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO gemini_caches (model, instructions, context_id, context_key, name, expires) VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, entry['context_key'], entry['name'], entry['expires'])
+        )
+
+
+def delete_google_cache(name):
+    '''Deletes a cached content that was superseded. It would otherwise be paid for until its TTL runs out.'''
+    try:
+        get_google_client().caches.delete(name=name)
+    except Exception as e:
+        current_app.logger.warning('Deleting the cached content %s failed: %s', name, e)
+
+
+def get_google_chat(conversation_history, agent):
+    system_instruction = f'You are a {agent["role"]}. {agent["instructions"]}'
+    cached_content = get_google_cached_content(agent, system_instruction)
+    if cached_content is not None:
+        config = types.GenerateContentConfig(cached_content=cached_content)
+        history = conversation_history[:-1]
+    else:
+        config = types.GenerateContentConfig(system_instruction=system_instruction)
+        history = [dict(role='user', parts=[{'text': context}]) for context in get_context_blocks(agent)] + conversation_history[:-1]
+    return get_google_client().chats.create(
+        model=agent['model_code'],
+        config=config,
+        history=history
+    )
+
+
+def get_google_usage(usage):
+    if usage is None:
+        return None
+    return dict(
+        input_tokens=usage.prompt_token_count or 0,
+        cached_input_tokens=usage.cached_content_token_count or 0,
+        output_tokens=usage.candidates_token_count or 0,
+    )
+
+
+def get_google_tool_config(agent):
+    '''The config of a request with tools. Its context is only the small catalogue of the lists, so it isn't cached.'''
+    config = types.GenerateContentConfig(
+        system_instruction=f'You are a {agent["role"]}. {agent["instructions"]}',
+        tools=[types.Tool(function_declarations=[
+            types.FunctionDeclaration(name=tool['name'], description=tool['description'], parameters_json_schema=tool['parameters'])
+            for tool in agent['tools']
+        ])],
+        automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True), # the tools run in conversations.get_tool_response
+    )
+    if agent.get('tool_choice'):
+        config.tool_config = types.ToolConfig(function_calling_config=types.FunctionCallingConfig(mode=agent['tool_choice'].upper()))
+    return config
+
+
+def get_google_tool_response(conversation_history, agent):
+    response = get_google_client().models.generate_content(
+        model=agent['model_code'],
+        contents=[dict(role='user', parts=[{'text': context}]) for context in get_context_blocks(agent)] + conversation_history,
+        config=get_google_tool_config(agent),
+    )
+    turn = response.candidates[0].content if response.candidates else None
+    parts = (turn.parts or []) if turn is not None else []
+    content = ''.join(part.text for part in parts if part.text and not part.thought)
+    result = dict(success=True, content=content, usage=get_google_usage(response.usage_metadata))
+    tool_calls = [dict(id=call.id, name=call.name, arguments=call.args) for call in response.function_calls or []]
+    if tool_calls:
+        result.update(tool_calls=tool_calls, tool_turn=[turn.model_dump(exclude_none=True)])
+    return result
+
+
+def get_google_response(conversation_history, agent):
+    if agent.get('tools'):
+        return get_google_tool_response(conversation_history, agent)
+    chat = get_google_chat(conversation_history, agent)
+    response = chat.send_message(conversation_history[-1]['parts'][0]['text'])
+    return dict(success=True, content=response.text, usage=get_google_usage(response.usage_metadata))
+
+
+def stream_google_response(conversation_history, agent, report=None):
+    chat = get_google_chat(conversation_history, agent)
+    usage_metadata = None
+    for chunk in chat.send_message_stream(conversation_history[-1]['parts'][0]['text']):
+        usage_metadata = chunk.usage_metadata or usage_metadata # the last chunk has the totals
+        if chunk.text:
+            yield chunk.text
+    if report is not None:
+        report['usage'] = get_google_usage(usage_metadata)
+
+
+def get_fake_response(conversation_history, agent):
+    report = {}
+    content = ''.join(stream_fake_response(conversation_history, agent, report))
+    return dict(success=True, content=content, usage=report['usage'])
+
+
+def stream_fake_response(conversation_history, agent, report=None):
+    '''An offline stand-in for development and tests: echoes the last message back word by word. Agents use it when their model's provider code is "fake". Reports usage as if the context had been cached.'''
+    reply = f'{agent["name"]} heard: {conversation_history[-1]["content"]}'
+    for token in re.findall(r'\s*\S+', reply):
+        yield token
+    if report is not None:
+        tokenizer = get_tokenizer()
+        cached = sum(tokenizer.count(context) for context in get_context_blocks(agent))
+        report['usage'] = dict(
+            input_tokens=cached + sum(tokenizer.count(message['content']) for message in conversation_history),
+            cached_input_tokens=cached,
+            output_tokens=tokenizer.count(reply),
+        )
+
+
+def get_context_blocks(agent):
+    '''The context of the request as a list of zero or one text blocks.'''
+    return [agent['context']] if agent.get('context') else []
+
+
+def format_history(agent, messages):
+    '''Turns messages (dicts with `human` and `content`) into the conversation history shape of the agent's provider.'''
+    provider = agent['provider_code']
+    agent_conversation_role = "model" if provider == "google" else "assistant"
+    conversation_history = []
+    for message in messages:
+        role = 'user' if message['human'] == 1 else agent_conversation_role
+        content = message['content']
+        if provider == 'google':
+            parts = [{'text': content}]
+            conversation_history.append(dict(role=role, parts=parts))
+        else:
+            conversation_history.append(dict(role=role, content=content))
+    return conversation_history
+
+
+def convert_history(conversation_history, agent):
+    '''Reshapes a history made by `format_history` for another provider into the agent's provider's shape.'''
+    messages = [
+        dict(
+            human=1 if message['role'] == 'user' else 0,
+            content=message['parts'][0]['text'] if 'parts' in message else message['content'],
+        )
+        for message in conversation_history
+    ]
+    return format_history(agent, messages)
+
+
+def format_tool_results(agent, tool_calls, results):
+    '''The turn that answers the tool calls of the agent's last reply, in its provider's shape. `results` are the JSON results in the order of `tool_calls`.'''
+    provider = agent['provider_code']
+    if provider == 'openai':
+        return [dict(type='function_call_output', call_id=call['id'], output=result) for call, result in zip(tool_calls, results)]
+    elif provider == 'anthropic':
+        return [dict(role='user', content=[dict(type='tool_result', tool_use_id=call['id'], content=result) for call, result in zip(tool_calls, results)])]
+    elif provider == 'fake':
+        return [dict(role='tool', tool_call_id=call['id'], content=result) for call, result in zip(tool_calls, results)]
+    else:
+        return [dict(role='user', parts=[
+            dict(function_response=dict(id=call['id'], name=call['name'], response=dict(result=result)))
+            for call, result in zip(tool_calls, results)
+        ])]
+
+
+def pin_model(agent, model_id):
+    '''The candidate of the agent's model chain that has `model_id`, without fallbacks. A reply with tool calls has to be continued by the model that made it.'''
+    candidate = next((candidate for candidate in get_model_chain(agent) if candidate.get('model_id') == model_id), agent)
+    return dict(candidate, fallbacks=[])
+
+
+def get_model_chain(agent):
+    '''The agent followed by a copy of it for each of its fallback models, in order. A stored OpenAI response can only be continued by the model that made it.'''
+    chain = [agent]
+    for fallback in agent.get('fallbacks') or []:
+        candidate = dict(
+            agent,
+            model_id=fallback['model_id'],
+            model_name=fallback['model_name'],
+            provider_code=fallback['provider_code'],
+            model_code=fallback['model_code'],
+            context_budget=fallback['context_budget'],
+        )
+        candidate.pop('previous_response_id', None)
+        candidate.pop('chained_messages', None)
+        chain.append(candidate)
+    return chain
+
+
+def count_fallback(agent, candidate, e):
+    incr('fallbacks')
+    incr(f"fallbacks.{candidate['model_code']}")
+    current_app.logger.warning('%s failed for agent %s, falling back to %s: %s', agent['model_code'], agent['id'], candidate['model_code'], e)
+
+
+def get_provider_response(agent, conversation_history):
+    '''Calls the agent's provider through the resilience layer (see resilience.py), then each of its fallback models in turn while they fail. Touches no database resources. Successful responses carry the `model_id` that answered, the token `usage` when the provider reports it and, for OpenAI, the `response_id`. Failures are returned, not raised.'''
+    error = None
+    previous = None
+    for candidate in get_model_chain(agent):
+        if previous is not None:
+            count_fallback(previous, candidate, error)
+        history = conversation_history if candidate['provider_code'] == agent['provider_code'] else convert_history(conversation_history, candidate)
+        try:
+            with limited(candidate): # held across retries, so waiting for it isn't provider latency or failure. A hedged second copy takes a slot of its own.
+                response = resilience.call(candidate['provider_code'], lambda: call_provider(candidate, history), take_slot=lambda: take_slot(candidate))
+        except Exception as e:
+            error = e
+        else:
+            if response['success']:
+                response['model_id'] = candidate.get('model_id')
+                return response
+            error = response['content']
+        previous = candidate
+    return dict(success=False, content=error)
+
+
+def call_provider(agent, conversation_history):
+    provider = agent['provider_code']
+    if provider == 'openai':
+        return get_openai_response(conversation_history, agent)
+    elif provider == 'anthropic':
+        return get_anthropic_response(conversation_history, agent)
+    elif provider == 'fake':
+        return get_fake_response(conversation_history, agent)
+    else:
+        return get_google_response(conversation_history, agent)
+
+
+def stream_provider_response(agent, conversation_history, report=None):
+    '''Yields the reply of the agent's provider as text chunks, retried and then handed to the next fallback model until a first chunk arrives. Errors after that, or of the last model, are raised, not returned. Once the stream is exhausted, `report` (if given) holds the `model_id` that answered, the token `usage` and, for OpenAI, the `response_id`.'''
+    report = {} if report is None else report
+    chain = get_model_chain(agent)
+    for position, candidate in enumerate(chain):
+        history = conversation_history if candidate['provider_code'] == agent['provider_code'] else convert_history(conversation_history, candidate)
+        chunks = limited_stream(candidate, history, report)
+        try:
+            first = next(chunks)
+        except StopIteration:
+            report['model_id'] = candidate.get('model_id')
+            return
+        except Exception as e:
+            if position + 1 == len(chain):
+                raise
+            count_fallback(candidate, chain[position + 1], e)
+            continue
+        report['model_id'] = candidate.get('model_id')
+        yield first
+        yield from chunks
+        return
+
+
+def limited_stream(agent, conversation_history, report):
+    '''Yields the provider's stream through the resilience layer while holding a slot of its limits (see limits.py). The slot is taken on the first `next`.'''
+    with limited(agent):
+        yield from resilience.stream(agent['provider_code'], lambda: open_provider_stream(agent, conversation_history, report))
+
+
+def open_provider_stream(agent, conversation_history, report):
+    provider = agent['provider_code']
+    if provider == 'openai':
+        return stream_openai_response(conversation_history, agent, report)
+    elif provider == 'anthropic':
+        return stream_anthropic_response(conversation_history, agent, report)
+    elif provider == 'fake':
+        return stream_fake_response(conversation_history, agent, report)
+    else:
+        return stream_google_response(conversation_history, agent, report)
+
+
+def init_app(app):
+    app.extensions['google_caches'] = LRUCache(256)
@@ -0,0 +1,314 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+
+import anthropic
+import httpx
+import openai
+from flask import current_app
+
+from incontext.metrics import incr
+
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+TIMEOUT_ERRORS = (TimeoutError, httpx.TimeoutException, openai.APITimeoutError, anthropic.APITimeoutError)
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError, openai.APIConnectionError, anthropic.APIConnectionError)
+
+
+class CircuitOpenError(Exception):
+    '''Raised instead of calling a provider whose circuit breaker is open.'''
+    def __init__(self, provider, retry_in):
+        super().__init__(f'{provider} is unavailable, retrying in {retry_in:.0f}s')
+        self.provider = provider
+
+
+class CircuitBreaker:
+    '''Opens after `threshold` consecutive transient failures and fails fast for `reset_seconds`. Then lets one trial call through: success closes it, failure opens it again. A trial that is abandoned, or not heard from within `reset_seconds`, makes way for another.'''
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''Returns 0 if a call may go ahead, otherwise the seconds until the next trial.'''
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            now = time.monotonic()
+            remaining = self.opened_at + self.reset_seconds - now
+            if self.trial_started is not None:
+                remaining = max(remaining, self.trial_started + self.reset_seconds - now)
+            if remaining > 0:
+                return remaining
+            self.trial_started = now # half open: this caller is the trial
+            return 0
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started = None
+
+    def failure(self):
+        '''Records a transient failure. Returns True if this opened the circuit.'''
+        with self._lock:
+            self.failures += 1
+            was_open = self.opened_at is not None
+            if self.trial_started is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial_started = None
+                return not was_open
+            return False
+
+    def abandon(self):
+        '''Records a call that ended without telling anything about the provider, such as a stream the client closed. If it was the trial, the next caller gets to try.'''
+        with self._lock:
+            self.trial_started = None
+
+
+class LatencyWindow:
+    '''The latest successful call durations of a provider, to pick the hedging delay from.'''
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction, min_samples):
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Resilience:
+    '''Per-process breakers, latency windows and the threads that run the second copies of hedged requests.'''
+    def __init__(self, app):
+        self.app = app
+        self.breakers = {}
+        self.latencies = {}
+        self.executor = ThreadPoolExecutor(max_workers=app.config['HEDGE_WORKERS'], thread_name_prefix='incontext-hedge')
+        self.hedge_workers = threading.BoundedSemaphore(app.config['HEDGE_WORKERS']) # free workers of the executor
+        self._lock = threading.Lock()
+
+    def get_breaker(self, provider):
+        with self._lock:
+            if provider not in self.breakers:
+                config = self.app.config
+                self.breakers[provider] = CircuitBreaker(config['BREAKER_FAILURES'], config['BREAKER_RESET_SECONDS'])
+            return self.breakers[provider]
+
+    def get_latencies(self, provider):
+        with self._lock:
+            return self.latencies.setdefault(provider, LatencyWindow())
+
+
+def get_resilience():
+    return current_app.extensions['resilience']
+
+
+def get_status(e):
+    status = getattr(e, 'status_code', None) # openai and anthropic
+    if status is None and isinstance(getattr(e, 'code', None), int): # google
+        status = e.code
+    return status
+
+
+def is_transient(e):
+    '''Whether the error says more about the provider's health than about the request.'''
+    return isinstance(e, TIMEOUT_ERRORS + CONNECTION_ERRORS) or get_status(e) in RETRYABLE_STATUSES
+
+
+def get_retry_after(e):
+    '''Returns the seconds the provider asked us to wait, or None.'''
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt, e):
+    '''Exponential backoff with full jitter, but never sooner than the provider's retry-after. None means don't retry.'''
+    config = current_app.config
+    delay = random.uniform(0, min(config['RETRY_MAX_DELAY'], config['RETRY_BASE_DELAY'] * 2 ** attempt))
+    retry_after = get_retry_after(e)
+    if retry_after is not None:
+        if retry_after > config['RETRY_AFTER_MAX']:
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+
+def count_failure(provider, breaker, e):
+    incr(f'resilience.{provider}.failures')
+    if isinstance(e, TIMEOUT_ERRORS):
+        incr(f'resilience.{provider}.timeouts')
+    if not is_transient(e):
+        breaker.success() # the provider answered, the request was at fault
+    elif breaker.failure():
+        incr(f'resilience.{provider}.breaker_opened')
+        current_app.logger.warning('Circuit breaker for %s opened after: %s', provider, e)
+
+
+def check_breaker(provider, breaker):
+    retry_in = breaker.allow()
+    if retry_in:
+        incr(f'resilience.{provider}.short_circuits')
+        raise CircuitOpenError(provider, retry_in)
+
+
+def call(provider, fn, take_slot=None):
+    '''Calls `fn` with retries on transient errors, hedging and the provider's circuit breaker. Raises the last error. `take_slot` is what a hedged second copy takes before it runs (see `start_hedge`).'''
+    resilience = get_resilience()
+    breaker = resilience.get_breaker(provider)
+    attempts = current_app.config['RETRY_MAX_ATTEMPTS']
+    for attempt in range(attempts):
+        check_breaker(provider, breaker)
+        started = time.monotonic()
+        try:
+            result = hedge(provider, fn, take_slot)
+        except Exception as e:
+            count_failure(provider, breaker, e)
+            delay = get_backoff(attempt, e) if is_transient(e) and attempt + 1 < attempts else None
+            if delay is None:
+                raise
+            incr(f'resilience.{provider}.retries')
+            time.sleep(delay)
+            continue
+        breaker.success()
+        resilience.get_latencies(provider).add(time.monotonic() - started)
+        return result
+
+
+def hedge(provider, fn, take_slot=None):
+    '''Runs `fn`, and a second copy if the first is slower than the `HEDGE_PERCENTILE` of recent calls. Returns whichever succeeds first.
+    The first copy gets a thread of its own, so it starts right away and the caller is free to return the second copy's answer. The second copy runs on the hedge pool, and only if one of its workers is free.'''
+    config = current_app.config
+    resilience = get_resilience()
+    delay = None
+    if config['HEDGE_PERCENTILE']:
+        delay = resilience.get_latencies(provider).percentile(config['HEDGE_PERCENTILE'], config['HEDGE_MIN_SAMPLES'])
+    if delay is None:
+        return fn()
+    app = current_app._get_current_object()
+
+    def run(future):
+        with app.app_context():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+    primary = Future()
+    threading.Thread(target=run, args=(primary,), name='incontext-call', daemon=True).start()
+    pending = {primary}
+    hedged = None
+    done, _ = wait(pending, timeout=delay)
+    if not done:
+        hedged = start_hedge(provider, run, take_slot)
+        if hedged is not None:
+            pending.add(hedged)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedged:
+                    incr(f'resilience.{provider}.hedge_wins')
+                return future.result() # a slower copy still running is left to finish on its own
+            error = future.exception()
+    raise error
+
+
+def start_hedge(provider, run, take_slot=None):
+    '''Submits the second copy of a call to the hedge pool. Returns its future, or None if every worker is busy: a queued copy would only add load.
+    `take_slot`, if given, is called first and returns a function that frees whatever it took, or None to skip the copy. The provider limits use it, so a second copy never runs past them (see limits.take_slot).'''
+    resilience = get_resilience()
+    if not resilience.hedge_workers.acquire(blocking=False):
+        incr(f'resilience.{provider}.hedges_skipped')
+        return None
+    free_slot = take_slot() if take_slot is not None else None
+    if take_slot is not None and free_slot is None:
+        resilience.hedge_workers.release()
+        incr(f'resilience.{provider}.hedges_skipped')
+        return None
+    incr(f'resilience.{provider}.hedges')
+    app = current_app._get_current_object()
+    future = Future()
+
+    def run_hedge():
+        try:
+            run(future)
+        finally:
+            if free_slot is not None:
+                with app.app_context():
+                    free_slot()
+            resilience.hedge_workers.release()
+
+    resilience.executor.submit(run_hedge)
+    return future
+
+
+def stream(provider, make_stream):
+    '''Yields from the stream `make_stream` returns, retrying while nothing has been yielded yet. Streams aren't hedged.'''
+    resilience = get_resilience()
+    breaker = resilience.get_breaker(provider)
+    attempts = current_app.config['RETRY_MAX_ATTEMPTS']
+    for attempt in range(attempts):
+        check_breaker(provider, breaker)
+        chunks = make_stream()
+        try:
+            first = next(chunks) # the request is made here
+        except StopIteration:
+            breaker.success()
+            return
+        except Exception as e:
+            count_failure(provider, breaker, e)
+            delay = get_backoff(attempt, e) if is_transient(e) and attempt + 1 < attempts else None
+            if delay is None:
+                raise
+            incr(f'resilience.{provider}.retries')
+            time.sleep(delay)
+            continue
+        break
+    finished = False
+    try:
+        yield first
+        yield from chunks
+        finished = True
+    except Exception as e:
+        finished = True
+        count_failure(provider, breaker, e)
+        raise
+    finally:
+        if not finished:
+            breaker.abandon() # closed early, e.g. the client went away
+    breaker.success()
+
+
+def init_app(app):
+    app.extensions['resilience'] = Resilience(app)
@@ -0,0 +1,179 @@
+import json
+import math
+import re
+import threading
+
+from flask import current_app
+
+from incontext.cache import LRUCache
+from incontext.metrics import incr, observe
+from incontext.prompts import get_tokenizer
+
+try:
+    import numpy as np # optional: needed for `CONTEXT_RETRIEVAL`. `pip install incontext[retrieval]`
+except ImportError:
+    np = None
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TERM = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TERM.findall(text.lower())
+
+
+def get_item_text(item, details):
+    '''What an item is found by: its name and its detail values.'''
+    return ' '.join([item['name']] + [item.get(detail['name']) or '' for detail in details])
+
+
+class LexicalIndex:
+    '''A BM25 index over the items of one context.
+
+    Refreshing from a new payload only tokenizes the items whose text changed. Term ids are never reused, so an item's term arrays stay valid until its text changes. The postings are then rebuilt from those arrays with a few NumPy operations, and scoring a query is vectorized over them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.payload = []
+        self.vocabulary = {}
+        self.docs = {} # item id -> (text, term ids, term frequencies, length)
+        self.item_ids = np.zeros(0, dtype=np.int64)
+
+    def refresh(self, version, payload):
+        '''Brings the index up to the context's `payload` at `version`. Returns the number of items that were (re)tokenized.'''
+        docs = {}
+        tokenized = 0
+        for alist in payload:
+            for item in alist['items']:
+                text = get_item_text(item, alist['details'])
+                doc = self.docs.get(item['id'])
+                if doc is None or doc[0] != text:
+                    doc = self.add_doc(text)
+                    tokenized += 1
+                docs[item['id']] = doc
+        self.docs = docs
+        self.payload = payload
+        self.version = version
+        self.compile()
+        return tokenized
+
+    def add_doc(self, text):
+        terms = {}
+        for token in tokenize(text):
+            term_id = self.vocabulary.setdefault(token, len(self.vocabulary))
+            terms[term_id] = terms.get(term_id, 0) + 1
+        term_ids = np.fromiter(terms.keys(), dtype=np.int64, count=len(terms))
+        frequencies = np.fromiter(terms.values(), dtype=np.float64, count=len(terms))
+        return text, term_ids, frequencies, float(frequencies.sum())
+
+    def compile(self):
+        '''Builds the postings, sorted by term id, from the term arrays of every item.'''
+        self.item_ids = np.fromiter(self.docs.keys(), dtype=np.int64, count=len(self.docs))
+        docs = list(self.docs.values())
+        self.lengths = np.array([doc[3] for doc in docs], dtype=np.float64)
+        counts = np.array([len(doc[1]) for doc in docs], dtype=np.int64)
+        if docs:
+            terms = np.concatenate([doc[1] for doc in docs])
+            frequencies = np.concatenate([doc[2] for doc in docs])
+        else:
+            terms = np.zeros(0, dtype=np.int64)
+            frequencies = np.zeros(0, dtype=np.float64)
+        positions = np.repeat(np.arange(len(docs)), counts)
+        order = np.argsort(terms, kind='stable')
+        self.posting_terms = terms[order]
+        self.posting_docs = positions[order]
+        self.posting_frequencies = frequencies[order]
+        self.average_length = self.lengths.mean() if docs else 0.0
+
+    def score(self, query):
+        '''Returns the BM25 score of every item, in the order of `item_ids`.'''
+        scores = np.zeros(len(self.item_ids), dtype=np.float64)
+        term_ids = sorted({self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary})
+        if not term_ids or not len(scores):
+            return scores
+        term_ids = np.array(term_ids, dtype=np.int64)
+        starts = np.searchsorted(self.posting_terms, term_ids, side='left')
+        ends = np.searchsorted(self.posting_terms, term_ids, side='right')
+        n = len(self.item_ids)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / (self.average_length or 1.0))
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue # the term only occurred in items that are gone
+            docs = self.posting_docs[start:end]
+            frequencies = self.posting_frequencies[start:end]
+            df = end - start
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm[docs])
+        return scores
+
+    def select(self, query, top_k, budget, tokenizer):
+        '''Returns a copy of the payload with only the items that best match `query`: at most `top_k` per list, and as many as fit in `budget` tokens, best first. If nothing matches, the first items of each list are sent instead.'''
+        scores = self.score(query)
+        by_item = dict(zip(self.item_ids.tolist(), scores.tolist()))
+        matched = any(score > 0 for score in by_item.values())
+        candidates = []
+        for list_index, alist in enumerate(self.payload):
+            ranked = [
+                (by_item.get(item['id'], 0.0), position, item)
+                for position, item in enumerate(alist['items'])
+                if by_item.get(item['id'], 0.0) > 0 or not matched
+            ]
+            ranked.sort(key=lambda c: (-c[0], c[1]))
+            candidates.extend((score, list_index, position, item) for score, position, item in ranked[:top_k])
+        candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+        used = sum(tokenizer.count(json.dumps(alist['details'])) for alist in self.payload)
+        kept = set()
+        for score, list_index, position, item in candidates:
+            cost = tokenizer.count(json.dumps(item))
+            if used + cost > budget:
+                continue
+            used += cost
+            kept.add((list_index, position))
+        selected = []
+        for list_index, alist in enumerate(self.payload):
+            items = [item for position, item in enumerate(alist['items']) if (list_index, position) in kept]
+            selected.append(dict(alist, items=items, total_items=len(alist['items'])))
+        return selected
+
+
+def get_indexes():
+    return current_app.extensions['retrieval_indexes']
+
+
+def get_index(context_id, version, load_payload):
+    '''Returns the index of the context, refreshed to `version` with `load_payload()` if it is behind.'''
+    indexes = get_indexes()
+    index = indexes.get(context_id)
+    if index is None:
+        index = LexicalIndex()
+        indexes.put(context_id, index)
+    with index.lock:
+        if index.version != version:
+            tokenized = index.refresh(version, load_payload())
+            incr('retrieval.refreshes')
+            incr('retrieval.tokenized', tokenized)
+    return index
+
+
+def is_enabled():
+    return current_app.config['CONTEXT_RETRIEVAL'] and np is not None # warned about in init_app
+
+
+def select_context(context_id, version, load_payload, query):
+    '''Returns the context payload cut down to the items relevant to `query`, per `RETRIEVAL_TOP_K` and `RETRIEVAL_BUDGET`.'''
+    config = current_app.config
+    index = get_index(context_id, version, load_payload)
+    with index.lock:
+        selected = index.select(query, config['RETRIEVAL_TOP_K'], config['RETRIEVAL_BUDGET'], get_tokenizer())
+    observe('retrieval.items', sum(len(alist['items']) for alist in selected))
+    return selected
+
+
+def init_app(app):
+    app.extensions['retrieval_indexes'] = LRUCache(app.config['RETRIEVAL_INDEX_SIZE'])
+    if app.config['CONTEXT_RETRIEVAL'] and np is None:
+        app.logger.warning('CONTEXT_RETRIEVAL is on but numpy is not installed (pip install incontext[retrieval]). Sending the whole context.')
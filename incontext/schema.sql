@@ -13,6 +13,22 @@ DROP TABLE IF EXISTS agent_models;
 DROP TABLE IF EXISTS conversations;
 DROP TABLE IF EXISTS messages;
 DROP TABLE IF EXISTS conversation_agent_relations;
+DROP TABLE IF EXISTS context_versions;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS conversation_summaries;
+DROP TABLE IF EXISTS agent_fallbacks;
+DROP TABLE IF EXISTS limit_buckets;
+DROP TABLE IF EXISTS limit_slots;
+DROP TABLE IF EXISTS limit_waiters;
+DROP TABLE IF EXISTS response_leases;
+DROP TABLE IF EXISTS idempotency_keys;
+DROP TABLE IF EXISTS gemini_caches;
+DROP TABLE IF EXISTS messages_fts;
+DROP TABLE IF EXISTS contexts_fts;
+DROP TABLE IF EXISTS lists_fts;
+DROP TABLE IF EXISTS agents_fts;
+DROP TABLE IF EXISTS items_fts;
+DROP TABLE IF EXISTS schema_version;
 
 
 CREATE TABLE users (
@@ -0,0 +1,157 @@
+import click
+from flask import Blueprint, g, jsonify, render_template, request, url_for
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+
+from incontext.auth import login_required
+from incontext.db import get_db
+from incontext.lists import get_page_size
+
+
+bp = Blueprint('search', __name__, url_prefix='/search')
+
+
+# What can be searched, each as a query of its FTS5 table (see migrations/0014_search.sql) that keeps to the user's own rows.
+# Names weigh more than descriptions and detail values in the ranking.
+KINDS = {
+    'context': (
+        "SELECT 'context' AS kind, c.id, c.name AS title, NULL AS list_id, NULL AS context_id,"
+        " snippet(contexts_fts, -1, char(2), char(3), '…', 12) AS snippet, bm25(contexts_fts, 5.0, 1.0) AS rank"
+        " FROM contexts_fts JOIN contexts c ON c.id = contexts_fts.rowid"
+        " WHERE contexts_fts MATCH ? AND c.creator_id = ?"
+    ),
+    'list': (
+        "SELECT 'list' AS kind, l.id, l.name AS title, NULL AS list_id, NULL AS context_id,"
+        " snippet(lists_fts, -1, char(2), char(3), '…', 12) AS snippet, bm25(lists_fts, 5.0, 1.0) AS rank"
+        " FROM lists_fts JOIN lists l ON l.id = lists_fts.rowid"
+        " WHERE lists_fts MATCH ? AND l.creator_id = ?"
+    ),
+    'item': (
+        "SELECT 'item' AS kind, i.id, i.name AS title, r.list_id, NULL AS context_id,"
+        " snippet(items_fts, -1, char(2), char(3), '…', 12) AS snippet, bm25(items_fts, 5.0, 1.0) AS rank"
+        " FROM items_fts JOIN items i ON i.id = items_fts.rowid"
+        " JOIN list_item_relations r ON r.item_id = i.id"
+        " WHERE items_fts MATCH ? AND i.creator_id = ?"
+    ),
+    'agent': (
+        "SELECT 'agent' AS kind, a.id, a.name AS title, NULL AS list_id, NULL AS context_id,"
+        " snippet(agents_fts, -1, char(2), char(3), '…', 12) AS snippet, bm25(agents_fts, 5.0, 1.0) AS rank"
+        " FROM agents_fts JOIN agents a ON a.id = agents_fts.rowid"
+        " WHERE agents_fts MATCH ? AND a.creator_id = ?"
+    ),
+    'message': (
+        "SELECT 'message' AS kind, m.id, cv.name AS title, NULL AS list_id, c.id AS context_id,"
+        " snippet(messages_fts, -1, char(2), char(3), '…', 12) AS snippet, bm25(messages_fts) AS rank"
+        " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        " JOIN conversations cv ON cv.id = m.conversation_id"
+        " JOIN context_conversation_relations ccr ON ccr.conversation_id = m.conversation_id"
+        " JOIN contexts c ON c.id = ccr.context_id"
+        " WHERE messages_fts MATCH ? AND c.creator_id = ?"
+    ),
+}
+
+
+@bp.route('/')
+@login_required
+def index():
+    q = request.args.get('q', '')
+    kinds = get_kinds()
+    results = search(g.user['id'], q, kinds, get_page_size('SEARCH_PAGE_SIZE', 'SEARCH_PAGE_SIZE_MAX'))
+    return render_template('search/index.html', q=q, kinds=kinds, results=results)
+
+
+@bp.route('/api')
+@login_required
+def api():
+    results = search(g.user['id'], request.args.get('q', ''), get_kinds(), get_page_size('SEARCH_PAGE_SIZE', 'SEARCH_PAGE_SIZE_MAX'))
+    return jsonify(results=[dict(result, snippet=str(result['snippet'])) for result in results])
+
+
+def get_kinds():
+    '''The kinds asked for with `kind` (may be repeated), or all of them.'''
+    kinds = [kind for kind in request.args.getlist('kind') if kind in KINDS]
+    return kinds or list(KINDS)
+
+
+def get_match_query(q):
+    '''Turns what the user typed into an FTS5 query: every word has to match, the last one as a prefix so results come while typing.
+    The words are quoted, so FTS5 syntax (AND, NEAR, column filters, stray quotes) is searched for as text instead of failing.'''
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(user_id, q, kinds=None, limit=20):
+    '''The user's contexts, lists, items, agents and messages matching `q`, best first.'''
+    match = get_match_query(q)
+    if match is None:
+        return []
+    kinds = kinds or list(KINDS)
+    params = []
+    for kind in kinds:
+        params.extend((match, user_id))
+    db = get_db()
+    rows = db.execute(
+        ' UNION ALL '.join(KINDS[kind] for kind in kinds) +
+        ' ORDER BY rank LIMIT ?',
+        (*params, limit)
+    ).fetchall()
+    return [
+        dict(
+            kind=row['kind'],
+            id=row['id'],
+            title=row['title'],
+            snippet=highlight(row['snippet']),
+            url=get_url(row),
+            rank=row['rank'],
+        )
+        for row in rows
+    ]
+
+
+def highlight(snippet):
+    '''Escapes the snippet and marks the matched words, which snippet() wrapped in control characters.'''
+    return Markup(str(escape(snippet or '')).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+
+def get_url(row):
+    if row['kind'] == 'context':
+        return url_for('contexts.view', context_id=row['id'])
+    if row['kind'] == 'list':
+        return url_for('lists.view', list_id=row['id'])
+    if row['kind'] == 'item':
+        return url_for('lists.view_item', list_id=row['list_id'], item_id=row['id'])
+    if row['kind'] == 'agent':
+        return url_for('agents.view', agent_id=row['id'])
+    return url_for('contexts.view', context_id=row['context_id'])
+
+
+def backfill():
+    '''Rebuilds every search index from its table.'''
+    db = get_db()
+    db.executescript(
+        "BEGIN;"
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');"
+        "INSERT INTO contexts_fts (contexts_fts) VALUES ('rebuild');"
+        "INSERT INTO lists_fts (lists_fts) VALUES ('rebuild');"
+        "INSERT INTO agents_fts (agents_fts) VALUES ('rebuild');"
+        "DELETE FROM items_fts;"
+        "INSERT INTO items_fts (rowid, name, details)"
+        " SELECT i.id, i.name, (SELECT group_concat(content, ' ') FROM item_detail_relations WHERE item_id = i.id) FROM items i;"
+        "INSERT INTO items_fts (items_fts) VALUES ('optimize');"
+        "COMMIT;"
+    )
+
+
+@click.command('search-backfill')
+@with_appcontext
+def search_backfill_command():
+    '''Index the existing data for search, e.g. after restoring a database.'''
+    backfill()
+    click.echo('Rebuilt the search index.')
+
+
+def init_app(app):
+    app.cli.add_command(search_backfill_command)
@@ -0,0 +1,85 @@
+import time
+
+from flask import current_app
+
+from incontext.db import get_db, release_db
+from incontext.metrics import incr
+from incontext.prompts import get_tokenizer, count_message, keep_tail
+from incontext.providers import get_provider_response, format_history
+
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below for your own future reference."
+    " Keep names, facts, decisions and open questions. Leave out pleasantries."
+    " Reply with the summary only."
+)
+
+
+def get_summary(conversation_id):
+    '''Returns the latest summary of a conversation, or None.'''
+    return get_db().execute(
+        "SELECT id, first_message_id, last_message_id, content FROM conversation_summaries"
+        " WHERE conversation_id = ?"
+        " ORDER BY last_message_id DESC LIMIT 1",
+        (conversation_id,)
+    ).fetchone()
+
+
+def get_summary_message(summary):
+    return dict(human=1, content=f"Summary of the earlier conversation: {summary['content']}")
+
+
+def get_summary_request(previous, messages):
+    lines = [f"{'User' if message['human'] == 1 else 'Agent'}: {message['content']}" for message in messages]
+    if previous is not None:
+        lines.insert(0, f"Earlier summary: {previous['content']}")
+    return dict(human=1, content=SUMMARY_INSTRUCTIONS + "\n\n" + "\n".join(lines))
+
+
+def compact_conversation(agent, conversation_id, summary, messages):
+    '''Folds older messages into the conversation's summary once the messages not yet summarized pass `SUMMARY_THRESHOLD` tokens.
+
+    `messages` are those after the summary. The new summary extends the previous one with the messages that fell out of the latest `SUMMARY_RECENT_TOKENS`, so each message is summarized once. Returns (summary, messages still to send in full).
+    After a failure the conversation is sent in full for `SUMMARY_RETRY_SECONDS` rather than summarized before every reply.
+    '''
+    config = current_app.config
+    tokenizer = get_tokenizer()
+    counts = [count_message(tokenizer, message) for message in messages]
+    if not config['SUMMARY_THRESHOLD'] or sum(counts) <= config['SUMMARY_THRESHOLD']:
+        return summary, messages
+    recent = keep_tail(counts, config['SUMMARY_RECENT_TOKENS'])
+    older = messages[:len(messages) - recent]
+    if not older:
+        return summary, messages
+    db = get_db()
+    retry_after = db.execute("SELECT summary_retry_after FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    if retry_after is not None and (retry_after['summary_retry_after'] or 0) > time.time():
+        incr('summaries.backed_off')
+        return summary, messages
+    release_db() # the agent can take a while
+    response = get_provider_response(agent, format_history(agent, [get_summary_request(summary, older)]))
+    db = get_db()
+    if not response['success']:
+        current_app.logger.warning('Summarizing conversation %s failed: %s', conversation_id, response['content'])
+        incr('summaries.failed')
+        db.execute(
+            "UPDATE conversations SET summary_retry_after = ? WHERE id = ?",
+            (time.time() + config['SUMMARY_RETRY_SECONDS'], conversation_id)
+        )
+        db.commit()
+        return summary, messages
+    first_message_id = summary['first_message_id'] if summary is not None else older[0]['id']
+    cur = db.execute(
+        "INSERT INTO conversation_summaries (conversation_id, first_message_id, last_message_id, content)"
+        " SELECT ?, ?, ?, ?"
+        " WHERE NOT EXISTS (SELECT 1 FROM conversation_summaries WHERE conversation_id = ? AND last_message_id >= ?)",
+        (conversation_id, first_message_id, older[-1]['id'], response['content'], conversation_id, older[-1]['id'])
+    )
+    db.commit()
+    if cur.rowcount != 1:
+        incr('summaries.duplicates') # a concurrent request summarized as far or further first
+        summary = get_summary(conversation_id)
+        return summary, [message for message in messages if message['id'] > summary['last_message_id']]
+    incr('summaries.created')
+    summary = dict(id=cur.lastrowid, first_message_id=first_message_id, last_message_id=older[-1]['id'], content=response['content'])
+    return summary, messages[len(older):]
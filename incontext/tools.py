@@ -0,0 +1,128 @@
+import json
+
+from flask import current_app
+
+from incontext.db import release_db
+from incontext.lists import (
+    get_context_lists, get_list_details, get_list_items_by_id, get_list_with_items_and_details, is_context_list, search_list_items
+)
+from incontext.metrics import incr
+
+
+# The tools an agent in the "tools" context mode can call, as JSON schema. providers.py turns them into each provider's format.
+TOOLS = [
+    dict(
+        name="list_lists",
+        description="Lists the lists of the context with their id, name, description and number of items.",
+        parameters=dict(type="object", properties={}, required=[]),
+    ),
+    dict(
+        name="get_list_schema",
+        description="Returns the details (the columns) of a list. Every item has a value for each detail.",
+        parameters=dict(
+            type="object",
+            properties=dict(list_id=dict(type="integer", description="The id of the list.")),
+            required=["list_id"],
+        ),
+    ),
+    dict(
+        name="search_items",
+        description="Finds the items of a list whose name or detail values contain every word of the query, ignoring case.",
+        parameters=dict(
+            type="object",
+            properties=dict(
+                list_id=dict(type="integer", description="The id of the list."),
+                query=dict(type="string", description="The words to look for."),
+            ),
+            required=["list_id", "query"],
+        ),
+    ),
+    dict(
+        name="get_items",
+        description="Returns items of a list with their detail values: the items with the given ids, or else a page of the list. Pass the returned next_after to get the next page.",
+        parameters=dict(
+            type="object",
+            properties=dict(
+                list_id=dict(type="integer", description="The id of the list."),
+                item_ids=dict(type="array", items=dict(type="integer"), description="The ids of the items to get."),
+                after=dict(type="integer", description="Get the page of items after this item id."),
+            ),
+            required=["list_id"],
+        ),
+    ),
+]
+
+
+class ToolError(Exception):
+    '''A tool call the model got wrong. The message is sent back to the model so it can try again.'''
+
+
+def get_catalogue(context_id):
+    '''What the prompt carries in place of the context: the lists the tools can read.'''
+    return json.dumps(get_context_lists(context_id))
+
+
+def run_tool(context_id, name, arguments):
+    '''Runs a tool call of the model against the context and returns the result as JSON. Lists outside the context can't be read.'''
+    incr(f"tools.{name}")
+    try:
+        result = call_tool(context_id, name, arguments or {})
+    except ToolError as e:
+        incr("tools.errors")
+        result = dict(error=str(e))
+    finally:
+        release_db() # the model's next step may take a while
+    return json.dumps(result)
+
+
+def call_tool(context_id, name, arguments):
+    if name == "list_lists":
+        return get_context_lists(context_id)
+    list_id = get_list_id(context_id, arguments)
+    if name == "get_list_schema":
+        return get_list_details(list_id, check_creator=False)
+    page_size = current_app.config["TOOL_PAGE_SIZE"]
+    details = get_list_details(list_id, check_creator=False)
+    if name == "search_items":
+        item_ids = search_list_items(list_id, str(arguments.get("query") or ""), page_size)
+        return dict(items=format_items(get_list_items_by_id(list_id, item_ids, details)))
+    if name == "get_items":
+        if arguments.get("item_ids"):
+            item_ids = get_int_list(arguments["item_ids"])[:page_size]
+            return dict(items=format_items(get_list_items_by_id(list_id, item_ids, details)))
+        alist = get_list_with_items_and_details(list_id, check_creator=False, after=get_int(arguments.get("after"), "after"), limit=page_size)
+        return dict(items=format_items(alist["items"]), next_after=alist["next_after"])
+    raise ToolError(f"There is no tool named {name}.")
+
+
+def get_list_id(context_id, arguments):
+    list_id = get_int(arguments.get("list_id"), "list_id")
+    if list_id is None or not is_context_list(context_id, list_id):
+        raise ToolError(f"There is no list with id {arguments.get('list_id')} in this context.")
+    return list_id
+
+
+def get_int(value, name):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ToolError(f"{name} must be an integer.")
+
+
+def get_int_list(values):
+    if not isinstance(values, list):
+        raise ToolError("item_ids must be a list of integers.")
+    return [get_int(value, "item_ids") for value in values]
+
+
+def format_items(items):
+    '''Items the way the inline context has them: detail values keyed by detail name.'''
+    formatted = []
+    for item in items:
+        values = dict(id=item["id"], name=item["name"], created=item["created"].strftime("%Y-%m-%d"))
+        for relation in item["relations"]:
+            values[relation["name"]] = relation["content"]
+        formatted.append(values)
+    return formatted
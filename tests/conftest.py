@@ -25,6 +25,9 @@ def app():
 
     yield app
 
+    if 'jobs' in app.extensions:
+        app.extensions['jobs'].shutdown() # let background jobs finish before the database goes away.
+    app.extensions['db'].close_all() # close the persistent connections so SQLite removes its -wal and -shm files.
     os.close(db_fd) # test is over. close and remove the temp file.
     os.unlink(db_path)
 
@@ -32,6 +35,10 @@ def app():
 def client(app): # that's the application object created by the app fixture.
     return app.test_client() # this creates a test client for the app which will make requests to the app without running the server.
 
+@pytest.fixture
+def counters(app):
+    return lambda: app.extensions['metrics'].snapshot()['counters'] # the metric counters as they are when called.
+
 @pytest.fixture
 def runner(app):
     return app.test_cli_runner() # so that the Click commands can be called.
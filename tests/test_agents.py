@@ -367,3 +367,66 @@ def test_delete(client, auth, app):
             else:
                 assert agent in agents_after
         assert len(agents_after) == len(agents_before) - deletion_count
+
+
+def test_fallbacks(app, client, auth):
+    auth.login()
+    data = dict(
+        name="agent name 1", description="agent description 1", model_id="1",
+        role="agent role 1", instructions="agent instructions 1",
+    )
+    # Blanks, unknown models, repeats and the agent's own model are skipped
+    client.post("/agents/1/edit", data=dict(data, fallback_model_id=["3", "", "1", "bogus", "999", "2", "3"]))
+    with app.app_context():
+        from incontext.agents import get_agent_fallbacks
+        assert [fallback["model_id"] for fallback in get_agent_fallbacks(1)] == [3, 2]
+    response = client.get("/agents/1/edit")
+    assert b'<option value="3" selected>' in response.data
+    assert b'<option value="2" selected>' in response.data
+    response = client.get("/agents/1/view")
+    assert b"Fallbacks: " in response.data
+    # Saving without fallbacks clears them
+    client.post("/agents/1/edit", data=data)
+    with app.app_context():
+        assert get_agent_fallbacks(1) == []
+        # A new agent can have them too, and deleting it removes them
+        client.post("/agents/new", data=dict(data, name="new agent", fallback_model_id=["2"]))
+        agent_id = get_db().execute("SELECT id FROM agents WHERE name = 'new agent'").fetchone()["id"]
+        assert [fallback["model_id"] for fallback in get_agent_fallbacks(agent_id)] == [2]
+        client.post(f"/agents/{agent_id}/delete")
+        assert get_agent_fallbacks(agent_id) == []
+
+
+def test_context_mode(app, client, auth):
+    auth.login()
+    data = dict(
+        name="agent name 1", description="agent description 1", model_id="1",
+        role="agent role 1", instructions="agent instructions 1",
+    )
+    assert b'<option value="inline" selected>' in client.get("/agents/1/edit").data
+    client.post("/agents/1/edit", data=dict(data, context_mode="tools"))
+    with app.app_context():
+        assert get_db().execute("SELECT context_mode FROM agents WHERE id = 1").fetchone()["context_mode"] == "tools"
+    assert b'<option value="tools" selected>' in client.get("/agents/1/edit").data
+    assert b"Looked up with tools" in client.get("/agents/1/view").data
+    # Unknown modes, or none, mean inline
+    client.post("/agents/1/edit", data=dict(data, context_mode="bogus"))
+    client.post("/agents/new", data=dict(data, name="new agent"))
+    with app.app_context():
+        modes = get_db().execute("SELECT context_mode FROM agents WHERE id = 1 OR name = 'new agent'").fetchall()
+        assert modes == [dict(context_mode="inline")] * 2
+
+
+def test_context_format(app, client, auth):
+    auth.login()
+    data = dict(
+        name="agent name 1", description="agent description 1", model_id="1",
+        role="agent role 1", instructions="agent instructions 1",
+    )
+    assert b'<option value="json" selected>' in client.get("/agents/1/edit").data
+    client.post("/agents/1/edit", data=dict(data, context_format="tsv"))
+    assert b'<option value="tsv" selected>' in client.get("/agents/1/edit").data
+    assert b"Context format: </b>tsv" in client.get("/agents/1/view").data
+    client.post("/agents/1/edit", data=dict(data, context_format="bogus"))
+    with app.app_context():
+        assert get_db().execute("SELECT context_format FROM agents WHERE id = 1").fetchone()["context_format"] == "json"
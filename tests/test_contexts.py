@@ -1,8 +1,8 @@
 import pytest
 from incontext.db import get_db, dict_factory
 from incontext.lists import get_user_lists
-from incontext.contexts import get_unrelated_lists
-from tests.test_db import get_other_tables
+from incontext.contexts import get_unrelated_lists, get_context_conversations
+from tests.test_db import get_other_tables, count_queries
 
 
 def test_index(app, client, auth):
@@ -462,3 +462,59 @@ def test_remove_list(client, auth, app):
                 assert clr["list_id"] != 1
             assert clr in context_list_relations_before
         assert len(context_list_relations_after) == len(context_list_relations_before) - 1
+
+
+def test_view_recent_messages(client, auth, app):
+    with app.app_context():
+        app.config["CONTEXT_VIEW_MESSAGES"] = 2
+        auth.login()
+        response = client.get("/contexts/1/view")
+        assert response.status_code == 200
+        # Only the latest messages of each conversation are rendered
+        assert b"message content 1<" not in response.data
+        assert b"message content 2<" in response.data
+        assert b"message content 3<" in response.data
+        assert b"message content 5<" not in response.data
+        assert b"message content 7<" in response.data
+        assert response.data.count(b'class="load-older"') == 2
+        assert b'data-before="2"' in response.data
+        # Conversations with few messages have nothing older to load
+        app.config["CONTEXT_VIEW_MESSAGES"] = 3
+        response = client.get("/contexts/1/view")
+        assert b"message content 1<" in response.data
+        assert b'class="load-older"' not in response.data
+
+
+def test_get_context_conversations_query_count(app):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO messages (conversation_id, content, human) VALUES (?, ?, ?)",
+            [(n % 2 + 1, f"bulk message {n}", n % 2) for n in range(100)]
+        )
+        db.commit()
+        with count_queries(db) as queries:
+            conversations = get_context_conversations(1, 5)
+        assert len(queries) == 2
+        assert [len(c["messages"]) for c in conversations] == [5, 5]
+        assert all(c["has_older"] for c in conversations)
+        assert conversations[0]["messages"][-1]["content"] == "bulk message 98"
+
+
+def test_export(client, auth, app):
+    path = "/contexts/1/export"
+    assert client.get(path).status_code == 302
+    auth.login("other", "other")
+    assert client.get(path).status_code == 403
+    auth.login()
+    assert client.get(path + "?format=bogus").status_code == 400
+    response = client.get(path)
+    assert response.mimetype == "application/json"
+    assert response.headers["Content-Disposition"] == 'attachment; filename="context-1.json"'
+    exported = response.get_data(as_text=True) # read the stream outside the app context below
+    with app.app_context():
+        from incontext.conversations import get_context_json
+        assert exported == get_context_json(1)
+    response = client.get(path + "?format=tsv")
+    assert response.mimetype == "text/tab-separated-values"
+    assert response.get_data(as_text=True).startswith("# list name 1 (list 1)\n")
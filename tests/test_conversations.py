@@ -1,6 +1,14 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
+from flask import g
 from incontext.db import get_db
-from tests.test_db import get_other_tables
+from incontext.cache import bump_list_context_versions
+from incontext.conversations import get_context_json
+from incontext.providers import clients
+from tests.test_db import get_other_tables, count_queries
 
 
 def test_index(app, client, auth):
@@ -340,10 +348,10 @@ def test_agent_response(app, client, auth):
         auth.login()
         db = get_db()
         messages_before = db.execute("SELECT * FROM messages").fetchall()
-        other_tables_before = get_other_tables(["messages"])
+        other_tables_before = get_other_tables(["messages", "response_leases"]) # the request leaves its lease behind
         response = client.post(path, json=json)
         assert response.status_code == 200
-        assert get_other_tables(["messages"]) == other_tables_before
+        assert get_other_tables(["messages", "response_leases"]) == other_tables_before
         messages_after = db.execute("SELECT * FROM messages").fetchall()
         agent_content = response.json["content"]
         new_messages  = [m for m in messages_after if m["content"] == agent_content]
@@ -415,3 +423,400 @@ def test_delete(client, auth, app):
         conversation_messages_before = [m for m in messages_before if m["conversation_id"] == 1]
         assert len(messages_after) == len(messages_before) - len(conversation_messages_before)
         
+
+
+def test_get_context_json(app):
+    with app.app_context():
+        db = get_db()
+        with count_queries(db) as queries:
+            context = json.loads(get_context_json(1))
+        assert len(queries) <= 6
+        created = db.execute("SELECT created FROM items WHERE id = 1").fetchone()["created"].strftime("%Y-%m-%d")
+        assert context == [
+            {
+                "id": 1,
+                "name": "list name 1",
+                "description": "list description 1",
+                "details": [
+                    {"id": 1, "name": "detail name 1", "description": "detail description 1"},
+                    {"id": 2, "name": "detail name 2", "description": "detail description 2"},
+                ],
+                "items": [
+                    {"id": 1, "name": "item name 1", "created": created, "detail name 1": "relation content 1", "detail name 2": "relation content 2"},
+                    {"id": 2, "name": "item name 2", "created": created, "detail name 1": "relation content 3", "detail name 2": "relation content 4"},
+                ],
+            },
+            {
+                "id": 2,
+                "name": "list name 2",
+                "description": "list description 2",
+                "details": [
+                    {"id": 3, "name": "detail name 3", "description": "detail description 3"},
+                ],
+                "items": [
+                    {"id": 3, "name": "item name 3", "created": created, "detail name 3": "relation content 5"},
+                ],
+            },
+        ]
+        # Query count doesn't grow with the number of items
+        cur = db.cursor()
+        for n in range(50):
+            cur.execute("INSERT INTO items (creator_id, name) VALUES (2, ?)", (f"bulk item {n}",))
+            item_id = cur.lastrowid
+            cur.execute("INSERT INTO list_item_relations (list_id, item_id) VALUES (1, ?)", (item_id,))
+            cur.executemany(
+                "INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (?, ?, ?)",
+                [(item_id, 1, f"bulk content {n}"), (item_id, 2, "")]
+            )
+        bump_list_context_versions(1)
+        db.commit()
+        with count_queries(db) as queries:
+            context = json.loads(get_context_json(1))
+        assert len(queries) <= 6
+        assert len(context[0]["items"]) == 52
+        assert context[0]["items"][-1]["detail name 1"] == "bulk content 49"
+
+
+def test_context_json_cache(app, client, auth):
+    with app.app_context():
+        metrics = app.extensions["metrics"]
+        db = get_db()
+        first = get_context_json(1)
+        assert metrics.counters["context_cache.misses"] == 1
+        # Unchanged context is served from the cache without rebuilding it
+        with count_queries(db) as queries:
+            assert get_context_json(2) == first # conversation 2 shares context 1
+        assert len(queries) == 2
+        assert metrics.counters["context_cache.hits"] == 1
+        # Write paths invalidate the cached payload
+        auth.login()
+        client.post("/lists/1/items/new", data={"name": "cached item", "1": "a", "2": "b"})
+        assert "cached item" in get_context_json(1)
+        client.post("/lists/1/details/1/edit", data={"name": "renamed detail", "description": ""})
+        assert "renamed detail" in get_context_json(1)
+        client.post("/contexts/1/remove-list", data={"list_id": 2})
+        assert "list name 2" not in get_context_json(1)
+        client.post("/contexts/1/new-list", data={"list_id": 2})
+        assert "list name 2" in get_context_json(1)
+        assert metrics.counters["context_cache.misses"] == 5
+        # Counters are exposed to admins only
+        assert client.get("/metrics/").json["counters"]["context_cache.hits"] == 1
+        auth.login("other", "other")
+        assert client.get("/metrics/").status_code == 403
+
+
+def test_messages(app, client, auth):
+    with app.app_context():
+        path = "/conversations/1/messages"
+        all_tables_before = get_other_tables()
+        response = client.get(path)
+        assert response.status_code == 302
+        assert response.headers["Location"] == "/auth/login"
+        auth.login("other", "other")
+        assert client.get(path).status_code == 403
+        auth.login()
+        assert client.get("/conversations/99/messages").status_code == 404
+        # Latest page first
+        page = client.get(path + "?limit=2").json
+        assert [m["content"] for m in page["messages"]] == ["message content 2", "message content 3"]
+        assert page["messages"][0]["human"] == 0
+        assert page["next_before"] == 2
+        # Older messages on demand
+        page = client.get(path + "?limit=2&before=2").json
+        assert [m["content"] for m in page["messages"]] == ["message content 1"]
+        assert page["next_before"] is None
+        page = client.get(path).json
+        assert len(page["messages"]) == 3
+        assert page["next_before"] is None
+        assert get_other_tables() == all_tables_before
+
+
+def test_agent_response_releases_db(app, client, auth, monkeypatch):
+    manager = app.extensions["db"]
+    calls = []
+    def fake_response(conversation_history, agent):
+        # No connection is checked out while the provider is working
+        calls.append((manager.checked_out, "db" in g))
+        assert conversation_history[0]["role"] == "user"
+        return dict(success=True, content="fake agent reply")
+    for name in ("get_openai_response", "get_anthropic_response", "get_google_response"):
+        monkeypatch.setattr(f"incontext.providers.{name}", fake_response)
+    auth.login()
+    response = client.post("/conversations/agent-response", json=dict(conversation_id="1"))
+    assert response.status_code == 200
+    assert response.json["content"] == "fake agent reply"
+    assert calls == [(0, False)]
+    assert manager.checked_out == 0
+    with app.app_context():
+        last = get_db().execute("SELECT * FROM messages ORDER BY id DESC LIMIT 1").fetchone()
+        assert last["conversation_id"] == 1
+        assert last["content"] == "fake agent reply"
+        assert last["human"] == 0
+
+
+def use_fake_provider(agent_id=1):
+    '''Points the agent at the offline fake provider.'''
+    db = get_db()
+    cur = db.execute(
+        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
+        " VALUES ('Fake', 'fake', 'Fake', 'fake', 'Offline echo')"
+    )
+    db.execute("UPDATE agents SET model_id = ? WHERE id = ?", (cur.lastrowid, agent_id))
+    db.commit()
+
+
+def read_events(response):
+    events = []
+    for frame in response.get_data(as_text=True).split("\n\n"):
+        if frame:
+            event_line, data_line = frame.split("\n")
+            events.append((event_line.removeprefix("event: "), json.loads(data_line.removeprefix("data: "))))
+    return events
+
+
+def test_agent_response_stream(app, client, auth, monkeypatch):
+    path = "/conversations/agent-response/stream"
+    with app.app_context():
+        use_fake_provider()
+        messages_before = get_db().execute("SELECT * FROM messages").fetchall()
+    assert client.post(path, json=dict(conversation_id="1")).status_code == 302
+    auth.login("other", "other")
+    assert client.post(path, json=dict(conversation_id="1")).status_code == 403
+    assert client.post(path, json=dict(conversation_id="99")).status_code == 404
+    auth.login()
+    response = client.post(path, json=dict(conversation_id="1"))
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = read_events(response)
+    deltas = [data["content"] for event, data in events if event == "delta"]
+    assert len(deltas) > 1
+    assert events[-1][0] == "done"
+    assert "".join(deltas) == events[-1][1]["content"] == "agent name 1 heard: message content 3"
+    assert app.extensions["db"].checked_out == 0
+    with app.app_context():
+        messages_after = get_db().execute("SELECT * FROM messages").fetchall()
+        assert len(messages_after) == len(messages_before) + 1
+        new_message = messages_after[-1]
+        assert new_message["id"] == events[-1][1]["message_id"]
+        assert new_message["content"] == "agent name 1 heard: message content 3"
+        assert new_message["human"] == 0
+    # A failing provider ends the stream with an error and stores nothing
+    def broken_stream(conversation_history, agent, report=None):
+        yield "partial"
+        raise RuntimeError("provider went away")
+    monkeypatch.setattr("incontext.providers.stream_fake_response", broken_stream)
+    events = read_events(client.post(path, json=dict(conversation_id="1")))
+    assert events[0] == ("delta", dict(content="partial"))
+    assert events[-1][0] == "error"
+    assert "provider went away" in events[-1][1]["content"]
+    with app.app_context():
+        assert len(get_db().execute("SELECT * FROM messages").fetchall()) == len(messages_after)
+
+
+
+def test_send(app, client, auth):
+    from tests.test_jobs import wait_for_job
+    path = "/conversations/send"
+    with app.app_context():
+        use_fake_provider()
+        messages_before = get_db().execute("SELECT * FROM messages").fetchall()
+    assert client.post(path, json=dict(conversation_id="1", content="hi")).status_code == 302
+    auth.login("other", "other")
+    assert client.post(path, json=dict(conversation_id="1", content="hi")).status_code == 403
+    auth.login()
+    assert client.post(path, json=dict(conversation_id="1", content="")).status_code == 400
+    assert client.post(path, json=dict(conversation_id="1", content="hi", mode="bogus")).status_code == 400
+    # The message is stored and the reply queued in one request
+    headers = {"Idempotency-Key": "key-1"}
+    response = client.post(path, json=dict(conversation_id="1", content="hi"), headers=headers)
+    assert response.status_code == 202
+    job = wait_for_job(client, response.json["job_id"])
+    assert job["content"] == "agent name 1 heard: hi"
+    # A retry with the same key stores nothing and gets the same job
+    retry = client.post(path, json=dict(conversation_id="1", content="hi"), headers=headers)
+    assert retry.json == response.json
+    with app.app_context():
+        messages = get_db().execute("SELECT id, content, human FROM messages").fetchall()
+        assert len(messages) == len(messages_before) + 2
+        assert messages[-2] == dict(id=response.json["message_id"], content="hi", human=1)
+        assert messages[-1]["id"] == job["message_id"]
+    # A key can't be reused for another conversation
+    assert client.post(path, json=dict(conversation_id="2", content="hi"), headers=headers).status_code == 422
+    # Streamed, the first event carries the stored message's id
+    headers = {"Idempotency-Key": "key-2"}
+    events = read_events(client.post(path, json=dict(conversation_id="1", content="hello", mode="stream"), headers=headers))
+    assert events[0][0] == "message"
+    assert events[-1] == ("done", dict(content="agent name 1 heard: hello", message_id=events[0][1]["message_id"] + 1))
+    # and a retry replays the reply instead of asking the agent again
+    retry = read_events(client.post(path, json=dict(conversation_id="1", content="hello", mode="stream"), headers=headers))
+    assert retry[0] == events[0]
+    assert retry[-1] == events[-1]
+    with app.app_context():
+        assert len(get_db().execute("SELECT * FROM messages").fetchall()) == len(messages_before) + 4
+    # Without a key every request is a new message
+    client.post(path, json=dict(conversation_id="1", content="again"))
+    client.post(path, json=dict(conversation_id="1", content="again"))
+    app.extensions["jobs"].shutdown()
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) AS n FROM messages WHERE content = 'again'").fetchone()["n"] == 2
+
+def test_agent_message_usage(app, client, auth):
+    with app.app_context():
+        use_fake_provider()
+    auth.login()
+    events = read_events(client.post("/conversations/agent-response/stream", json=dict(conversation_id="1")))
+    message_id = events[-1][1]["message_id"]
+    with app.app_context():
+        message = get_db().execute(
+            "SELECT input_tokens, cached_input_tokens, output_tokens FROM messages WHERE id = ?",
+            (message_id,)
+        ).fetchone()
+        context_tokens = len(f"Contextual info: {get_context_json(1)}") // 4
+    # The fake provider reports the context as cached
+    assert message["cached_input_tokens"] >= context_tokens
+    assert message["input_tokens"] > message["cached_input_tokens"]
+    assert message["output_tokens"] > 0
+    counters = app.extensions["metrics"].snapshot()["counters"]
+    assert counters["tokens.fake.cached_input_tokens"] == message["cached_input_tokens"]
+    assert counters["tokens.fake.input_tokens"] == message["input_tokens"]
+
+
+class ResponsesStub(BaseHTTPRequestHandler):
+    '''A local stand-in for the OpenAI responses API. Forgets responses named "resp_gone" and can't fit "resp_full" in the model's window. Each entry of `faults` spoils one request: a number delays the reply by that many seconds, a (status, headers) pair replaces it with an error.'''
+    protocol_version = "HTTP/1.1"
+    requests = []
+    faults = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        ResponsesStub.requests.append(body)
+        fault = ResponsesStub.faults.pop(0) if ResponsesStub.faults else None
+        if isinstance(fault, (int, float)):
+            threading.Event().wait(fault) # unaffected by tests that patch time.sleep
+        if isinstance(fault, tuple):
+            status, headers = fault
+            data = json.dumps(dict(error=dict(message="injected fault", type="server_error", param=None, code=None))).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if body.get("previous_response_id") == "resp_gone":
+            status, payload = 400, dict(error=dict(
+                message="Previous response with id 'resp_gone' not found.", type="invalid_request_error",
+                param="previous_response_id", code="previous_response_not_found",
+            ))
+        elif body.get("previous_response_id") == "resp_full":
+            status, payload = 400, dict(error=dict(
+                message="Your input exceeds the context window of this model.", type="invalid_request_error",
+                param="input", code="context_length_exceeded",
+            ))
+        else:
+            response_id = f"resp_{len(ResponsesStub.requests)}"
+            status, payload = 200, dict(
+                id=response_id, object="response", created_at=0, model=body["model"], status="completed",
+                output=[dict(type="message", id=f"msg_{response_id}", role="assistant", status="completed",
+                             content=[dict(type="output_text", text=f"reply {response_id}", annotations=[])])],
+                usage=dict(input_tokens=10, input_tokens_details=dict(cached_tokens=0), output_tokens=2,
+                           output_tokens_details=dict(reasoning_tokens=0), total_tokens=12),
+            )
+        data = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass # the client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+def use_openai_stub(agent_id=1):
+    '''Points the agent at an OpenAI model. Use with the `responses_stub` fixture.'''
+    db = get_db()
+    cur = db.execute(
+        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
+        " VALUES ('OpenAI', 'openai', 'Stub', 'stub-model', 'Local stub')"
+    )
+    db.execute("UPDATE agents SET model_id = ? WHERE id = ?", (cur.lastrowid, agent_id))
+    db.commit()
+
+
+@pytest.fixture
+def responses_stub(app, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ResponsesStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ResponsesStub.requests = []
+    ResponsesStub.faults = []
+    monkeypatch.setenv("OPENAI_API_KEY", "stub-key")
+    app.config["PROVIDER_BASE_URLS"] = {"openai": f"http://127.0.0.1:{server.server_port}/v1"}
+    clients.clear()
+    yield ResponsesStub.requests
+    clients.clear()
+    server.shutdown()
+
+
+def test_openai_stateful_responses(app, client, auth, responses_stub):
+    app.config["OPENAI_STATEFUL_RESPONSES"] = True
+    with app.app_context():
+        use_openai_stub()
+    auth.login()
+    def send(content):
+        client.post("/conversations/add-message", json=dict(conversation_id=1, content=content))
+        return client.post("/conversations/agent-response", json=dict(conversation_id=1)).json["content"]
+    # The first turn sends the whole conversation
+    assert client.post("/conversations/agent-response", json=dict(conversation_id=1)).json["content"] == "reply resp_1"
+    assert "previous_response_id" not in responses_stub[0]
+    assert responses_stub[0]["input"][-1] == dict(role="user", content="message content 3")
+    assert len(responses_stub[0]["input"]) == 5 # instructions, context and three messages
+    # The next one continues the stored response with only the new message
+    assert send("hello") == "reply resp_2"
+    assert responses_stub[1]["previous_response_id"] == "resp_1"
+    assert responses_stub[1]["input"] == [dict(role="user", content="hello")]
+    with app.app_context():
+        last = get_db().execute("SELECT response_id, chain_key FROM messages ORDER BY id DESC LIMIT 1").fetchone()
+        assert last["response_id"] == "resp_2"
+        # A context change breaks the chain
+        bump_list_context_versions(1)
+        get_db().commit()
+    assert send("again") == "reply resp_3"
+    assert "previous_response_id" not in responses_stub[2]
+    assert len(responses_stub[2]["input"]) == 9
+    # A response OpenAI no longer has is replayed in full
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE messages SET response_id = 'resp_gone' WHERE response_id = 'resp_3'")
+        db.commit()
+    assert send("once more") == "reply resp_5"
+    assert responses_stub[3]["previous_response_id"] == "resp_gone"
+    assert "previous_response_id" not in responses_stub[4]
+    assert responses_stub[4]["input"][-1] == dict(role="user", content="once more")
+    assert app.extensions["metrics"].snapshot()["counters"]["openai.chain_replays"] == 1
+    # A chain that outgrew the prompt budget starts over from the assembled prompt
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE messages SET input_tokens = ? WHERE response_id = 'resp_5'", (app.config["PROMPT_BUDGET"],))
+        db.commit()
+    assert send("too long") == "reply resp_6"
+    assert "previous_response_id" not in responses_stub[5]
+    assert app.extensions["metrics"].snapshot()["counters"]["openai.chain_resets"] == 1
+    # Chained requests let OpenAI truncate, and a chain that still doesn't fit is replayed
+    assert send("next") == "reply resp_7"
+    assert responses_stub[6]["truncation"] == "auto"
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE messages SET response_id = 'resp_full' WHERE response_id = 'resp_7'")
+        db.commit()
+    assert send("overflow") == "reply resp_9"
+    assert responses_stub[7]["previous_response_id"] == "resp_full"
+    assert "previous_response_id" not in responses_stub[8]
+    assert app.extensions["metrics"].snapshot()["counters"]["openai.chain_replays"] == 2
+    app.config["OPENAI_STATEFUL_RESPONSES"] = False
+    send("stateless")
+    assert "previous_response_id" not in responses_stub[9]
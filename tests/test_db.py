@@ -1,15 +1,34 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 import os
 
 import pytest
-from incontext.db import get_db, dict_factory
+from incontext.db import get_db, dict_factory, get_migrations, get_model_seed, get_schema_version, migrate
 from flask import g, session
 
 
 def test_get_close_db(app):
+    manager = app.extensions['db']
     with app.app_context():
         db = get_db()
         assert db is get_db() # within an application context, `get_db` should return the same connection each time it's called.
+        assert manager.checked_out == 1
+
+    assert manager.checked_out == 0 # After the context, the connection is returned to the manager...
+    with app.app_context():
+        assert get_db() is db # ...and handed out again to the next context on this thread.
+
+    db.close() # A broken connection is replaced rather than handed out.
+    with app.app_context():
+        assert get_db() is not db
+        assert get_db().execute('SELECT 1 AS one').fetchone()['one'] == 1
+
+
+def test_get_close_db_not_persistent(app):
+    app.extensions['db'].persistent = False
+    with app.app_context():
+        db = get_db()
 
     with pytest.raises(sqlite3.ProgrammingError) as e:
         db.execute('SELECT 1')
@@ -17,6 +36,36 @@ def test_get_close_db(app):
     assert 'closed' in str(e.value) # After the context, the connection should be closed.
 
 
+def test_connection_pragmas(app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()['journal_mode'] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()['synchronous'] == 1 # NORMAL
+        assert db.execute('PRAGMA busy_timeout').fetchone()['timeout'] == 5000
+        assert db.execute('PRAGMA cache_size').fetchone()['cache_size'] == -16000
+
+
+def test_connections_per_thread(app):
+    manager = app.extensions['db']
+    with app.app_context():
+        main_db = get_db()
+    seen = []
+    def work():
+        with app.app_context():
+            seen.append(get_db())
+            get_db().execute('SELECT 1')
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert seen[0] is not main_db # each thread gets its own connection
+    assert manager.checked_out == 0
+    # Uncommitted work doesn't leak into the next checkout
+    with app.app_context():
+        get_db().execute("INSERT INTO users (username, password) VALUES ('uncommitted', 'x')")
+    with app.app_context():
+        assert get_db().execute("SELECT * FROM users WHERE username = 'uncommitted'").fetchone() is None
+
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder:
         called = False
@@ -30,6 +79,57 @@ def test_init_db_command(runner, monkeypatch):
     assert Recorder.called
 
 
+def test_migrate(app):
+    with app.app_context():
+        db = get_db()
+        latest = get_migrations()[-1][0]
+        # init_db leaves a fresh database fully migrated
+        assert get_schema_version() == latest
+        assert migrate() == []
+        # A database created from the baseline schema is brought up to date without losing data
+        with app.open_resource("schema.sql") as f:
+            db.executescript(f.read().decode("utf-8"))
+        db.execute("INSERT INTO users (username, password) VALUES ('kept', 'x')")
+        db.execute(
+            "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
+            " VALUES ('OpenAI', 'openai', 'GPT-4o', 'gpt-4o', 'default'), ('Other', 'other', 'Other', 'other-1', '')"
+        )
+        db.commit()
+        assert get_schema_version() == 0
+        applied = migrate()
+        assert applied == [filename for version, filename in get_migrations()]
+        assert get_schema_version() == latest
+        assert db.execute("SELECT username FROM users").fetchone()["username"] == "kept"
+        # The shipped models get their budgets, others keep falling back to PROMPT_BUDGET
+        budgets = db.execute("SELECT model_code, context_budget FROM agent_models ORDER BY id").fetchall()
+        assert budgets == [{"model_code": "gpt-4o", "context_budget": 128000}, {"model_code": "other-1", "context_budget": None}]
+        indexes = [row["name"] for row in db.execute("SELECT name FROM sqlite_schema WHERE type = 'index'")]
+        assert "messages_conversation_id" in indexes
+        assert "item_detail_relations_item_id_detail_id" in indexes
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT id FROM messages WHERE conversation_id = 1").fetchall()
+        assert "USING" in plan[0]["detail"] and "INDEX messages_conversation_id" in plan[0]["detail"]
+
+
+def test_migrate_rolls_back_failed_migration(app, monkeypatch, tmp_path):
+    with app.app_context():
+        db = get_db()
+        version = get_schema_version()
+        (tmp_path / "migrations").mkdir()
+        (tmp_path / "migrations" / f"{version + 1:04}_broken.sql").write_text(
+            "CREATE TABLE half_done (id INTEGER);\nINSERT INTO no_such_table VALUES (1);"
+        )
+        monkeypatch.setattr(app, "root_path", str(tmp_path))
+        with pytest.raises(sqlite3.OperationalError):
+            migrate()
+        assert get_schema_version() == version
+        assert db.execute("SELECT name FROM sqlite_schema WHERE name = 'half_done'").fetchone() is None
+
+
+def test_migrate_command(runner):
+    result = runner.invoke(args=['migrate'])
+    assert 'schema version' in result.output
+
+
 def test_data_entry(app):
     with app.app_context():
         db = get_db()
@@ -37,6 +137,11 @@ def test_data_entry(app):
         assert user_count == 4
         agent_count = db.execute("SELECT COUNT(*) AS count FROM agents").fetchone()["count"]
         assert agent_count == 4
+        unbudgeted = db.execute("SELECT COUNT(*) AS count FROM agent_models WHERE context_budget IS NULL").fetchone()["count"]
+        assert unbudgeted == 0
+        # An entry can bring its own budget
+        assert get_model_seed(("Local", "local", "Local", "gpt-4o", "", 8000))[-1] == 8000
+        assert get_model_seed(("Local", "local", "Local", "local-1", ""))[-1] is None
 
 
 def test_admin_login(client, auth):
@@ -50,14 +155,32 @@ def test_admin_login(client, auth):
         assert g.user["admin"] == True
 
 
+# Tables holding derived state (cache versions and the like) rather than user data.
+BOOKKEEPING_TABLES = ["context_versions"]
+# The search indexes and their shadow tables (items_fts_data and so on) are derived state too.
+SEARCH_INDEXES = ["messages_fts", "contexts_fts", "lists_fts", "agents_fts", "items_fts"]
+
+
 def get_other_tables(table_names=[]):
     db = get_db()
     db.row_factory = dict_factory
     all_tables = db.execute("SELECT name FROM sqlite_schema WHERE type='table' AND name NOT LIKE '%sqlite_%'").fetchall()
     other_tables = []
     for table in all_tables:
-        if table["name"] not in table_names:
+        is_search_index = any(table["name"].startswith(index) for index in SEARCH_INDEXES)
+        if table["name"] not in table_names and table["name"] not in BOOKKEEPING_TABLES and not is_search_index:
             other_table = db.execute(f"SELECT * FROM {table["name"]}").fetchall()
             other_tables.append(other_table)
     return other_tables
         
+
+
+@contextmanager
+def count_queries(db):
+    '''Collects the statements executed on `db` while the block runs.'''
+    queries = []
+    db.set_trace_callback(queries.append)
+    try:
+        yield queries
+    finally:
+        db.set_trace_callback(None)
@@ -0,0 +1,114 @@
+import json
+
+from incontext.cache import bump_context_version
+from incontext.conversations import get_agent_request, get_context_json, get_context_payload, iter_context_payload
+from incontext.db import get_db
+from incontext.formats import FORMATS, encode, serialize
+
+
+PAYLOAD = [
+    dict(
+        id=1, name="books", description="Books I read",
+        details=[dict(id=1, name="author", description="Who wrote it"), dict(id=2, name="notes", description="")],
+        items=[
+            dict(id=1, name="Dune", created="2024-01-02", author="Herbert", notes="sand\tand | spice\nworms"),
+            dict(id=2, name="Emma", created="2024-01-03", author="Austen, Jane", notes=None),
+        ],
+    ),
+]
+
+
+def test_formats():
+    assert json.loads(serialize(PAYLOAD)) == PAYLOAD
+    assert serialize(PAYLOAD, "bogus") == serialize(PAYLOAD)
+    columnar = json.loads(serialize(PAYLOAD, "columnar"))
+    assert columnar[0]["columns"] == ["id", "name", "created", "author", "notes"]
+    assert columnar[0]["rows"][1] == [2, "Emma", "2024-01-03", "Austen, Jane", None]
+    assert serialize(PAYLOAD, "tsv") == (
+        "# books (list 1)\n"
+        "Books I read\n"
+        "- author: Who wrote it\n"
+        "id\tname\tcreated\tauthor\tnotes\n"
+        "1\tDune\t2024-01-02\tHerbert\tsand\\tand | spice\\nworms\n"
+        "2\tEmma\t2024-01-03\tAusten, Jane\t"
+    )
+    assert serialize(PAYLOAD, "markdown") == (
+        "## books (list 1)\n"
+        "Books I read\n"
+        "- author: Who wrote it\n"
+        "| id | name | created | author | notes |\n"
+        "|---|---|---|---|---|\n"
+        "| 1 | Dune | 2024-01-02 | Herbert | sand\tand \\| spice<br>worms |\n"
+        "| 2 | Emma | 2024-01-03 | Austen, Jane |  |"
+    )
+    assert serialize(PAYLOAD, "compact") == (
+        "books (list 1):\n"
+        "  description: Books I read\n"
+        "  details:\n"
+        "    author: Who wrote it\n"
+        '    notes: ""\n'
+        "  items [id, name, created, author, notes]:\n"
+        '    - 1, Dune, 2024-01-02, Herbert, "sand\\tand | spice\\nworms"\n'
+        '    - 2, Emma, 2024-01-03, "Austen, Jane", ~'
+    )
+    # Lists cut down by retrieval say so
+    partial = [dict(PAYLOAD[0], items=PAYLOAD[0]["items"][:1], total_items=2)]
+    assert serialize(partial, "tsv").startswith("# books (list 1) - 1 of 2 items\n")
+    assert json.loads(serialize(partial, "columnar"))[0]["total_items"] == 2
+    # Every format is smaller than JSON
+    sizes = {name: len(serialize(PAYLOAD, name)) for name in FORMATS}
+    assert min(sizes, key=sizes.get) != "json" and max(sizes, key=sizes.get) == "json"
+
+
+def test_streamed_payload(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO lists (id, creator_id, name, description) VALUES (99, 2, 'empty list', '')")
+        db.execute("INSERT INTO context_list_relations (context_id, list_id) VALUES (1, 99)")
+        db.execute("INSERT INTO context_list_relations (context_id, list_id) VALUES (1, 1)")
+        bump_context_version(1)
+        db.commit()
+        payload = get_context_payload(1)
+        assert [(alist["name"], len(alist["items"])) for alist in payload] == [
+            ("list name 1", 2), ("list name 2", 1), ("empty list", 0), ("list name 1", 2),
+        ]
+        for name in FORMATS:
+            assert serialize(iter_context_payload(1), name) == serialize(payload, name)
+        # A reader may skip a list's items, or stop halfway through them
+        lists = iter_context_payload(1)
+        first = next(lists)
+        assert next(first["items"])["name"] == "item name 1"
+        assert [item["name"] for item in next(lists)["items"]] == ["item name 3"]
+        # Chunks are about the size asked for
+        chunks = list(encode(iter_context_payload(1), "json", chunk_size=100))
+        assert "".join(chunks) == json.dumps(payload)
+        assert all(100 <= len(chunk) < 400 for chunk in chunks[:-1])
+
+
+def test_agent_format(app):
+    with app.app_context():
+        db = get_db()
+        agent, history = get_agent_request(1, check_access=False)
+        assert agent["context"].startswith('Contextual info: [{"id": 1')
+        assert agent["context_key"] == "1-0"
+        db.execute("UPDATE agents SET context_format = 'markdown' WHERE id = 1")
+        db.commit()
+        agent, history = get_agent_request(1, check_access=False)
+        assert agent["context"].startswith("Contextual info: ## list name 1 (list 1)\n")
+        assert agent["context_key"] == "1-0-markdown"
+        # Each format is cached per context version
+        metrics = app.extensions["metrics"]
+        misses = metrics.counters["context_cache.misses"]
+        assert get_context_json(1, context_format="markdown") == agent["context"].removeprefix("Contextual info: ")
+        assert metrics.counters["context_cache.misses"] == misses
+        get_context_json(1, context_format="tsv")
+        assert metrics.counters["context_cache.misses"] == misses + 1
+
+
+def test_measure_formats(app, runner):
+    result = runner.invoke(args=["measure-formats", "1"])
+    lines = result.output.splitlines()
+    assert lines[0].split() == ["format", "bytes", "tokens", "vs", "json"]
+    assert [line.split()[0] for line in lines[1:]] == list(FORMATS)
+    with app.app_context():
+        assert int(lines[1].split()[1]) == len(json.dumps(get_context_payload(1)))
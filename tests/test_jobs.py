@@ -0,0 +1,134 @@
+import time
+
+from incontext.db import get_db
+from incontext.jobs import get_job_queue
+from tests.test_db import get_other_tables
+from tests.test_conversations import use_fake_provider
+
+
+def wait_for_job(client, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").json
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} didn't finish")
+
+
+def test_agent_response_job(app, client, auth):
+    path = "/jobs/agent-response"
+    with app.app_context():
+        use_fake_provider()
+        messages_before = get_db().execute("SELECT * FROM messages").fetchall()
+        other_tables_before = get_other_tables(["messages", "jobs", "response_leases"])
+    assert client.post(path, json=dict(conversation_id="1")).status_code == 302
+    auth.login("other", "other")
+    assert client.post(path, json=dict(conversation_id="1")).status_code == 403
+    assert client.post(path, json=dict(conversation_id="99")).status_code == 404
+    auth.login()
+    response = client.post(path, json=dict(conversation_id="1"))
+    assert response.status_code == 202
+    job_id = response.json["job_id"]
+    assert response.json["status_url"] == f"/jobs/{job_id}"
+    job = wait_for_job(client, job_id)
+    assert job["status"] == "done"
+    assert job["content"] == "agent name 1 heard: message content 3"
+    result = client.get(response.json["result_url"])
+    assert result.status_code == 200
+    assert result.json == dict(content=job["content"], message_id=job["message_id"])
+    with app.app_context():
+        messages_after = get_db().execute("SELECT * FROM messages").fetchall()
+        assert len(messages_after) == len(messages_before) + 1
+        assert messages_after[-1]["id"] == job["message_id"]
+        assert messages_after[-1]["human"] == 0
+        assert get_other_tables(["messages", "jobs", "response_leases"]) == other_tables_before
+    # Other users can't see the job
+    auth.login("other", "other")
+    assert client.get(f"/jobs/{job_id}").status_code == 403
+    assert client.get(f"/jobs/{job_id}/result").status_code == 403
+    assert client.get("/jobs/99").status_code == 404
+    app.extensions["jobs"].shutdown() # wait for the worker to record its timings
+    metrics = app.extensions["metrics"].snapshot()
+    assert metrics["counters"]["jobs.done"] == 1
+    assert metrics["counters"]["jobs.depth"] == 0
+    assert metrics["timings"]["jobs.wait_seconds"]["count"] == 1
+    assert metrics["timings"]["jobs.run_seconds"]["count"] == 1
+
+
+def test_agent_response_job_failure(app, client, auth, monkeypatch):
+    def broken_stream(conversation_history, agent, report=None):
+        yield "partial"
+        raise RuntimeError("provider went away")
+    monkeypatch.setattr("incontext.providers.stream_fake_response", broken_stream)
+    with app.app_context():
+        use_fake_provider()
+        messages_before = get_db().execute("SELECT * FROM messages").fetchall()
+    auth.login()
+    job_id = client.post("/jobs/agent-response", json=dict(conversation_id="1")).json["job_id"]
+    job = wait_for_job(client, job_id)
+    assert job["status"] == "failed"
+    assert "provider went away" in job["error"]
+    result = client.get(f"/jobs/{job_id}/result")
+    assert "provider went away" in result.json["content"]
+    with app.app_context():
+        assert get_db().execute("SELECT * FROM messages").fetchall() == messages_before
+    app.extensions["jobs"].shutdown()
+    assert app.extensions["metrics"].snapshot()["counters"]["jobs.failed"] == 1
+
+
+def test_job_recovery(app, client, auth):
+    now = time.time()
+    stale = now - app.config["JOB_STALE_SECONDS"] - 1
+    with app.app_context():
+        use_fake_provider()
+        db = get_db()
+        db.executemany(
+            "INSERT INTO jobs (conversation_id, status, started_at, heartbeat, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (1, "pending", None, None, now - app.config["JOB_PENDING_GRACE"] - 1), # queued when the worker stopped
+                (1, "running", stale, stale, stale), # lost with the worker
+                (1, "running", now, now, now), # still running elsewhere
+                (1, "running", stale, now, stale), # running long elsewhere, but its worker is alive
+                (1, "pending", None, None, now), # just queued by another worker
+            ]
+        )
+        db.commit()
+        # A new worker picks the leftover jobs up when its queue starts
+        queue = get_job_queue()
+        assert app.extensions["jobs"] is queue
+    auth.login()
+    assert wait_for_job(client, 1)["status"] == "done"
+    assert wait_for_job(client, 2)["status"] == "done"
+    assert client.get("/jobs/3").json["status"] == "running"
+    assert client.get("/jobs/4").json["status"] == "running"
+    assert client.get("/jobs/5").json["status"] == "pending"
+    with app.app_context():
+        jobs = get_db().execute("SELECT id, status FROM jobs ORDER BY id").fetchall()
+        assert [job["status"] for job in jobs] == ["done", "done", "running", "running", "pending"]
+        # If its heartbeat stops later, say its worker crashed after this one started, polling it requeues it
+        db = get_db()
+        db.execute("UPDATE jobs SET heartbeat = ? WHERE id = 3", (stale,))
+        db.commit()
+    assert wait_for_job(client, 3)["status"] == "done"
+    with app.app_context():
+        assert get_db().execute("SELECT status FROM jobs WHERE id = 4").fetchone()["status"] == "running"
+    queue.shutdown()
+
+
+def test_job_heartbeat(app, client, auth, monkeypatch):
+    app.config["JOB_HEARTBEAT_INTERVAL"] = 0.05
+    def slow(conversation_history, agent, report=None):
+        time.sleep(0.3)
+        yield "late reply"
+    monkeypatch.setattr("incontext.providers.stream_fake_response", slow)
+    with app.app_context():
+        use_fake_provider()
+    auth.login()
+    job_id = client.post("/jobs/agent-response", json=dict(conversation_id="1")).json["job_id"]
+    time.sleep(0.2)
+    with app.app_context():
+        job = get_db().execute("SELECT status, started_at, heartbeat FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        assert job["status"] == "running"
+        assert job["heartbeat"] > job["started_at"] # touched while the provider is silent
+    assert wait_for_job(client, job_id)["content"] == "late reply"
@@ -0,0 +1,134 @@
+import threading
+import time
+
+from incontext.db import get_db
+from incontext.leases import claim_lease, fail_lease, finish_lease, get_lease, join_lease
+from tests.test_conversations import use_fake_provider, read_events
+
+
+def slow_fake(monkeypatch, calls, release):
+    '''Makes the fake provider wait for `release` and count its calls.'''
+    from incontext import providers
+    fake = providers.stream_fake_response
+    def stream(conversation_history, agent, report=None):
+        calls.append(None)
+        release.wait(5)
+        yield from fake(conversation_history, agent, report)
+    monkeypatch.setattr("incontext.providers.stream_fake_response", stream)
+
+
+def post_together(app, path, count=2):
+    '''Posts `count` agent-response requests for conversation 1 at the same time. Returns the responses.'''
+    responses = [None] * count
+    def post(i):
+        client = app.test_client()
+        client.post("/auth/login", data=dict(username="test", password="test"))
+        responses[i] = client.post(path, json=dict(conversation_id=1))
+        responses[i].get_data() # read streams through, as a browser would
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, responses
+
+
+def wait_for_attached(app, timeout=5):
+    '''Waits until the second request is waiting on the first one's lease.'''
+    deadline = time.monotonic() + timeout
+    while app.extensions["metrics"].snapshot()["counters"].get("leases.attached") != 1:
+        assert time.monotonic() < deadline, "the second request didn't attach"
+        time.sleep(0.01)
+
+
+def test_single_flight(app, monkeypatch):
+    calls = []
+    release = threading.Event()
+    slow_fake(monkeypatch, calls, release)
+    with app.app_context():
+        use_fake_provider()
+        messages_before = get_db().execute("SELECT COUNT(*) AS n FROM messages").fetchone()["n"]
+    threads, responses = post_together(app, "/conversations/agent-response")
+    wait_for_attached(app)
+    release.set()
+    for thread in threads:
+        thread.join()
+    # One provider call and one message, and both requests get the reply
+    assert len(calls) == 1
+    assert [response.json["content"] for response in responses] == ["agent name 1 heard: message content 3"] * 2
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) AS n FROM messages").fetchone()["n"] == messages_before + 1
+        lease = get_lease(1, 3)
+        assert lease["status"] == "done"
+    # The next request is for the new state and calls the provider again
+    client = app.test_client()
+    client.post("/auth/login", data=dict(username="test", password="test"))
+    client.post("/conversations/add-message", json=dict(conversation_id=1, content="again"))
+    client.post("/conversations/agent-response", json=dict(conversation_id=1))
+    assert len(calls) == 2
+    with app.app_context():
+        assert get_lease(1, 3) is None # older states are cleaned up
+
+
+def test_single_flight_stream(app, monkeypatch):
+    calls = []
+    release = threading.Event()
+    slow_fake(monkeypatch, calls, release)
+    with app.app_context():
+        use_fake_provider()
+    # A stream the client stops reading leaves no running lease behind
+    release.set()
+    client = app.test_client()
+    client.post("/auth/login", data=dict(username="test", password="test"))
+    client.post("/conversations/agent-response/stream", json=dict(conversation_id=1)).close()
+    with app.app_context():
+        assert get_lease(1, 3)["status"] == "failed"
+    release.clear()
+    calls.clear()
+    threads, responses = post_together(app, "/conversations/agent-response/stream")
+    wait_for_attached(app)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    done = [read_events(response)[-1] for response in responses]
+    assert [event for event, data in done] == ["done", "done"]
+    assert done[0][1] == done[1][1]
+
+
+def test_lease_states(app):
+    app.config["LEASE_POLL_INTERVAL"] = 0.01
+    with app.app_context():
+        owner = claim_lease(1, 3)
+        assert owner is not None
+        assert claim_lease(1, 3) is None # held
+        fail_lease(1, 3, owner, "provider went away")
+        owner, lease = join_lease(1, 3)
+        assert owner is not None and lease is None # a failed lease is taken over by a new request
+        db = get_db()
+        db.execute("UPDATE response_leases SET expires = ? WHERE conversation_id = 1", (time.time() - 1,))
+        db.commit()
+        new_owner = claim_lease(1, 3) # so is an expired one
+        assert new_owner is not None
+        fail_lease(1, 3, owner, "too late") # the first owner can't touch it any more
+        assert get_lease(1, 3)["status"] == "running"
+        finish_lease(1, 3, new_owner, "the reply", 10)
+        db.commit()
+        owner, lease = join_lease(1, 3)
+        assert owner is None
+        assert (lease["status"], lease["content"], lease["message_id"]) == ("done", "the reply", 10)
+
+def test_job_defers_to_lease(app, client, auth):
+    from tests.test_jobs import wait_for_job
+    app.config["JOB_DEFER_SECONDS"] = 0.05
+    with app.app_context():
+        use_fake_provider()
+        owner = claim_lease(1, 3) # another request is answering
+    auth.login()
+    job_id = client.post("/jobs/agent-response", json=dict(conversation_id=1)).json["job_id"]
+    time.sleep(0.2)
+    assert client.get(f"/jobs/{job_id}").json["status"] == "pending" # waiting without holding a worker
+    assert app.extensions["metrics"].snapshot()["counters"]["jobs.deferred"] >= 1
+    with app.app_context():
+        finish_lease(1, 3, owner, "the reply", 10)
+        get_db().commit()
+    job = wait_for_job(client, job_id)
+    assert (job["status"], job["content"], job["message_id"]) == ("done", "the reply", 10)
@@ -0,0 +1,133 @@
+import time
+
+import pytest
+
+from incontext.db import get_db
+from incontext.limits import LimitTimeoutError, limited, is_next, with_connection
+from incontext.providers import get_provider_response, stream_provider_response
+
+
+FAKE = dict(provider_code="fake", model_code="fake", creator_id=1)
+
+
+def test_unlimited(app):
+    with app.app_context():
+        with limited(FAKE):
+            pass
+        assert get_db().execute("SELECT COUNT(*) AS n FROM limit_waiters").fetchone()["n"] == 0
+
+
+def test_concurrency(app, counters):
+    app.config["PROVIDER_LIMITS"] = {"fake": {"concurrency": 1}}
+    app.config["LIMIT_WAIT_MAX"] = 0.2
+    with app.app_context():
+        with limited(FAKE):
+            assert get_db().execute("SELECT user_id FROM limit_slots").fetchall() == [dict(user_id=1)]
+            started = time.monotonic()
+            with pytest.raises(LimitTimeoutError):
+                with limited(FAKE):
+                    pass
+            assert time.monotonic() - started >= 0.2
+            # The provider call gives up and reports the error
+            response = get_provider_response(dict(FAKE, name="agent", context=None), [dict(role="user", content="hi")])
+            assert response["success"] is False
+            assert isinstance(response["content"], LimitTimeoutError)
+        # The slot is free again
+        with limited(FAKE):
+            pass
+        db = get_db()
+        assert db.execute("SELECT COUNT(*) AS n FROM limit_slots").fetchone()["n"] == 0
+        assert db.execute("SELECT COUNT(*) AS n FROM limit_waiters").fetchone()["n"] == 0
+        assert counters()["limits.fake.timeouts"] == 2
+        assert app.extensions["metrics"].snapshot()["timings"]["limits.fake.wait_seconds"]["count"] == 2
+        # A slot left behind by a dead worker expires
+        db.execute("INSERT INTO limit_slots (provider, model, user_id, expires) VALUES ('fake', 'fake', 1, ?)", (time.time() - 1,))
+        db.commit()
+        with limited(FAKE):
+            pass
+
+
+def test_rate(app):
+    app.config["PROVIDER_LIMITS"] = {"fake/fake": {"rate": 0.001, "burst": 2}}
+    app.config["LIMIT_WAIT_MAX"] = 0.1
+    with app.app_context():
+        for _ in range(2):
+            with limited(FAKE):
+                pass
+        with pytest.raises(LimitTimeoutError):
+            with limited(FAKE):
+                pass
+        # Other models aren't affected
+        with limited(dict(FAKE, model_code="other")):
+            pass
+
+
+def test_fair_order(app):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO limit_slots (provider, model, user_id, expires) VALUES ('fake', 'fake', ?, ?)",
+            [(1, time.time() + 60), (1, time.time() + 60)]
+        )
+        waiters = [
+            db.execute("INSERT INTO limit_waiters (provider, model, user_id, seen) VALUES ('fake', 'fake', ?, ?)", (user_id, time.time())).lastrowid
+            for user_id in (1, 1, 2, 2)
+        ]
+        # The user with calls in flight waits for the one without, though they queued first
+        assert [is_next(db, "fake", "fake", waiter) for waiter in waiters] == [False, False, True, False]
+        db.execute("DELETE FROM limit_waiters WHERE id = ?", (waiters[2],))
+        assert is_next(db, "fake", "fake", waiters[3])
+        db.execute("DELETE FROM limit_waiters WHERE id = ?", (waiters[3],))
+        assert is_next(db, "fake", "fake", waiters[0])
+
+
+def test_limit_outside_resilience(app, counters):
+    app.config["PROVIDER_LIMITS"] = {"fake": {"concurrency": 1}}
+    app.config["LIMIT_WAIT_MAX"] = 0.1
+    with app.app_context():
+        breaker = app.extensions["resilience"].get_breaker("fake")
+        breaker.failures = 2
+        agent = dict(FAKE, name="agent", context=None)
+        with limited(FAKE):
+            response = get_provider_response(agent, [dict(role="user", content="hi")])
+            assert isinstance(response["content"], LimitTimeoutError)
+            with pytest.raises(LimitTimeoutError):
+                list(stream_provider_response(agent, [dict(role="user", content="hi")]))
+        # The provider was never called, so its breaker and latencies are untouched
+        assert breaker.failures == 2
+        assert len(app.extensions["resilience"].get_latencies("fake").samples) == 0
+        assert "resilience.fake.failures" not in counters()
+        # A stream holds its slot until it ends
+        chunks = stream_provider_response(agent, [dict(role="user", content="hi")])
+        next(chunks)
+        assert get_db().execute("SELECT COUNT(*) AS n FROM limit_slots").fetchone()["n"] == 1
+        list(chunks)
+        assert get_db().execute("SELECT COUNT(*) AS n FROM limit_slots").fetchone()["n"] == 0
+
+
+def test_hedged_copy_takes_a_slot(app, counters, monkeypatch):
+    app.config["HEDGE_PERCENTILE"] = 0.5
+    app.config["HEDGE_MIN_SAMPLES"] = 3
+    app.config["PROVIDER_LIMITS"] = {"fake": {"concurrency": 1}}
+    slots = []
+    def slow(conversation_history, agent):
+        slots.append(with_connection(lambda db: db.execute("SELECT COUNT(*) AS n FROM limit_slots").fetchone()["n"]))
+        time.sleep(0.1)
+        return dict(success=True, content="slow")
+    monkeypatch.setattr("incontext.providers.get_fake_response", slow)
+    agent = dict(FAKE, name="agent", context=None)
+    with app.app_context():
+        for _ in range(3):
+            app.extensions["resilience"].get_latencies("fake").add(0.01)
+        # The call holds the only slot, so there is no second copy
+        assert get_provider_response(agent, [dict(role="user", content="hi")])["content"] == "slow"
+        assert slots == [1]
+        assert counters()["resilience.fake.hedges_skipped"] == 1
+        # With room for it, the second copy holds a slot of its own until it finishes
+        app.config["PROVIDER_LIMITS"] = {"fake": {"concurrency": 2}}
+        slots.clear()
+        assert get_provider_response(agent, [dict(role="user", content="hi")])["content"] == "slow"
+        assert slots == [1, 2]
+        assert counters()["resilience.fake.hedges"] == 1
+        time.sleep(0.2) # the slower copy is left to finish
+        assert with_connection(lambda db: db.execute("SELECT COUNT(*) AS n FROM limit_slots").fetchone()["n"]) == 0
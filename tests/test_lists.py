@@ -1,6 +1,7 @@
 import pytest
 from incontext.db import get_db, dict_factory
-from tests.test_db import get_other_tables
+from incontext.lists import get_list_with_items_and_details
+from tests.test_db import get_other_tables, count_queries
 
 def test_index(client, auth, app):
     # user must be logged in
@@ -152,6 +153,99 @@ def test_view(app, client, auth):
                     assert context["description"] not in response.data
 
 
+def test_view_query_count(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        cur = db.cursor()
+        for n in range(200):
+            cur.execute("INSERT INTO items (creator_id, name) VALUES (2, ?)", (f"bulk item {n}",))
+            item_id = cur.lastrowid
+            cur.execute("INSERT INTO list_item_relations (list_id, item_id) VALUES (1, ?)", (item_id,))
+            # Stored out of detail order; the view still renders them under the right columns
+            cur.executemany(
+                "INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (?, ?, ?)",
+                [(item_id, 2, f"second {n}"), (item_id, 1, f"first {n}")]
+            )
+        db.commit()
+        auth.login()
+        with count_queries(db) as queries:
+            response = client.get("/lists/1/view?limit=500")
+        assert response.status_code == 200
+        # The number of queries doesn't depend on the number of items or details
+        assert len(queries) <= 6
+        assert response.data.index(b"<td>first 199</td>") < response.data.index(b"<td>second 199</td>")
+        alist = get_list_with_items_and_details(1, False)
+        assert len(alist["items"]) == 202
+        assert alist["items"][0]["relations"] == [
+            dict(name="detail name 1", content="relation content 1"),
+            dict(name="detail name 2", content="relation content 2"),
+        ]
+        assert alist["items"][-1]["relations"] == [
+            dict(name="detail name 1", content="first 199"),
+            dict(name="detail name 2", content="second 199"),
+        ]
+
+
+def test_view_pagination(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        cur = db.cursor()
+        for n in range(5):
+            cur.execute("INSERT INTO items (creator_id, name) VALUES (2, ?)", (f"paged item {n}",))
+            item_id = cur.lastrowid
+            cur.execute("INSERT INTO list_item_relations (list_id, item_id) VALUES (1, ?)", (item_id,))
+            cur.executemany(
+                "INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (?, ?, ?)",
+                [(item_id, 1, f"paged content {n}"), (item_id, 2, "")]
+            )
+        db.commit()
+        item_ids = [row["item_id"] for row in db.execute("SELECT item_id FROM list_item_relations WHERE list_id = 1 ORDER BY item_id")]
+        assert len(item_ids) == 7
+        auth.login()
+        # Web view
+        response = client.get("/lists/1/view?limit=3")
+        assert b"item name 1" in response.data
+        assert b"paged item 0" in response.data
+        assert b"paged item 1" not in response.data
+        assert f"/lists/1/view?after={item_ids[2]}&amp;limit=3".encode() in response.data # the page size carries over
+        response = client.get(f"/lists/1/view?limit=3&after={item_ids[5]}")
+        assert b"paged item 4" in response.data
+        assert b"paged item 3" not in response.data
+        assert b"Next page" not in response.data
+        assert b'<a href="/lists/1/view?limit=3">First page</a>' in response.data
+        response = client.get(f"/lists/1/view?after={item_ids[2]}")
+        assert b"limit=" not in response.data # and is left out when not given
+        # JSON pages walk the whole list exactly once
+        seen = []
+        after = None
+        while True:
+            path = "/lists/1/items?limit=2" + (f"&after={after}" if after else "")
+            page = client.get(path).json
+            assert len(page["items"]) <= 2
+            seen += [item["id"] for item in page["items"]]
+            after = page["next_after"]
+            if after is None:
+                break
+        assert seen == item_ids
+        page = client.get("/lists/1/items?limit=1").json
+        assert [detail["name"] for detail in page["details"]] == ["detail name 1", "detail name 2"]
+        assert page["items"][0]["relations"] == [
+            dict(name="detail name 1", content="relation content 1"),
+            dict(name="detail name 2", content="relation content 2"),
+        ]
+        # Page size is clamped to the configured maximum
+        app.config["LIST_PAGE_SIZE_MAX"] = 4
+        assert len(client.get("/lists/1/items?limit=100").json["items"]) == 4
+        assert len(client.get("/lists/1/items?limit=0").json["items"]) == 1
+        # Access control
+        auth.login("other", "other")
+        assert client.get("/lists/1/items").status_code == 403
+        auth.logout()
+        assert client.get("/lists/1/items").status_code == 302
+        auth.login()
+        assert client.get("/lists/99/items").status_code == 404
+
+
 def test_edit(app, client, auth):
     # Get requests
     # User must be logged in
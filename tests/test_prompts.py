@@ -0,0 +1,88 @@
+import logging
+
+from incontext.db import get_db
+from incontext.conversations import get_agent_request
+from incontext.prompts import ApproximateTokenizer, fit_history, get_tokenizer, assemble_prompt
+
+
+def make_messages(count, length=40):
+    return [dict(id=i, human=(i + 1) % 2, content=f"{i:<{length}}") for i in range(count)]
+
+
+def test_approximate_tokenizer():
+    tokenizer = ApproximateTokenizer()
+    assert tokenizer.count("") == 0
+    assert tokenizer.count("abcd") == 1
+    assert tokenizer.count("abcde") == 2
+
+
+def test_get_tokenizer(app):
+    with app.app_context():
+        assert isinstance(get_tokenizer(), ApproximateTokenizer)
+        assert get_tokenizer() is get_tokenizer()
+
+
+def test_fit_history_sliding(app):
+    tokenizer = ApproximateTokenizer()
+    messages = make_messages(10) # 14 tokens each
+    with app.app_context():
+        assert fit_history(messages, 1000, tokenizer) == messages
+        assert fit_history(messages, 42, tokenizer) == messages[-3:]
+        # The latest message is kept even if it doesn't fit
+        assert fit_history(messages, 1, tokenizer) == messages[-1:]
+
+
+def test_fit_history_head_tail(app):
+    tokenizer = ApproximateTokenizer()
+    messages = make_messages(10)
+    with app.app_context():
+        assert fit_history(messages, 70, tokenizer, "head_tail") == messages[:2] + messages[-3:]
+
+
+def test_fit_history_summary(app):
+    tokenizer = ApproximateTokenizer()
+    messages = make_messages(10)
+    with app.app_context():
+        app.config["PROMPT_SUMMARY_TOKENS"] = 30
+        history = fit_history(messages, 120, tokenizer, "summary")
+    summary = history[0]
+    assert summary["human"] == 1
+    assert summary["content"].startswith("Summary of the earlier conversation:")
+    assert history[1:] == messages[-6:]
+    assert "Agent: 3" in summary["content"]
+    assert "User: 0 " not in summary["content"] # the oldest dropped turns go first when the note is too long
+
+
+def test_assemble_prompt(app, caplog):
+    agent = dict(role="helper", instructions="Help.", context_budget=None)
+    context_message = dict(human=1, content="Contextual info: []")
+    messages = make_messages(10)
+    with app.app_context():
+        app.config["PROMPT_BUDGET"] = app.config["PROMPT_RESPONSE_RESERVE"] + 1000
+        with caplog.at_level(logging.INFO):
+            assert assemble_prompt(agent, 1, context_message, messages) == messages
+        assert "Prompt for conversation 1: " in caplog.text
+        # The model's own budget wins over the default
+        agent["context_budget"] = app.config["PROMPT_RESPONSE_RESERVE"] + 60
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            prompt = assemble_prompt(agent, 1, context_message, messages)
+        assert prompt == messages[-3:]
+        assert "3 of 10 messages" in caplog.text
+
+
+def test_get_agent_request_budget(app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "UPDATE agent_models SET context_budget = ?"
+            " WHERE id = (SELECT model_id FROM agents WHERE id = 1)",
+            (app.config["PROMPT_RESPONSE_RESERVE"] + 40,)
+        )
+        db.commit()
+        agent, conversation_history = get_agent_request(1, check_access=False)
+        assert agent["context_budget"] == app.config["PROMPT_RESPONSE_RESERVE"] + 40
+        # Only the latest message fits next to the context
+        assert len(conversation_history) == 1
+        assert "message content 3" in str(conversation_history[-1])
+        assert agent["context"].startswith("Contextual info")
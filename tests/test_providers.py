@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from incontext.providers import (
+    ClientRegistry, clients, get_openai_client, get_openai_input, get_openai_options, get_openai_usage,
+    get_anthropic_system, get_anthropic_usage, get_anthropic_tool_options, get_google_usage, get_google_cached_content,
+    get_google_tool_config, format_tool_results
+)
+from incontext.db import get_db
+from incontext.tools import TOOLS
+
+
+def make_counting_factory(built):
+    def factory(api_key, **options):
+        built.append((api_key, options))
+        return object()
+    return factory
+
+
+def test_client_reuse():
+    registry = ClientRegistry()
+    built = []
+    factory = make_counting_factory(built)
+    options = (('timeout', 5.0),)
+    client = registry.get_client('openai', 'key-1', options, factory)
+    assert registry.get_client('openai', 'key-1', options, factory) is client
+    assert built == [('key-1', {'timeout': 5.0})]
+    # Another provider gets its own client
+    assert registry.get_client('anthropic', 'key-1', options, factory) is not client
+    assert len(built) == 2
+
+
+def test_client_rotation():
+    registry = ClientRegistry()
+    built = []
+    factory = make_counting_factory(built)
+    old_client = registry.get_client('openai', 'key-1', (), factory)
+    new_client = registry.get_client('openai', 'key-2', (), factory)
+    assert new_client is not old_client
+    # The stale client is dropped rather than kept alongside the new one
+    assert list(registry._clients) == [('openai', 'key-2', ())]
+
+
+def test_client_thread_safety():
+    registry = ClientRegistry()
+    built = []
+    factory = make_counting_factory(built)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(registry.get_client('openai', 'key-1', (), factory))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(built) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_credential_rotation(monkeypatch, tmp_path):
+    registry = ClientRegistry()
+    monkeypatch.delenv('TEST_API_KEY', raising=False)
+    monkeypatch.setenv('CREDENTIALS_DIRECTORY', str(tmp_path))
+    path = tmp_path / 'TEST_API_KEY'
+    path.write_text('old-key\n')
+    assert registry.get_credential('TEST_API_KEY') == 'old-key'
+    path.write_text('new-key\n')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert registry.get_credential('TEST_API_KEY') == 'new-key'
+    # The environment takes precedence over the credentials directory
+    monkeypatch.setenv('TEST_API_KEY', 'env-key')
+    assert registry.get_credential('TEST_API_KEY') == 'env-key'
+
+
+def test_get_openai_client(app, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    app.config['PROVIDER_TIMEOUT'] = 7.0
+    app.config['PROVIDER_BASE_URLS'] = {'openai': 'http://127.0.0.1:9/v1'}
+    clients.clear()
+    with app.app_context():
+        client = get_openai_client()
+        assert get_openai_client() is client
+        assert client.timeout == 7.0
+        assert str(client.base_url) == 'http://127.0.0.1:9/v1/'
+        monkeypatch.setenv('OPENAI_API_KEY', 'rotated-key')
+        rotated = get_openai_client()
+        assert rotated is not client
+        assert rotated.api_key == 'rotated-key'
+    clients.clear()
+
+
+def make_agent(**values):
+    return dict(dict(
+        id=1, name="agent", role="helper", instructions="Help.", model_code="model",
+        provider_code="fake", context="Contextual info: []", context_key="1-0",
+    ), **values)
+
+
+def test_openai_prompt_prefix():
+    agent = make_agent()
+    history = [dict(role="user", content="hi")]
+    assert get_openai_input(history, agent) == [
+        dict(role="developer", content="You are a helper. Help."),
+        dict(role="user", content="Contextual info: []"),
+        dict(role="user", content="hi"),
+    ]
+    assert get_openai_options(agent) == dict(model="model", prompt_cache_key="context-1-0")
+    assert get_openai_options(make_agent(context=None, context_key=None)) == dict(model="model")
+
+
+def test_anthropic_cache_breakpoint():
+    assert get_anthropic_system(make_agent()) == [
+        dict(type="text", text="You are a helper."),
+        dict(type="text", text="Contextual info: []", cache_control=dict(type="ephemeral")),
+    ]
+
+
+def test_tool_formats():
+    tool = TOOLS[2]
+    agent = make_agent(tools=[tool], tool_choice="none")
+    assert get_openai_options(agent)["tools"] == [dict(type="function", **tool)]
+    assert get_openai_options(agent)["tool_choice"] == "none"
+    assert get_anthropic_tool_options(agent) == dict(
+        tools=[dict(name="search_items", description=tool["description"], input_schema=tool["parameters"])],
+        tool_choice=dict(type="none"),
+    )
+    assert get_anthropic_tool_options(make_agent()) == {}
+    config = get_google_tool_config(agent)
+    assert config.tools[0].function_declarations[0].name == "search_items"
+    assert config.tool_config.function_calling_config.mode == "NONE"
+    calls = [dict(id="call_1", name="search_items", arguments=dict(list_id=1, query="x"))]
+    assert format_tool_results(make_agent(provider_code="openai"), calls, ["[]"]) == [
+        dict(type="function_call_output", call_id="call_1", output="[]"),
+    ]
+    assert format_tool_results(make_agent(provider_code="anthropic"), calls, ["[]"]) == [
+        dict(role="user", content=[dict(type="tool_result", tool_use_id="call_1", content="[]")]),
+    ]
+    assert format_tool_results(make_agent(provider_code="google"), calls, ["[]"]) == [
+        dict(role="user", parts=[dict(function_response=dict(id="call_1", name="search_items", response=dict(result="[]")))]),
+    ]
+
+
+def test_usage():
+    openai_usage = SimpleNamespace(input_tokens=1200, input_tokens_details=SimpleNamespace(cached_tokens=1024), output_tokens=10)
+    assert get_openai_usage(openai_usage) == dict(input_tokens=1200, cached_input_tokens=1024, output_tokens=10)
+    anthropic_usage = SimpleNamespace(input_tokens=20, cache_creation_input_tokens=0, cache_read_input_tokens=1500, output_tokens=10)
+    assert get_anthropic_usage(anthropic_usage) == dict(input_tokens=1520, cached_input_tokens=1500, output_tokens=10)
+    google_usage = SimpleNamespace(prompt_token_count=5000, cached_content_token_count=4500, candidates_token_count=10)
+    assert get_google_usage(google_usage) == dict(input_tokens=5000, cached_input_tokens=4500, output_tokens=10)
+    assert get_openai_usage(None) is None
+
+
+class Unavailable(Exception):
+    status_code = 503
+
+
+def test_google_cached_content(app, monkeypatch):
+    created = []
+    deleted = []
+    class Caches:
+        def create(self, model, config):
+            created.append((model, config))
+            if config.system_instruction == "broken":
+                raise RuntimeError("too small")
+            if config.system_instruction == "busy":
+                raise Unavailable()
+            return SimpleNamespace(name=f"cachedContents/{len(created)}")
+        def delete(self, name):
+            deleted.append(name)
+    monkeypatch.setattr("incontext.providers.get_google_client", lambda: SimpleNamespace(caches=Caches()))
+    big_context = "x" * 40000
+    with app.app_context():
+        app.config["GEMINI_CACHE_MIN_TOKENS"] = 4096
+        # Small contexts aren't cached
+        assert get_google_cached_content(make_agent(), "system") is None
+        assert created == []
+        # One cached content per context version
+        agent = make_agent(context=big_context)
+        assert get_google_cached_content(agent, "system") == "cachedContents/1"
+        assert get_google_cached_content(agent, "system") == "cachedContents/1"
+        assert created[0][1].contents[0].parts[0].text == big_context
+        # A new version replaces the one before, which is deleted
+        newer = make_agent(context=big_context, context_key="1-1")
+        assert get_google_cached_content(newer, "system") == "cachedContents/2"
+        assert deleted == ["cachedContents/1"]
+        # Other worker processes use the same cached content
+        app.extensions["google_caches"].clear()
+        assert get_google_cached_content(newer, "system") == "cachedContents/2"
+        assert len(created) == 2
+        # A failure is remembered rather than retried every turn
+        assert get_google_cached_content(agent, "broken") is None
+        assert get_google_cached_content(agent, "broken") is None
+        assert len(created) == 3
+        # A transient one only for a short while
+        assert get_google_cached_content(agent, "busy") is None
+        expires = [row["expires"] for row in get_db().execute("SELECT expires FROM gemini_caches WHERE name IS NULL ORDER BY expires")]
+        assert expires[0] <= time.time() + app.config["GEMINI_CACHE_RETRY_SECONDS"]
+        assert expires[1] > time.time() + app.config["GEMINI_CACHE_TTL"] - 1
@@ -0,0 +1,294 @@
+import threading
+import time
+
+import httpx
+import pytest
+
+from incontext.resilience import CircuitBreaker, CircuitOpenError, call, stream, get_retry_after, get_backoff
+from incontext.db import get_db
+from incontext.providers import stream_provider_response, convert_history
+from tests.test_conversations import responses_stub, use_openai_stub, use_fake_provider, read_events
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = httpx.Response(status_code, headers=headers or {})
+
+
+def failing(*errors, result="ok"):
+    '''Returns a function that raises `errors` one per call, then returns `result`.'''
+    errors = list(errors)
+    calls = []
+    def fn():
+        calls.append(time.monotonic())
+        if errors:
+            raise errors.pop(0)
+        return result
+    fn.calls = calls
+    return fn
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("incontext.resilience.time.sleep", sleeps.append)
+    return sleeps
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("incontext.resilience.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, reset_seconds=30)
+    assert breaker.allow() == 0
+    assert breaker.failure() is False
+    assert breaker.failure() is True # opened
+    assert breaker.allow() == 30
+    now[0] += 30
+    assert breaker.allow() == 0 # the trial call
+    assert breaker.allow() > 0 # everyone else waits for it
+    assert breaker.failure() is False # reopened, not newly opened
+    now[0] += 30
+    assert breaker.allow() == 0
+    breaker.success()
+    assert breaker.allow() == 0
+    assert breaker.failures == 0
+    # A trial that is never heard from makes way for another
+    breaker.failure()
+    breaker.failure()
+    now[0] += 30
+    assert breaker.allow() == 0
+    assert breaker.allow() == 30
+    now[0] += 30
+    assert breaker.allow() == 0
+
+
+def test_retry_after(app):
+    assert get_retry_after(StatusError(429, {"retry-after": "2"})) == 2
+    assert get_retry_after(StatusError(429, {"retry-after-ms": "250"})) == 0.25
+    assert get_retry_after(StatusError(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert get_retry_after(StatusError(429)) is None
+    assert get_retry_after(ValueError()) is None
+    with app.app_context():
+        app.config["RETRY_MAX_DELAY"] = 1
+        for attempt in range(5):
+            assert 0 <= get_backoff(attempt, StatusError(503)) <= 1
+        assert get_backoff(0, StatusError(429, {"retry-after": "5"})) == 5
+        assert get_backoff(0, StatusError(429, {"retry-after": "120"})) is None # longer than RETRY_AFTER_MAX
+
+
+def test_retries(app, sleeps, counters):
+    with app.app_context():
+        fn = failing(StatusError(503), StatusError(429, {"retry-after": "3"}))
+        assert call("test", fn) == "ok"
+        assert len(fn.calls) == 3
+        assert sleeps[1] == 3
+        assert counters()["resilience.test.retries"] == 2
+        # Errors about the request itself aren't retried
+        fn = failing(StatusError(400))
+        with pytest.raises(StatusError):
+            call("test", fn)
+        assert len(fn.calls) == 1
+        # Neither is a provider that keeps failing past RETRY_MAX_ATTEMPTS
+        fn = failing(*[httpx.ReadTimeout("slow")] * 3)
+        with pytest.raises(httpx.ReadTimeout):
+            call("test", fn)
+        assert len(fn.calls) == 3
+        assert counters()["resilience.test.timeouts"] == 3
+
+
+def test_circuit_breaker_fails_fast(app, sleeps, counters):
+    with app.app_context():
+        app.config["BREAKER_FAILURES"] = 2
+        app.config["RETRY_MAX_ATTEMPTS"] = 1
+        for _ in range(2):
+            with pytest.raises(StatusError):
+                call("test", failing(StatusError(503)))
+        fn = failing()
+        with pytest.raises(CircuitOpenError):
+            call("test", fn)
+        assert fn.calls == []
+        assert counters()["resilience.test.breaker_opened"] == 1
+        assert counters()["resilience.test.short_circuits"] == 1
+        # Other providers are unaffected
+        assert call("other", fn) == "ok"
+
+
+def test_abandoned_trial_stream(app, sleeps, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("incontext.resilience.time.monotonic", lambda: now[0])
+    def make_stream():
+        yield "hello"
+        yield " there"
+    with app.app_context():
+        app.config["BREAKER_FAILURES"] = 1
+        app.config["RETRY_MAX_ATTEMPTS"] = 1
+        with pytest.raises(StatusError):
+            call("test", failing(StatusError(503)))
+        now[0] += app.config["BREAKER_RESET_SECONDS"]
+        chunks = stream("test", make_stream) # the trial
+        assert next(chunks) == "hello"
+        chunks.close() # the client went away
+        # The next call is the trial, and closes the breaker
+        assert list(stream("test", make_stream)) == ["hello", " there"]
+        assert call("test", lambda: "ok") == "ok"
+
+
+def test_hedging(app, counters):
+    with app.app_context():
+        app.config["HEDGE_PERCENTILE"] = 0.5
+        app.config["HEDGE_MIN_SAMPLES"] = 3
+        latencies = app.extensions["resilience"].get_latencies("test")
+        for _ in range(3):
+            latencies.add(0.01)
+        calls = []
+        def fn():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.5) # the first copy is stuck
+                return "slow"
+            return "fast"
+        assert call("test", fn) == "fast"
+        assert counters()["resilience.test.hedges"] == 1
+        assert counters()["resilience.test.hedge_wins"] == 1
+        # A request as fast as usual isn't hedged
+        assert call("test", lambda: "quick") == "quick"
+        assert counters()["resilience.test.hedges"] == 1
+
+
+def test_hedging_saturated(app, counters):
+    with app.app_context():
+        app.config["HEDGE_PERCENTILE"] = 0.5
+        app.config["HEDGE_MIN_SAMPLES"] = 3
+        resilience = app.extensions["resilience"]
+        for _ in range(3):
+            resilience.get_latencies("test").add(0.01)
+        # With every hedge worker busy a slow request runs on alone, and not on the pool
+        for _ in range(app.config["HEDGE_WORKERS"]):
+            resilience.hedge_workers.acquire()
+        threads = []
+        def slow():
+            threads.append(threading.current_thread().name)
+            time.sleep(0.1)
+            return "slow"
+        assert call("test", slow) == "slow"
+        assert threads == ["incontext-call"]
+        assert counters()["resilience.test.hedges_skipped"] == 1
+        assert "resilience.test.hedges" not in counters()
+        # A freed worker takes the next hedge
+        resilience.hedge_workers.release()
+        threads.clear()
+        assert call("test", slow) == "slow"
+        assert sorted(name.split("_")[0] for name in threads) == ["incontext-call", "incontext-hedge"]
+        assert counters()["resilience.test.hedges"] == 1
+
+
+def test_fault_injection(app, client, auth, responses_stub, sleeps, counters):
+    from tests.test_conversations import ResponsesStub
+    app.config["PROVIDER_TIMEOUT"] = 0.2
+    with app.app_context():
+        use_openai_stub()
+    auth.login()
+    ResponsesStub.faults = [(429, {"retry-after": "1"}), (503, {}), 1.0]
+    app.config["RETRY_MAX_ATTEMPTS"] = 4
+    response = client.post("/conversations/agent-response", json=dict(conversation_id=1))
+    assert response.json["content"] == "reply resp_4"
+    assert len(responses_stub) == 4
+    assert sleeps[0] == 1 # honored retry-after
+    assert counters()["resilience.openai.retries"] == 3
+    assert counters()["resilience.openai.timeouts"] == 1
+    # Out of attempts, the error reaches the user
+    ResponsesStub.faults = [(500, {})] * 4
+    response = client.post("/conversations/agent-response", json=dict(conversation_id=1))
+    assert response.json["content"].startswith("An error occurred")
+
+
+def test_stream_retries_until_first_chunk(app, sleeps, monkeypatch):
+    opened = []
+    def flaky_stream(conversation_history, agent, report=None):
+        opened.append(None)
+        if len(opened) == 1:
+            raise StatusError(503)
+        yield "hello"
+        yield " there"
+    monkeypatch.setattr("incontext.providers.stream_fake_response", flaky_stream)
+    with app.app_context():
+        use_fake_provider()
+        agent = dict(provider_code="fake")
+        assert list(stream_provider_response(agent, [])) == ["hello", " there"]
+        assert len(opened) == 2
+        # Once text has been sent an error isn't retried
+        def broken_stream(conversation_history, agent, report=None):
+            opened.append(None)
+            yield "partial"
+            raise StatusError(503)
+        monkeypatch.setattr("incontext.providers.stream_fake_response", broken_stream)
+        chunks = stream_provider_response(agent, [])
+        assert next(chunks) == "partial"
+        with pytest.raises(StatusError):
+            next(chunks)
+        assert len(opened) == 3
+
+
+def add_fake_fallback(agent_id=1):
+    '''Leaves the agent on its own model and adds the offline fake provider as its fallback.'''
+    db = get_db()
+    cur = db.execute(
+        "INSERT INTO agent_models (provider_name, provider_code, model_name, model_code, model_description)"
+        " VALUES ('Fake', 'fake', 'Fake', 'fake', 'Offline echo')"
+    )
+    db.execute("INSERT INTO agent_fallbacks (agent_id, model_id, position) VALUES (?, ?, 0)", (agent_id, cur.lastrowid))
+    db.commit()
+    return cur.lastrowid
+
+
+def test_fallback_response(app, client, auth, sleeps, monkeypatch, counters):
+    calls = []
+    def overloaded(conversation_history, agent):
+        calls.append(conversation_history)
+        raise StatusError(529)
+    for provider in ("openai", "anthropic", "google"):
+        monkeypatch.setattr(f"incontext.providers.get_{provider}_response", overloaded)
+    with app.app_context():
+        model_id = add_fake_fallback()
+    auth.login()
+    response = client.post("/conversations/agent-response", json=dict(conversation_id=1))
+    assert response.json["content"] == "agent name 1 heard: message content 3"
+    assert len(calls) == app.config["RETRY_MAX_ATTEMPTS"] # the own model is retried first
+    with app.app_context():
+        message = get_db().execute("SELECT model_id, chain_key FROM messages ORDER BY id DESC LIMIT 1").fetchone()
+        assert message["model_id"] == model_id
+        assert message["chain_key"] is None
+        assert counters()["fallbacks.fake"] == 1
+    # Without a fallback that answers the error is returned
+    monkeypatch.setattr("incontext.providers.get_fake_response", overloaded)
+    response = client.post("/conversations/agent-response", json=dict(conversation_id=1))
+    assert response.json["content"].startswith("An error occurred")
+
+
+def test_fallback_stream(app, client, auth, sleeps, monkeypatch):
+    def overloaded(conversation_history, agent, report=None):
+        raise StatusError(503)
+        yield
+    for provider in ("openai", "anthropic", "google"):
+        monkeypatch.setattr(f"incontext.providers.stream_{provider}_response", overloaded)
+    with app.app_context():
+        model_id = add_fake_fallback()
+    auth.login()
+    response = client.post("/conversations/agent-response/stream", json=dict(conversation_id=1))
+    events = read_events(response)
+    assert events[-1][0] == "done"
+    assert events[-1][1]["content"] == "agent name 1 heard: message content 3"
+    with app.app_context():
+        message = get_db().execute("SELECT model_id FROM messages WHERE id = ?", (events[-1][1]["message_id"],)).fetchone()
+        assert message["model_id"] == model_id
+
+
+def test_convert_history():
+    google = dict(provider_code="google")
+    openai = dict(provider_code="openai")
+    history = [dict(role="user", content="hi"), dict(role="assistant", content="hello")]
+    converted = convert_history(history, google)
+    assert converted == [dict(role="user", parts=[{"text": "hi"}]), dict(role="model", parts=[{"text": "hello"}])]
+    assert convert_history(converted, openai) == history
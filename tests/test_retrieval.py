@@ -0,0 +1,112 @@
+import json
+
+from incontext.cache import bump_list_context_versions
+from incontext.conversations import get_agent_request, get_context_payload
+from incontext.db import get_db
+from incontext.prompts import get_tokenizer
+from incontext import create_app
+from incontext.retrieval import LexicalIndex, get_index, is_enabled, tokenize
+
+
+def add_items(db, list_id, names):
+    cur = db.cursor()
+    for name, content in names:
+        cur.execute("INSERT INTO items (creator_id, name) VALUES (2, ?)", (name,))
+        item_id = cur.lastrowid
+        cur.execute("INSERT INTO list_item_relations (list_id, item_id) VALUES (?, ?)", (list_id, item_id))
+        cur.execute("INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (?, 1, ?)", (item_id, content))
+    bump_list_context_versions(list_id)
+    db.commit()
+
+
+def test_tokenize():
+    assert tokenize("Hello, wörld! 42 times") == ["hello", "wörld", "42", "times"]
+
+
+def test_index(app):
+    with app.app_context():
+        db = get_db()
+        add_items(db, 1, [
+            ("apple pie", "a sweet dessert with apples"),
+            ("banana bread", "bread baked with ripe bananas"),
+            ("apple juice", "pressed apple drink"),
+        ])
+        index = LexicalIndex()
+        assert index.refresh(1, get_context_payload(1)) == 6
+        scores = dict(zip(index.item_ids.tolist(), index.score("apple").tolist()))
+        apple_ids = [row["id"] for row in db.execute("SELECT id FROM items WHERE name LIKE 'apple%'")]
+        assert all(scores[i] > 0 for i in apple_ids)
+        assert sum(1 for score in scores.values() if score > 0) == 2
+        assert index.score("nothing like it").sum() == 0
+        # Only changed items are tokenized again
+        db.execute("UPDATE item_detail_relations SET content = 'bread with banana and apple' WHERE content = 'bread baked with ripe bananas'")
+        assert index.refresh(2, get_context_payload(1)) == 1
+        assert sum(1 for score in index.score("apple").tolist() if score > 0) == 3
+        db.execute("DELETE FROM list_item_relations WHERE item_id = ?", (apple_ids[0],))
+        assert index.refresh(3, get_context_payload(1)) == 0
+        assert sum(1 for score in index.score("apple").tolist() if score > 0) == 2
+
+
+def test_select(app):
+    with app.app_context():
+        db = get_db()
+        add_items(db, 1, [(f"item {n}", "common words" + " apple" * (n % 3)) for n in range(10)])
+        index = LexicalIndex()
+        index.refresh(1, get_context_payload(1))
+        tokenizer = get_tokenizer()
+        selected = index.select("apple", 3, 10000, tokenizer)
+        assert [alist["id"] for alist in selected] == [1, 2]
+        assert len(selected[0]["items"]) == 3
+        assert all("apple" in item["detail name 1"] for item in selected[0]["items"])
+        assert selected[0]["total_items"] == 12
+        assert selected[1]["items"] == [] # nothing in list 2 matches
+        # Nothing matches at all: the first items of each list
+        selected = index.select("zebra", 2, 10000, tokenizer)
+        assert [item["name"] for item in selected[0]["items"]] == ["item name 1", "item name 2"]
+        assert [item["name"] for item in selected[1]["items"]] == ["item name 3"]
+        # The budget caps the items sent
+        details = sum(tokenizer.count(json.dumps(alist["details"])) for alist in selected)
+        one_item = tokenizer.count(json.dumps(selected[0]["items"][0]))
+        selected = index.select("apple", 10, details + one_item + 1, tokenizer)
+        assert sum(len(alist["items"]) for alist in selected) == 1
+
+
+def test_agent_request(app, counters):
+    with app.app_context():
+        db = get_db()
+        add_items(db, 1, [("kiwi", "green fruit"), ("plum", "purple fruit")])
+        db.execute("INSERT INTO messages (conversation_id, content, human) VALUES (1, 'Which one is purple?', 1)")
+        db.commit()
+        agent, history = get_agent_request(1, check_access=False)
+        assert "kiwi" in agent["context"] # off by default
+        app.config["CONTEXT_RETRIEVAL"] = True
+        agent, history = get_agent_request(1, check_access=False)
+        assert "plum" in agent["context"]
+        assert "kiwi" not in agent["context"]
+        assert "item name 1" not in agent["context"]
+        assert agent["context_key"].startswith("1-1-")
+        assert counters()["retrieval.refreshes"] == 1
+        # The index is reused until the context changes
+        get_agent_request(1, check_access=False)
+        assert counters()["retrieval.refreshes"] == 1
+        db.execute("INSERT INTO messages (conversation_id, content, human) VALUES (1, 'and the green one?', 1)")
+        db.commit()
+        again, history = get_agent_request(1, check_access=False)
+        assert "kiwi" in again["context"]
+        assert again["context_key"] != agent["context_key"]
+        add_items(db, 1, [("lime", "green citrus")])
+        again, history = get_agent_request(1, check_access=False)
+        assert "lime" in again["context"]
+        assert counters()["retrieval.refreshes"] == 2
+        assert counters()["retrieval.tokenized"] == 6
+        assert get_index(1, 2, lambda: None).version == 2
+
+
+def test_without_numpy(monkeypatch, caplog):
+    monkeypatch.setattr("incontext.retrieval.np", None)
+    other = create_app({"TESTING": True, "CONTEXT_RETRIEVAL": True})
+    assert "numpy is not installed" in caplog.text # once, when the app starts
+    caplog.clear()
+    with other.app_context():
+        assert is_enabled() is False
+    assert caplog.text == ""
@@ -0,0 +1,105 @@
+from incontext.db import get_db
+from incontext.search import get_match_query, search
+from tests.test_db import get_other_tables
+
+
+def results(client, **args):
+    response = client.get("/search/api", query_string=args)
+    assert response.status_code == 200
+    return [(result["kind"], result["id"]) for result in response.json["results"]]
+
+
+def test_search(app, client, auth):
+    with app.app_context():
+        all_tables_before = get_other_tables()
+        # User must be logged in
+        response = client.get("/search/?q=name")
+        assert response.status_code == 302
+        assert response.headers["Location"] == "/auth/login"
+        auth.login()
+        # Every kind is found, and only the user's own
+        assert results(client, q="relation content 4") == [("item", 2)]
+        assert sorted(results(client, q="name", kind="context")) == [("context", 1), ("context", 2)]
+        assert sorted(results(client, q="list description", kind="list")) == [("list", 1), ("list", 2), ("list", 5)]
+        assert sorted(results(client, q="agent", kind="agent")) == [("agent", 1), ("agent", 2), ("agent", 4)]
+        assert results(client, q="message content 1") == [("message", 1)]
+        assert sorted(results(client, q="content 1", kind=["item", "message"])) == [("item", 1), ("message", 1)]
+        # The last word is a prefix, the matches are highlighted, and each result links to its page
+        result = client.get("/search/api?q=relation+cont").json["results"][0]
+        assert "<mark>relation</mark> <mark>content</mark>" in result["snippet"]
+        assert result["url"] == f"/lists/1/items/{result['id']}/view"
+        assert client.get("/search/api?q=message+content+2").json["results"][0]["url"] == "/contexts/1/view"
+        assert len(results(client, q="name", limit=3)) == 3
+        response = client.get("/search/?q=message")
+        assert b"Nothing found." not in response.data
+        assert b"<mark>message</mark>" in response.data
+        assert b"Nothing found." in client.get("/search/?q=nothing").data
+        assert get_other_tables() == all_tables_before # Data unchanged
+        auth.logout()
+        auth.login("other", "other")
+        assert results(client, q="message content 1") == [("message", 9)] # "message content 10"
+        assert results(client, q="relation content 4") == [("item", 4)]
+
+
+def test_search_input(app, client, auth):
+    auth.login()
+    assert get_match_query("  ") is None
+    assert get_match_query('fish "and" chips') == '"fish" """and""" "chips"*'
+    # FTS5 syntax is searched for as text
+    for q in ['"', "AND", "name OR", "NEAR(name", "name:1", "*", "-x", "(", "^"]:
+        results(client, q=q)
+    assert results(client, q="") == []
+    # Names and values are escaped, only the highlighting is markup
+    with app.test_request_context():
+        db = get_db()
+        db.execute("INSERT INTO contexts (creator_id, name, description) VALUES (2, '<b>Fish</b> & chips', '')")
+        db.commit()
+        snippet = search(2, "fish", ["context"])[0]["snippet"]
+        assert str(snippet) == "&lt;b&gt;<mark>Fish</mark>&lt;/b&gt; &amp; chips"
+    assert b"<b>Fish" not in client.get("/search/?q=fish").data
+
+
+def test_search_sync(app):
+    with app.test_request_context():
+        db = get_db()
+        # Detail values and names are indexed as they change
+        db.execute("INSERT INTO item_detail_relations (item_id, detail_id, content) VALUES (3, 1, 'plankton')")
+        assert [result["id"] for result in search(2, "plankton")] == [3]
+        db.execute("UPDATE item_detail_relations SET content = 'krill' WHERE content = 'plankton'")
+        assert search(2, "plankton") == []
+        assert [result["id"] for result in search(2, "krill")] == [3]
+        db.execute("DELETE FROM item_detail_relations WHERE content = 'krill'")
+        assert search(2, "krill") == []
+        assert [result["id"] for result in search(2, "relation content 5")] == [3]
+        db.execute("UPDATE items SET name = 'whale' WHERE id = 3")
+        assert [result["title"] for result in search(2, "whale")] == ["whale"]
+        db.execute("DELETE FROM items WHERE id = 3")
+        assert search(2, "whale") == []
+        # So are messages and the names and descriptions of contexts, lists and agents
+        db.execute("UPDATE messages SET content = 'squid' WHERE id = 2")
+        assert [result["id"] for result in search(2, "squid")] == [2]
+        db.execute("DELETE FROM messages WHERE id = 2")
+        db.execute("UPDATE contexts SET description = 'squid' WHERE id = 1")
+        db.execute("UPDATE lists SET name = 'squid' WHERE id = 1")
+        db.execute("UPDATE agents SET description = 'squid' WHERE id = 1")
+        assert sorted((result["kind"], result["id"]) for result in search(2, "squid")) == [("agent", 1), ("context", 1), ("list", 1)]
+        db.execute("DELETE FROM lists WHERE id = 1")
+        assert len(search(2, "squid")) == 2
+        # The index agrees with the tables
+        for table in ["messages_fts", "contexts_fts", "lists_fts", "agents_fts", "items_fts"]:
+            db.execute(f"INSERT INTO {table} ({table}) VALUES ('integrity-check')")
+
+
+def test_search_backfill(app, runner):
+    with app.test_request_context():
+        db = get_db()
+        db.execute("DELETE FROM items_fts")
+        db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+        db.commit()
+        assert search(2, "relation content 4") == []
+        assert search(2, "message content 1") == []
+    result = runner.invoke(args=["search-backfill"])
+    assert "Rebuilt the search index." in result.output
+    with app.test_request_context():
+        assert [result["id"] for result in search(2, "relation content 4")] == [2]
+        assert [result["id"] for result in search(2, "message content 1")] == [1]
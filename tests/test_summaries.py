@@ -0,0 +1,117 @@
+from incontext.db import get_db
+from incontext.conversations import get_agent_request
+from tests.test_conversations import use_fake_provider
+
+
+def get_summaries():
+    return get_db().execute(
+        "SELECT conversation_id, first_message_id, last_message_id, content FROM conversation_summaries ORDER BY id"
+    ).fetchall()
+
+
+def add_messages(*contents):
+    db = get_db()
+    db.executemany(
+        "INSERT INTO messages (conversation_id, content, human) VALUES (1, ?, ?)",
+        [(content, (i + 1) % 2) for i, content in enumerate(contents)]
+    )
+    db.commit()
+
+
+def test_compaction(app):
+    with app.app_context():
+        use_fake_provider()
+        app.config["SUMMARY_RECENT_TOKENS"] = 9 # each test message is 9 tokens
+        # Short conversations are sent in full
+        app.config["SUMMARY_THRESHOLD"] = 1000
+        agent, history = get_agent_request(1, check_access=False)
+        assert [m["content"] for m in history] == ["message content 1", "message content 2", "message content 3"]
+        assert get_summaries() == []
+        # Past the threshold the older messages are summarized once by the agent
+        app.config["SUMMARY_THRESHOLD"] = 20
+        agent, history = get_agent_request(1, check_access=False)
+        summaries = get_summaries()
+        assert len(summaries) == 1
+        assert summaries[0]["first_message_id"] == 1
+        assert summaries[0]["last_message_id"] == 2
+        assert summaries[0]["content"].startswith("agent name 1 heard: Summarize the conversation")
+        assert "User: message content 1\nAgent: message content 2" in summaries[0]["content"]
+        assert history[0]["content"] == f"Summary of the earlier conversation: {summaries[0]['content']}"
+        assert history[1:] == [dict(role="user", content="message content 3")]
+        # The summary is reused while the newer messages stay below the threshold
+        agent, again = get_agent_request(1, check_access=False)
+        assert again == history
+        assert len(get_summaries()) == 1
+        # Then it is extended with the messages that fell out of the recent window
+        add_messages("message content 11", "message content 12", "message content 13")
+        agent, history = get_agent_request(1, check_access=False)
+        summaries = get_summaries()
+        assert len(summaries) == 2
+        last_id = get_db().execute("SELECT MAX(id) AS id FROM messages").fetchone()["id"]
+        assert summaries[1]["first_message_id"] == 1
+        assert summaries[1]["last_message_id"] == last_id - 1
+        assert f"Earlier summary: {summaries[0]['content']}" in summaries[1]["content"]
+        # Only the messages since the earlier summary are sent along with it
+        assert summaries[1]["content"].endswith(f"{summaries[0]['content']}\nUser: message content 3\nUser: message content 11\nAgent: message content 12")
+        assert history[1:] == [dict(role="user", content="message content 13")]
+
+
+def test_compaction_failure(app, monkeypatch, counters):
+    calls = []
+    def failing(conversation_history, agent):
+        calls.append(conversation_history)
+        return dict(success=False, content="no")
+    monkeypatch.setattr("incontext.providers.get_fake_response", failing)
+    with app.app_context():
+        use_fake_provider()
+        app.config["SUMMARY_THRESHOLD"] = 20
+        app.config["SUMMARY_RECENT_TOKENS"] = 9
+        agent, history = get_agent_request(1, check_access=False)
+        assert get_summaries() == []
+        assert len(history) == 3 # every message
+        assert counters()["summaries.failed"] == 1
+        # The next turns don't try again right away
+        agent, history = get_agent_request(1, check_access=False)
+        assert len(history) == 3
+        assert len(calls) == 1
+        assert counters()["summaries.backed_off"] == 1
+        db = get_db()
+        db.execute("UPDATE conversations SET summary_retry_after = 0 WHERE id = 1")
+        db.commit()
+        get_agent_request(1, check_access=False)
+        assert len(calls) == 2
+
+
+def test_concurrent_compaction(app, monkeypatch, counters):
+    def summarize_twice(conversation_history, agent):
+        # Another request for the conversation stores its summary first
+        db = get_db()
+        db.execute(
+            "INSERT INTO conversation_summaries (conversation_id, first_message_id, last_message_id, content)"
+            " VALUES (1, 1, 2, 'the other summary')"
+        )
+        db.commit()
+        return dict(success=True, content="this summary")
+    monkeypatch.setattr("incontext.providers.get_fake_response", summarize_twice)
+    with app.app_context():
+        use_fake_provider()
+        app.config["SUMMARY_THRESHOLD"] = 20
+        app.config["SUMMARY_RECENT_TOKENS"] = 9
+        agent, history = get_agent_request(1, check_access=False)
+        assert [summary["content"] for summary in get_summaries()] == ["the other summary"]
+        assert history[0]["content"] == "Summary of the earlier conversation: the other summary"
+        assert history[1:] == [dict(role="user", content="message content 3")]
+        assert counters()["summaries.duplicates"] == 1
+
+
+def test_delete_conversation_removes_summaries(app, client, auth):
+    with app.app_context():
+        use_fake_provider()
+        app.config["SUMMARY_THRESHOLD"] = 20
+        app.config["SUMMARY_RECENT_TOKENS"] = 9
+        get_agent_request(1, check_access=False)
+        assert len(get_summaries()) == 1
+    auth.login()
+    client.post("/conversations/1/delete")
+    with app.app_context():
+        assert get_summaries() == []
@@ -0,0 +1,105 @@
+import json
+
+from incontext.db import get_db
+from incontext.tools import run_tool
+from tests.test_conversations import use_fake_provider, read_events
+
+
+def call(name, **arguments):
+    return json.loads(run_tool(1, name, arguments))
+
+
+def test_run_tool(app):
+    with app.app_context():
+        assert call("list_lists") == [
+            dict(id=1, name="list name 1", description="list description 1", items=2),
+            dict(id=2, name="list name 2", description="list description 2", items=1),
+        ]
+        assert [detail["name"] for detail in call("get_list_schema", list_id=1)] == ["detail name 1", "detail name 2"]
+        # Every word has to match, in the name or a detail value, ignoring case
+        items = call("search_items", list_id=1, query="RELATION content 3")["items"]
+        assert [item["id"] for item in items] == [2]
+        assert items[0]["detail name 1"] == "relation content 3"
+        assert call("search_items", list_id=1, query="item 100%")["items"] == []
+        assert [item["id"] for item in call("search_items", list_id=1, query="name")["items"]] == [1, 2]
+        # Items of other lists are ignored
+        assert [item["id"] for item in call("get_items", list_id=1, item_ids=[2, 3])["items"]] == [2]
+        app.config["TOOL_PAGE_SIZE"] = 1
+        page = call("get_items", list_id=1)
+        assert [item["id"] for item in page["items"]] == [1]
+        page = call("get_items", list_id=1, after=page["next_after"])
+        assert [item["id"] for item in page["items"]] == [2]
+        assert page["next_after"] is None
+        # Mistakes are reported to the model, and lists outside the context can't be read
+        assert call("get_list_schema", list_id=3) == dict(error="There is no list with id 3 in this context.")
+        assert call("get_items", list_id="one") == dict(error="list_id must be an integer.")
+        assert call("get_items", list_id=1, item_ids="1") == dict(error="item_ids must be a list of integers.")
+        assert call("delete_everything", list_id=1) == dict(error="There is no tool named delete_everything.")
+        counters = app.extensions["metrics"].snapshot()["counters"]
+        assert counters["tools.errors"] == 4
+
+
+def use_tools(monkeypatch, script):
+    '''Makes the fake provider answer with the steps of `script`, each a reply or a list of tool calls. Returns the requests it got.'''
+    requests = []
+
+    def scripted(conversation_history, agent):
+        requests.append((conversation_history, agent))
+        step = script[len(requests) - 1]
+        usage = dict(input_tokens=10, cached_input_tokens=0, output_tokens=1)
+        if isinstance(step, str):
+            return dict(success=True, content=step, usage=usage)
+        tool_calls = [dict(id=f"call_{len(requests)}_{n}", name=name, arguments=arguments) for n, (name, arguments) in enumerate(step)]
+        return dict(success=True, content="", usage=usage, tool_calls=tool_calls, tool_turn=[dict(role="assistant", content="", tool_calls=tool_calls)])
+
+    monkeypatch.setattr("incontext.providers.get_fake_response", scripted)
+    return requests
+
+
+def test_tool_response(app, client, auth, monkeypatch):
+    with app.app_context():
+        use_fake_provider()
+        get_db().execute("UPDATE agents SET context_mode = 'tools' WHERE id = 1")
+        get_db().commit()
+    requests = use_tools(monkeypatch, [
+        [("search_items", dict(list_id=1, query="content 3"))],
+        [("get_list_schema", dict(list_id=1)), ("get_items", dict(list_id=2, item_ids=[3]))],
+        "Item 2 has relation content 3.",
+    ])
+    auth.login()
+    response = client.post("/conversations/agent-response", json=dict(conversation_id="1"))
+    assert response.json == dict(content="Item 2 has relation content 3.")
+    # The prompt has the catalogue in place of the items
+    first, agent = requests[0]
+    assert "list description 1" in agent["context"]
+    assert "relation content" not in agent["context"]
+    assert agent["context_key"] == "1-0-tools"
+    # Each step sees the results of the calls before it
+    history, agent = requests[2]
+    results = [message for message in history if message["role"] == "tool"]
+    assert [result["tool_call_id"] for result in results] == ["call_1_0", "call_2_0", "call_2_1"]
+    assert json.loads(results[0]["content"])["items"][0]["id"] == 2
+    assert json.loads(results[2]["content"])["items"][0]["name"] == "item name 3"
+    with app.app_context():
+        message = get_db().execute("SELECT content, input_tokens, output_tokens FROM messages ORDER BY id DESC LIMIT 1").fetchone()
+        assert message == dict(content="Item 2 has relation content 3.", input_tokens=30, output_tokens=3)
+        assert app.extensions["metrics"].snapshot()["counters"]["tools.steps"] == 2
+
+
+def test_tool_step_cap(app, client, auth, monkeypatch):
+    app.config["TOOL_MAX_STEPS"] = 3
+    with app.app_context():
+        use_fake_provider()
+        get_db().execute("UPDATE agents SET context_mode = 'tools' WHERE id = 1")
+        get_db().commit()
+    requests = use_tools(monkeypatch, [[("list_lists", {})]] * 3)
+    auth.login()
+    response = client.post("/conversations/agent-response", json=dict(conversation_id="1"))
+    assert response.json["content"] == "An error occurred in get_agent_response: No reply after 3 steps of tool calls."
+    assert [agent.get("tool_choice") for history, agent in requests] == [None, None, "none"]
+    # Streamed, the reply comes in one piece once the tools are done
+    requests = use_tools(monkeypatch, [[("list_lists", {})], "Two lists."])
+    response = client.post("/conversations/agent-response/stream", json=dict(conversation_id="1"))
+    events = read_events(response)
+    assert [event for event, data in events] == ["delta", "done"]
+    assert events[-1][1]["content"] == "Two lists."